@@ -2,28 +2,41 @@ import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
 from flask import Flask, request, current_app
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
-from flask_bootstrap import Bootstrap
 from config import Config
-from celery import Celery
+from app.engine import SQLAlchemy
+from app.cache import fragment_cache
+from app.counters import station_counters
+from app.broadcast import broadcaster
+from app.leaderboard import leaderboard
 
 db = SQLAlchemy()
-migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'
 login.login_message = 'Please log in to access this page.'
-bootstrap = Bootstrap()
 
-def create_app(config_class=Config):
+def create_app(config_class=Config, web=True):
+    '''
+    Creates the app; with web False, for celery workers, scripts and
+    command line tasks, it skips the extensions and blueprints only
+    used to serve pages, and Flask-Migrate, which imports alembic
+    '''
     app = Flask(__name__)
     app.config.from_object(config_class)
 
     db.init_app(app)
-    migrate.init_app(app, db)
+    fragment_cache.init_app(app)
+    station_counters.init_app(app)
+    broadcaster.init_app(app)
+    leaderboard.init_app(app)
+    if not web:
+        return app
+
+    from flask_migrate import Migrate
+    from flask_bootstrap import Bootstrap
+    Migrate(app, db)
     login.init_app(app)
-    bootstrap.init_app(app)
+    Bootstrap(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -34,8 +47,8 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
-    celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
-    celery.conf.update(app.config)
+    from app.export import bp as export_bp
+    app.register_blueprint(export_bp, url_prefix='/export')
 
     return app
 
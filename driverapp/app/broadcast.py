@@ -0,0 +1,236 @@
+'''
+Live swap events for the station and driver pages
+
+Each committed swap is published on the channels of its station and driver,
+with the station's stock after it, and the pages listen through a server-sent
+events stream, adding rows to their tables instead of being reloaded. A
+correction removes the row of the swap it corrects.
+
+Events are collected on the session and published once it commits, so a rolled
+back swap is never shown. They are published through Redis pub/sub when
+BROADCAST_REDIS_URL is set, so a page is told of swaps made by any process, and
+not at all otherwise; in process broadcasting (simple) is for development and tests.
+Events published while a page is not listening are not replayed; the page is
+current as of when it was loaded.
+
+Each open stream holds a worker for as long as the page is open, so pages only
+listen when BROADCAST_STREAMS is set, which gunicorn.conf.py does for threaded
+or async workers.
+'''
+import json
+import queue
+import threading
+from time import time
+from flask import current_app
+from sqlalchemy import event
+from app.routing import RoutingSession
+
+# session.info key of the events to publish when the session commits
+PENDING_KEY = 'broadcast_events'
+
+
+def station_channel(charging_station_id):
+    return 'station:{}'.format(charging_station_id)
+
+
+def driver_channel(driver_id):
+    return 'driver:{}'.format(driver_id)
+
+
+class SimpleSubscription():
+    def __init__(self, broker, channels):
+        self.broker = broker
+        self.channels = channels
+        self.messages = queue.Queue()
+
+    def get(self, timeout):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class SimpleBroker():
+    '''
+    In process broadcasting, to a queue per subscription
+    '''
+    def __init__(self):
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, channels):
+        subscription = SimpleSubscription(self, channels)
+        with self.lock:
+            for channel in channels:
+                self.subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for channel in subscription.channels:
+                self.subscriptions.get(channel, set()).discard(subscription)
+
+    def publish(self, messages):
+        with self.lock:
+            for channel, message in messages:
+                for subscription in self.subscriptions.get(channel, ()):
+                    subscription.messages.put(message)
+
+
+class RedisSubscription():
+    def __init__(self, client, channels):
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(*channels)
+
+    def get(self, timeout):
+        # subscribe confirmations are read as None, before the timeout
+        deadline = time() + timeout
+        while True:
+            message = self.pubsub.get_message(timeout=max(deadline - time(), 0))
+            if message:
+                return message['data'].decode('utf-8')
+            if time() >= deadline:
+                return None
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisBroker():
+    def __init__(self, url=None, client=None):
+        if client is None:
+            import redis
+            client = redis.StrictRedis.from_url(url)
+        self.client = client
+
+    def subscribe(self, channels):
+        return RedisSubscription(self.client, channels)
+
+    def publish(self, messages):
+        pipe = self.client.pipeline(transaction=False)
+        for channel, message in messages:
+            pipe.publish(channel, message)
+        pipe.execute()
+
+
+class Broadcaster():
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BROADCAST', 'none')
+        app.config.setdefault('BROADCAST_STREAMS', False)
+        # seconds between comments keeping an idle stream open
+        app.config.setdefault('BROADCAST_KEEPALIVE', 15)
+        backend = app.config['BROADCAST']
+        if backend == 'redis':
+            backend = RedisBroker(app.config['BROADCAST_REDIS_URL'])
+        elif backend == 'simple':
+            backend = SimpleBroker()
+        else:
+            backend = None
+        app.extensions['broadcast'] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions.get('broadcast')
+
+    @property
+    def streams(self):
+        '''
+        Whether pages listen to event streams
+        '''
+        return bool(self.backend) and current_app.config['BROADCAST_STREAMS']
+
+    def record(self, session, transaction, correction=None, stock=()):
+        '''
+        Publishes the swap to its station and driver, and the StationStock
+        of its stations, once the session commits
+        '''
+        if not self.backend:
+            return
+        swap = swap_event(transaction, correction)
+        channels = set()
+        # the correction's pages remove its row
+        for swapped in (transaction, correction):
+            if swapped:
+                channels.add(driver_channel(swapped.driver_id))
+                if swapped.charging_station_id:
+                    channels.add(station_channel(swapped.charging_station_id))
+        pending = session.info.setdefault(PENDING_KEY, [])
+        pending.extend((channel, _message('swap', swap, transaction.id)) for channel in sorted(channels))
+        pending.extend((station_channel(station.charging_station_id), _message('stock', dict(station._asdict())))
+                for station in stock)
+
+    def stream(self, channels):
+        '''
+        Yields server-sent events for the channels, until the client disconnects
+        '''
+        subscription = self.backend.subscribe(channels)
+        keepalive = current_app.config['BROADCAST_KEEPALIVE']
+        try:
+            # how long the browser waits before reconnecting, in milliseconds
+            yield 'retry: 3000\n\n'
+            while True:
+                message = subscription.get(keepalive)
+                if message is None:
+                    yield ': keepalive\n\n'
+                    continue
+                event_type, data, event_id = json.loads(message)
+                if event_id:
+                    yield 'id: {}\n'.format(event_id)
+                yield 'event: {}\ndata: {}\n\n'.format(event_type, json.dumps(data, separators=(',', ':')))
+        finally:
+            subscription.close()
+
+    def _apply(self, session):
+        pending = session.info.pop(PENDING_KEY, None)
+        if pending and self.backend:
+            self.backend.publish(pending)
+
+
+def swap_event(transaction, correction=None):
+    '''
+    What the transactions table shows of a swap
+    '''
+    return {
+        'id': transaction.id,
+        'date': str(transaction.transaction_date),
+        'driver_id': transaction.driver_id,
+        'driver': transaction.driver.display_name,
+        'charging_station_id': transaction.charging_station_id,
+        'charging_station': transaction.charging_station.display_name if transaction.charging_station else None,
+        'battery_in_id': transaction.battery_in_id,
+        'battery_in': transaction.battery_in.serial if transaction.battery_in else None,
+        'battery_out_id': transaction.battery_out_id,
+        'battery_out': transaction.battery_out.serial if transaction.battery_out else None,
+        'battery_in_energy': transaction.battery_in_energy,
+        'battery_out_energy': transaction.battery_out_energy,
+        'odometer_reading': transaction.odometer_reading,
+        'ride_distance': transaction.ride_distance,
+        'energy_used': transaction.energy_used,
+        'efficiency': transaction.efficiency,
+        'charge_amount': transaction.charge_amount,
+        'corrects': correction.id if correction else None,
+    }
+
+
+def _message(event_type, data, event_id=None):
+    return json.dumps([event_type, data, event_id], separators=(',', ':'))
+
+
+broadcaster = Broadcaster()
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def publish_committed(session):
+    broadcaster._apply(session)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_rolled_back(session):
+    session.info.pop(PENDING_KEY, None)
@@ -0,0 +1,117 @@
+'''
+Rendered template fragment cache
+
+Fragments are cached under a key made of the entity they show and a version
+number kept in the database, which every change to what they show bumps in the
+same database transaction (see DriverState.history_version), so a change made
+by any process is seen by all of them once it commits.
+Old entries are never deleted, they just stop being used and expire.
+Reads from a lagging replica can still cache stale content under a new key,
+so FRAGMENT_CACHE_TIMEOUT also bounds how long that can be shown.
+
+The cache is in process by default; set FRAGMENT_CACHE to redis to share it
+between processes.
+'''
+import threading
+from time import time
+from collections import OrderedDict
+from flask import current_app
+from jinja2 import Markup
+
+
+class SimpleBackend():
+    '''
+    In process, least recently used cache
+    '''
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self.lock:
+            self.entries[key] = (time() + timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class RedisBackend():
+    def __init__(self, url):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, timeout):
+        self.client.setex(key, timeout, value)
+
+
+class FragmentCache():
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE', 'simple')
+        app.config.setdefault('FRAGMENT_CACHE_TIMEOUT', 60 * 60)
+        backend = app.config['FRAGMENT_CACHE']
+        if backend == 'redis':
+            backend = RedisBackend(app.config['FRAGMENT_CACHE_REDIS_URL'])
+        elif backend == 'simple':
+            backend = SimpleBackend(app.config.get('FRAGMENT_CACHE_MAX_ENTRIES', 1000))
+        else:
+            backend = None
+        app.extensions['fragment_cache'] = backend
+        app.add_template_global(self.cached, 'cached_fragment')
+
+    @property
+    def backend(self):
+        return current_app.extensions.get('fragment_cache')
+
+    def key(self, entity, entity_id, version):
+        '''
+        The cache key for fragments showing the entity as of its version
+        '''
+        if not self.backend:
+            return None
+        return 'fragment:{}:{}:{}'.format(entity, entity_id, version)
+
+    def cached(self, name, key, caller):
+        '''
+        Template global for {% call cached_fragment(name, key) %} blocks
+        '''
+        if not key:
+            return caller()
+        key = '{}:{}'.format(key, name)
+        value = self.backend.get(key)
+        if value is None:
+            value = str(caller())
+            self.backend.set(key, value, current_app.config['FRAGMENT_CACHE_TIMEOUT'])
+        return Markup(value)
+
+
+fragment_cache = FragmentCache()
+
+
+def lazy(function, *args):
+    '''
+    Iterates over the result of function(*args), only calling it if iterated,
+    so a query for a cached fragment is not run
+    '''
+    for item in function(*args):
+        yield item
@@ -0,0 +1,198 @@
+import os
+import sys
+import time
+import click
+from app import db
+from app.controllers.exports import EXPORTS, FORMATS
+from app.controllers.fleet import refresh_fleet_state
+from app.controllers.imports import Lookups, import_transactions, read_transactions
+from app.controllers.ingest import IngestScheduler
+from app.controllers.fleet_rebuild import FleetRebuilder, verify_totals
+from app.controllers.drift import find_drift, drifted_block_drivers, repair_drift
+from app.controllers.outbox import get_publisher, relay
+from app.controllers.archive import archive_cutoff, archive_horizon, archive_transactions
+from app.counters import station_counters, SimpleBackend as SimpleCounters
+from app.leaderboard import leaderboard, SimpleBackend as SimpleLeaderboard
+
+
+def register(app):
+    @app.cli.command()
+    @click.argument('export', type=click.Choice(sorted(EXPORTS)))
+    @click.option('--format', 'export_format', type=click.Choice(sorted(FORMATS)), default='csv')
+    @click.option('--start', type=click.DateTime(['%Y-%m-%d']), help='First day to export')
+    @click.option('--end', type=click.DateTime(['%Y-%m-%d']), help='Day after the last day to export')
+    @click.option('--driver-id', type=int)
+    @click.option('--charging-station-id', type=int, help='Transactions only')
+    @click.option('--output', type=click.File('wb'), default='-', help='Defaults to stdout')
+    def export(export, export_format, start, end, driver_id, charging_station_id, output):
+        """Stream transactions or summaries as csv or parquet."""
+        filters = {'start_date': start, 'end_date': end, 'driver_id': driver_id}
+        if export == 'transactions':
+            filters['charging_station_id'] = charging_station_id
+        elif charging_station_id:
+            raise click.UsageError('Summaries can not be filtered by charging station')
+
+        columns, rows = EXPORTS[export]
+        mimetype, chunks = FORMATS[export_format]
+        for chunk in chunks(columns, rows(**filters)):
+            output.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+
+    @app.cli.command('import-swaps')
+    @click.argument('swap_log', type=click.File('r'))
+    @click.option('--dry-run', is_flag=True, help='Only validate the rows')
+    def import_swaps(swap_log, dry_run):
+        """Import historical battery swaps from a csv file."""
+        try:
+            result = import_transactions(swap_log, dry_run=dry_run)
+        except ValueError as err:
+            raise click.UsageError(str(err))
+        for error in result.errors:
+            click.echo('line {}: {}'.format(error.line, error.message), err=True)
+        if dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+        click.echo('{} swaps {} for {} drivers, {} already imported, {} rows skipped'.format(
+            result.imported, 'valid' if dry_run else 'imported', result.drivers, result.duplicates, len(result.errors)))
+
+    @app.cli.command('ingest-swaps')
+    @click.argument('swap_log', type=click.File('r'))
+    @click.option('--workers', type=int,
+            help='Defaults to the database pool size plus overflow (SQLALCHEMY_POOL_SIZE, SQLALCHEMY_MAX_OVERFLOW), or 4')
+    def ingest_swaps(swap_log, workers):
+        """Apply battery swaps from a csv file one by one, in parallel across drivers."""
+        # each worker holds a connection for as long as it runs
+        connections = _pool_connections(app.config)
+        if workers is None:
+            workers = connections or 4
+        elif connections and workers > connections:
+            raise click.UsageError('--workers {} needs {} database connections, the pool has {}; '
+                    'raise SQLALCHEMY_POOL_SIZE'.format(workers, workers, connections))
+        errors = []
+        try:
+            swaps = list(read_transactions(swap_log, Lookups(), errors))
+        except ValueError as err:
+            raise click.UsageError(str(err))
+        db.session.remove()
+        for error in errors:
+            click.echo('line {}: {}'.format(error.line, error.message), err=True)
+
+        result = IngestScheduler(app, workers).run(swaps)
+        for failure in result.failed:
+            click.echo('{:%Y-%m-%d %H:%M:%S} driver {}: {}'.format(
+                failure.swap['transaction_date'], failure.swap['driver_id'], failure.message), err=True)
+        click.echo('{} swaps applied in {} queues, {} already applied, {} failed, {} rows skipped'.format(
+            result.applied, result.queues, result.duplicates, len(result.failed), len(errors)))
+
+    @app.cli.command('refresh-fleet-state')
+    def refresh_fleet_state_command():
+        """Recompute the fleet state shown on the drivers and charging stations lists."""
+        refresh_fleet_state()
+        db.session.commit()
+
+    @app.cli.command('rebuild-summaries')
+    @click.option('--workers', type=int, default=4, show_default=True)
+    @click.option('--checkpoint', type=click.Path(dir_okay=False), default='rebuild-summaries.checkpoint',
+            show_default=True, help='Drivers already rebuilt are read from and added to this file')
+    @click.option('--verify/--no-verify', default=True, help='Compare the totals with the transactions afterwards')
+    def rebuild_summaries(workers, checkpoint, verify):
+        """Rebuild the summaries of every driver from scratch, in parallel across drivers."""
+        def progress(finished, total):
+            click.echo('{}/{} drivers'.format(finished, total), err=True)
+
+        result = FleetRebuilder(app, workers, checkpoint).run(progress)
+        for failure in result.failed:
+            click.echo('driver {}: {}'.format(failure.driver_id, failure.message), err=True)
+        click.echo('{} drivers rebuilt, {} already rebuilt, {} failed'.format(
+            result.rebuilt, result.skipped, len(result.failed)))
+        if result.failed:
+            sys.exit(1)
+        # every driver is rebuilt, so the next rebuild starts from scratch
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        if verify:
+            mismatches = verify_totals()
+            for mismatch in mismatches:
+                click.echo('driver {}: transactions {}, summaries {}, blocks {}'.format(*mismatch), err=True)
+            click.echo('{} drivers with totals not matching their transactions'.format(len(mismatches)))
+            if mismatches:
+                sys.exit(1)
+
+    @app.cli.command('check-summaries')
+    @click.option('--repair', is_flag=True, help='Rebuild the summaries of drifted days')
+    def check_summaries(repair):
+        """Compare every daily summary with its transactions, and every summary block with its summaries."""
+        ranges = find_drift()
+        for drift in ranges:
+            click.echo('driver {}: {} days drifted from {:%Y-%m-%d} to {:%Y-%m-%d}'.format(
+                drift.driver_id, drift.days, drift.start_date, drift.end_date), err=True)
+        block_driver_ids = drifted_block_drivers()
+        for driver_id in block_driver_ids:
+            click.echo('driver {}: summary blocks drifted'.format(driver_id), err=True)
+        if repair:
+            repair_drift(ranges, block_driver_ids)
+            db.session.commit()
+        click.echo('{} drifted ranges, {} drivers with drifted blocks{}'.format(
+            len(ranges), len(block_driver_ids), ', repaired' if repair else ''))
+        if (ranges or block_driver_ids) and not repair:
+            sys.exit(1)
+
+    @app.cli.command('relay-outbox')
+    @click.option('--follow', is_flag=True, help='Keep relaying new events')
+    @click.option('--interval', type=float, default=1, show_default=True, help='Seconds between polls with --follow')
+    def relay_outbox(follow, interval):
+        """Publish the swap events waiting in the outbox to downstream consumers."""
+        publisher = get_publisher(app)
+        if not publisher:
+            raise click.UsageError('OUTBOX_PUBLISHER is none')
+        while True:
+            published = relay(publisher)
+            click.echo('{} events published'.format(published), err=follow)
+            if not follow:
+                return
+            time.sleep(interval)
+
+    @app.cli.command('rebuild-station-counters')
+    def rebuild_station_counters():
+        """Recompute the live station dashboard counters from the database."""
+        if not station_counters.backend:
+            raise click.UsageError('STATION_COUNTERS is none')
+        if isinstance(station_counters.backend, SimpleCounters):
+            raise click.UsageError('STATION_COUNTERS is simple, counters rebuilt here would not be seen by other processes')
+        station_counters.rebuild(db.session)
+        click.echo('{} stations counted'.format(len(station_counters.counts())))
+
+    @app.cli.command('rebuild-leaderboard')
+    @click.option('--periods', type=int, default=2, show_default=True,
+            help='Weeks and months rebuilt, counting back from the current ones')
+    def rebuild_leaderboard(periods):
+        """Recompute the weekly and monthly driver efficiency rankings from the summaries."""
+        if not leaderboard.backend:
+            raise click.UsageError('LEADERBOARD is none')
+        if isinstance(leaderboard.backend, SimpleLeaderboard):
+            raise click.UsageError('LEADERBOARD is simple, rankings rebuilt here would not be seen by other processes')
+        for (window, start_date), ranked in sorted(leaderboard.rebuild(db.session, periods).items()):
+            click.echo('{} of {:%Y-%m-%d}: {} drivers ranked'.format(window, start_date, ranked))
+
+    @app.cli.command('archive-swaps')
+    @click.option('--years', type=int, help='Archive swaps older than this; defaults to ARCHIVE_AFTER_YEARS')
+    @click.option('--rejected-only', is_flag=True, help='Only archive rejected swaps')
+    def archive_swaps(years, rejected_only):
+        """Move rejected swaps, and swaps older than a number of years, to the archive."""
+        years = years if years is not None else app.config['ARCHIVE_AFTER_YEARS']
+        before = None if rejected_only else archive_cutoff(years)
+        archived = archive_transactions(before)
+        horizon = archive_horizon()
+        click.echo('{} swaps archived{}'.format(archived,
+            ', summaries before {:%Y-%m-%d} are final'.format(horizon) if horizon else ''))
+
+
+def _pool_connections(config):
+    '''
+    Returns the most connections the database pool opens, or None if it is not limited or not configured
+    '''
+    pool_size, max_overflow = config.get('SQLALCHEMY_POOL_SIZE'), config.get('SQLALCHEMY_MAX_OVERFLOW')
+    if pool_size is None or (max_overflow is not None and max_overflow < 0):
+        return None
+    return pool_size + (max_overflow or 0)
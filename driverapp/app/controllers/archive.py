@@ -0,0 +1,120 @@
+'''
+Archive of rejected and aged swaps
+
+Rejected swaps, and swaps older than a number of years, are moved from
+battery_transaction to battery_transaction_archive with their ids, so the
+table, and every index and rejected.is_(False) filter on it, only carries the
+swaps that summaries, validation and the pages work from. References by id
+(correction_id, last_transaction_id, and a summary's last transaction) are not
+foreign keys, and resolve_transaction finds a swap in either table.
+
+A swap which is the last transaction of a swap staying in the table, or of its
+driver's DriverState, is kept, so every swap from the archive horizon on still
+has its last transaction at hand. Swaps are archived up to the start of a month,
+and the horizon is the start of the month after the latest archived swap:
+summaries and blocks before it are final, drift checks and summary rebuilds
+start from it, and swaps dated before it are not accepted.
+
+History pages only read the archive when asked to, with archived=1.
+'''
+from datetime import datetime
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.expression import and_, or_
+from app import db
+from app.models import BatteryTransaction, BatteryTransactionArchive, DriverState, DriverSummaryBlock
+from app.controllers.fleet import bump_history_versions
+
+# swaps moved per database transaction
+ARCHIVE_BATCH_SIZE = 1000
+
+
+def archive_cutoff(years, now=None):
+    '''
+    The start of the month years before now
+    '''
+    now = now or datetime.utcnow()
+    return DriverSummaryBlock.get_start_date(now).replace(year=now.year - years)
+
+
+def archive_horizon():
+    '''
+    The start of the month after the latest archived swap which was not rejected,
+    or None if none has been archived
+    '''
+    latest = db.session.query(func.max(BatteryTransactionArchive.transaction_date))\
+            .filter(BatteryTransactionArchive.rejected.is_(False)).scalar()
+    if latest is None:
+        return None
+    return DriverSummaryBlock.get_end_date(DriverSummaryBlock.get_start_date(latest))
+
+
+def archive_transactions(before=None, batch_size=ARCHIVE_BATCH_SIZE):
+    '''
+    Moves the rejected swaps, and the swaps dated before before (the start
+    of a month) if it is given, to the archive, committing each batch
+
+    Returns the number of swaps archived
+    '''
+    if before and before != DriverSummaryBlock.get_start_date(before):
+        raise ValueError('Swaps are archived up to the start of a month')
+    archived = 0
+    while True:
+        # a swap being corrected waits for its batch, or is skipped once it is rejected
+        rows = _archivable(before).with_for_update().limit(batch_size).all()
+        if rows:
+            ids = [transaction_id for transaction_id, driver_id in rows]
+            columns = BatteryTransactionArchive.COPIED_COLUMNS
+            db.session.execute(BatteryTransactionArchive.__table__.insert().from_select(columns,
+                select([BatteryTransaction.__table__.c[column] for column in columns])\
+                        .where(BatteryTransaction.id.in_(ids))))
+            BatteryTransaction.query.filter(BatteryTransaction.id.in_(ids)).delete(synchronize_session=False)
+            bump_history_versions(driver_id for transaction_id, driver_id in rows)
+        db.session.commit()
+        archived += len(rows)
+        if len(rows) < batch_size:
+            return archived
+
+
+def _archivable(before):
+    '''
+    Query of the id and driver id of the swaps to archive, oldest first
+    '''
+    staying = aliased(BatteryTransaction)
+    if before:
+        archivable = or_(BatteryTransaction.rejected.is_(True), BatteryTransaction.transaction_date < before)
+        stays = and_(staying.rejected.is_(False), staying.transaction_date >= before)
+    else:
+        archivable = BatteryTransaction.rejected.is_(True)
+        stays = staying.rejected.is_(False)
+    return db.session.query(BatteryTransaction.id, BatteryTransaction.driver_id)\
+            .filter(archivable,
+                ~db.session.query(staying.id).filter(stays, staying.last_transaction_id == BatteryTransaction.id).exists(),
+                ~db.session.query(DriverState.id).filter(DriverState.last_transaction_id == BatteryTransaction.id).exists())\
+            .order_by(BatteryTransaction.id)
+
+
+def resolve_transaction(transaction_id):
+    '''
+    The swap with the id, from battery_transaction or the archive
+    '''
+    return BatteryTransaction.query.get(transaction_id) or BatteryTransactionArchive.query.get(transaction_id)
+
+
+def archived_transactions(*criteria):
+    '''
+    The archived swaps which were not rejected and meet criteria, in date order,
+    with their last transactions found
+    '''
+    transactions = BatteryTransactionArchive.query\
+            .filter(BatteryTransactionArchive.rejected.is_(False), *criteria)\
+            .order_by(BatteryTransactionArchive.transaction_date.asc(), BatteryTransactionArchive.id.asc()).all()
+    BatteryTransactionArchive.load_last_transactions(transactions)
+    return transactions
+
+
+def with_archived(query, *criteria):
+    '''
+    The transactions of a query, and the archived transactions meeting criteria, in date order
+    '''
+    return sorted(archived_transactions(*criteria) + query.all(), key=lambda t: (t.transaction_date, t.id))
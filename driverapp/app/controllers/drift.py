@@ -0,0 +1,146 @@
+'''
+Detecting and repairing drift between the daily summaries and the transaction log
+
+Summaries are a cache of the transactions, so a bug in applying transactions,
+or a change made directly in the database, leaves them silently wrong. The
+check totals the transactions of every driver and day with one grouped query,
+the stored summaries with another, and walks both in (driver, day) order
+side by side, so it reads each table once and holds one row of each at a time.
+
+Drifted days close together are repaired with a single rebuild of that range.
+The monthly summary blocks are checked against the summaries by comparing each
+driver's totals, and recomputed from the summaries where they differ.
+'''
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+from app import db
+from app.models import Driver, BatteryTransaction, DriverSummary, DriverSummaryBlock
+from app.controllers.records import ride_distance_and_energy_used
+from app.controllers.summaries import SUMMARY_INTERVAL, rebuild, recompute_blocks
+from app.controllers.archive import archive_horizon
+
+# rows fetched from the database at a time
+DRIFT_BATCH_SIZE = 5000
+# drifted days of a driver less than this far apart are repaired by one rebuild
+DRIFT_RANGE_GAP = timedelta(days=7)
+
+# (ride_distance, energy_used) from the transactions, and from the stored summaries
+DriftedDay = namedtuple('DriftedDay', ['driver_id', 'day', 'transactions', 'summaries'])
+# drifted days of a driver from start_date up to (not including) end_date
+DriftRange = namedtuple('DriftRange', ['driver_id', 'start_date', 'end_date', 'days'])
+
+
+def drifted_days():
+    '''
+    Yields a DriftedDay for each driver and day whose summary totals
+    differ from the totals of its transactions, in driver and day order
+
+    Days before the archive horizon are final, and not checked
+    '''
+    horizon = archive_horizon()
+    transactions = _transaction_day_totals(horizon)
+    summaries = _summary_day_totals(horizon)
+    transaction = next(transactions, None)
+    summary = next(summaries, None)
+    while transaction or summary:
+        if summary is None or (transaction and transaction[0] < summary[0]):
+            key, expected, stored = transaction[0], transaction[1], (0, 0)
+            transaction = next(transactions, None)
+        elif transaction is None or summary[0] < transaction[0]:
+            key, expected, stored = summary[0], (0, 0), summary[1]
+            summary = next(summaries, None)
+        else:
+            key, expected, stored = transaction[0], transaction[1], summary[1]
+            transaction = next(transactions, None)
+            summary = next(summaries, None)
+        if expected != stored:
+            yield DriftedDay(key[0], key[1], expected, stored)
+
+
+def find_drift(gap=DRIFT_RANGE_GAP):
+    '''
+    Returns the ranges of drifted days of each driver,
+    joining days less than gap apart
+    '''
+    ranges = []
+    for day in drifted_days():
+        last = ranges[-1] if ranges else None
+        if last and last.driver_id == day.driver_id and day.day < last.end_date + gap:
+            ranges[-1] = last._replace(end_date=day.day + SUMMARY_INTERVAL, days=last.days + 1)
+        else:
+            ranges.append(DriftRange(day.driver_id, day.day, day.day + SUMMARY_INTERVAL, 1))
+    return ranges
+
+
+def drifted_block_drivers():
+    '''
+    Returns the ids of the drivers whose block totals differ from their summary totals
+    '''
+    summaries = db.session.query(DriverSummary.driver_id,
+            func.sum(DriverSummary.ride_distance), func.sum(DriverSummary.energy_used))\
+                    .group_by(DriverSummary.driver_id)
+    blocks = db.session.query(DriverSummaryBlock.driver_id,
+            func.sum(DriverSummaryBlock.ride_distance), func.sum(DriverSummaryBlock.energy_used))\
+                    .group_by(DriverSummaryBlock.driver_id)
+    summaries = dict((driver_id, (ride_distance or 0, energy_used or 0)) for driver_id, ride_distance, energy_used in summaries)
+    blocks = dict((driver_id, (ride_distance or 0, energy_used or 0)) for driver_id, ride_distance, energy_used in blocks)
+    return sorted(driver_id for driver_id in set(summaries) | set(blocks)
+            if summaries.get(driver_id, (0, 0)) != blocks.get(driver_id, (0, 0)))
+
+
+def repair_drift(ranges, block_driver_ids=()):
+    '''
+    Rebuilds the summaries of each drifted range, and recomputes their blocks,
+    then recomputes every block of the drivers whose blocks drifted
+    '''
+    for drift in ranges:
+        driver = Driver.query.get(drift.driver_id)
+        for summary in rebuild(driver, drift.start_date, drift.end_date):
+            db.session.add(summary)
+        # rebuild moves the blocks by the change in the summaries, which were wrong
+        for block in recompute_blocks(driver, drift.start_date, drift.end_date):
+            db.session.add(block)
+        db.session.flush()
+    for driver_id in block_driver_ids:
+        for block in recompute_blocks(Driver.query.get(driver_id)):
+            db.session.add(block)
+        db.session.flush()
+
+
+def _transaction_day_totals(horizon=None):
+    last_transaction = aliased(BatteryTransaction)
+    ride_distance, energy_used = ride_distance_and_energy_used(last_transaction)
+    day = func.date(BatteryTransaction.transaction_date)
+    query = db.session.query(BatteryTransaction.driver_id, day, func.sum(ride_distance), func.sum(energy_used))\
+            .outerjoin(last_transaction, BatteryTransaction.last_transaction_id == last_transaction.id)\
+            .filter(BatteryTransaction.rejected.is_(False))
+    if horizon:
+        query = query.filter(BatteryTransaction.transaction_date >= horizon)
+    query = query.group_by(BatteryTransaction.driver_id, day)\
+            .order_by(BatteryTransaction.driver_id, day)
+    for driver_id, transaction_day, ride_distance, energy_used in _stream(query):
+        yield (driver_id, _as_datetime(transaction_day)), (ride_distance or 0, energy_used or 0)
+
+
+def _summary_day_totals(horizon=None):
+    query = db.session.query(DriverSummary.driver_id, DriverSummary.start_date,
+            func.sum(DriverSummary.ride_distance), func.sum(DriverSummary.energy_used))
+    if horizon:
+        query = query.filter(DriverSummary.start_date >= horizon)
+    query = query.group_by(DriverSummary.driver_id, DriverSummary.start_date)\
+                    .order_by(DriverSummary.driver_id, DriverSummary.start_date)
+    for driver_id, start_date, ride_distance, energy_used in _stream(query):
+        yield (driver_id, start_date), (ride_distance or 0, energy_used or 0)
+
+
+def _stream(query):
+    return query.execution_options(stream_results=True).yield_per(DRIFT_BATCH_SIZE)
+
+
+def _as_datetime(day):
+    # date() is a date on postgres, and a string on sqlite
+    if isinstance(day, str):
+        return datetime.strptime(day, '%Y-%m-%d')
+    return datetime.combine(day, datetime.min.time())
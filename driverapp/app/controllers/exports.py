@@ -0,0 +1,232 @@
+'''
+Streaming exports of transactions and summaries
+
+Rows are read in batches over a server side cursor, and written out
+a chunk at a time, so memory use does not depend on the size of the export
+'''
+import csv
+import io
+from importlib.util import find_spec
+from sqlalchemy.orm import aliased
+from app import db
+from app.models import BatteryTransaction, DriverSummary
+from app.controllers.summaries import SUMMARY_INTERVAL, get_start_date, _cumulative_totals
+from app.controllers.archive import archive_horizon
+
+# pyarrow (and numpy) take longer to import than the rest of the app, so are only imported to write parquet
+HAS_PYARROW = find_spec('pyarrow') is not None
+
+# rows fetched from the database, and written out, at a time
+EXPORT_BATCH_SIZE = 1000
+
+TRANSACTION_COLUMNS = (
+    'id',
+    'transaction_date',
+    'driver_id',
+    'charging_station_id',
+    'battery_in_id',
+    'battery_out_id',
+    'battery_in_energy',
+    'battery_out_energy',
+    'odometer_reading',
+    'ride_distance',
+    'energy_used',
+    'correction_id',
+)
+
+SUMMARY_COLUMNS = (
+    'driver_id',
+    'start_date',
+    'end_date',
+    'ride_distance',
+    'energy_used',
+    'cumulative_ride_distance',
+    'cumulative_energy_used',
+)
+
+
+def _stream(query):
+    return query.execution_options(stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+
+
+def transaction_rows(start_date=None, end_date=None, driver_id=None, charging_station_id=None):
+    '''
+    Yields a tuple of TRANSACTION_COLUMNS for each transaction which is not rejected,
+    in date order, optionally filtered by date range, driver and charging station
+
+    Transactions before the archive horizon are in the archive, and not exported
+    '''
+    horizon = archive_horizon()
+    if horizon and (not start_date or start_date < horizon):
+        start_date = horizon
+    last_transaction = aliased(BatteryTransaction)
+    query = db.session.query(
+            BatteryTransaction.id,
+            BatteryTransaction.transaction_date,
+            BatteryTransaction.driver_id,
+            BatteryTransaction.charging_station_id,
+            BatteryTransaction.battery_in_id,
+            BatteryTransaction.battery_out_id,
+            BatteryTransaction.battery_in_energy,
+            BatteryTransaction.battery_out_energy,
+            BatteryTransaction.odometer_reading,
+            BatteryTransaction.correction_id,
+            BatteryTransaction.last_transaction_id,
+            last_transaction.odometer_reading,
+            last_transaction.battery_out_energy)\
+                    .outerjoin(last_transaction, BatteryTransaction.last_transaction_id == last_transaction.id)\
+                    .filter(BatteryTransaction.rejected.is_(False))
+    if start_date:
+        query = query.filter(BatteryTransaction.transaction_date >= start_date)
+    if end_date:
+        query = query.filter(BatteryTransaction.transaction_date < end_date)
+    if driver_id:
+        query = query.filter(BatteryTransaction.driver_id == driver_id)
+    if charging_station_id:
+        query = query.filter(BatteryTransaction.charging_station_id == charging_station_id)
+    query = query.order_by(BatteryTransaction.transaction_date.asc(), BatteryTransaction.id.asc())
+
+    for row in _stream(query):
+        (transaction_id, transaction_date, driver_id, charging_station_id,
+                battery_in_id, battery_out_id, battery_in_energy, battery_out_energy,
+                odometer_reading, correction_id, last_transaction_id,
+                last_odometer_reading, last_battery_out_energy) = row
+
+        # the same as BatteryTransaction.ride_distance and energy_used, without loading the last transaction
+        ride_distance = odometer_reading - last_odometer_reading if last_transaction_id else 0
+        if last_transaction_id and last_battery_out_energy:
+            energy_used = last_battery_out_energy - battery_in_energy
+        else:
+            energy_used = 0
+
+        yield (transaction_id, transaction_date, driver_id, charging_station_id,
+                battery_in_id, battery_out_id, battery_in_energy, battery_out_energy,
+                odometer_reading, ride_distance, energy_used, correction_id)
+
+
+def summary_rows(start_date=None, end_date=None, driver_id=None):
+    '''
+    Yields a tuple of SUMMARY_COLUMNS for each summary, ordered by driver and date,
+    optionally filtered by date range and driver
+    '''
+    query = db.session.query(
+            DriverSummary.driver_id,
+            DriverSummary.start_date,
+            DriverSummary.end_date,
+            DriverSummary.ride_distance,
+            DriverSummary.energy_used)
+    if start_date:
+        start_date = get_start_date(start_date)
+        query = query.filter(DriverSummary.start_date >= start_date)
+    if end_date:
+        query = query.filter(DriverSummary.start_date < end_date)
+    if driver_id:
+        query = query.filter(DriverSummary.driver_id == driver_id)
+    query = query.order_by(DriverSummary.driver_id.asc(), DriverSummary.start_date.asc())
+
+    current_driver_id = None
+    for driver_id, summary_start, summary_end, ride_distance, energy_used in _stream(query):
+        if driver_id != current_driver_id:
+            current_driver_id = driver_id
+            if start_date:
+                cumulative_ride_distance, cumulative_energy_used = \
+                        _cumulative_totals(driver_id, start_date - SUMMARY_INTERVAL)
+            else:
+                cumulative_ride_distance, cumulative_energy_used = 0, 0
+        cumulative_ride_distance += ride_distance
+        cumulative_energy_used += energy_used
+        yield (driver_id, summary_start, summary_end, ride_distance, energy_used,
+                cumulative_ride_distance, cumulative_energy_used)
+
+
+def csv_chunks(columns, rows):
+    '''
+    Yields a CSV file with a header row, a chunk of rows at a time
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _ChunkSink():
+    '''
+    A write only file that hands back whatever was written to it since it was last drained
+    '''
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_chunks(columns, rows):
+    '''
+    Yields a parquet file, one row group of rows at a time
+
+    Requires pyarrow; columns ending in _date are timestamps, all others integers
+    '''
+    if not HAS_PYARROW:
+        raise RuntimeError('Parquet export requires pyarrow')
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pyarrow.schema([
+        (column, pyarrow.timestamp('us') if column.endswith('_date') else pyarrow.int64())
+        for column in columns])
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == EXPORT_BATCH_SIZE:
+            _write_row_group(writer, schema, batch)
+            batch = []
+            yield sink.drain()
+    if batch:
+        _write_row_group(writer, schema, batch)
+    writer.close()
+    yield sink.drain()
+
+
+def _write_row_group(writer, schema, rows):
+    import pyarrow
+    arrays = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+    writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+
+EXPORTS = {
+    'transactions': (TRANSACTION_COLUMNS, transaction_rows),
+    'summaries': (SUMMARY_COLUMNS, summary_rows),
+}
+
+FORMATS = {
+    'csv': ('text/csv', csv_chunks),
+    'parquet': ('application/octet-stream', parquet_chunks),
+}
@@ -0,0 +1,194 @@
+'''
+Current fleet state read models, for the drivers and charging stations list pages
+
+The energy of a battery, and the last swap of a driver, depend on the transaction
+history, so they are kept in DriverState and ChargingStationState rows which are
+refreshed whenever a transaction changes them. The list pages then run one query,
+joining these rows to the drivers and charging stations.
+'''
+from sqlalchemy import and_, func, select, union_all
+from app import db
+from app.models import Person, Driver, Vehicle, ChargingStation, Battery, BatteryTransaction, \
+        DriverState, ChargingStationState
+
+
+def refresh_fleet_state(driver_ids=None, charging_station_ids=None):
+    '''
+    Recomputes the state of the given drivers and charging stations,
+    or of every driver and charging station if they are None
+    '''
+    if driver_ids is None:
+        driver_ids = [driver_id for driver_id, in db.session.query(Driver.id)]
+    if charging_station_ids is None:
+        charging_station_ids = [station_id for station_id, in db.session.query(ChargingStation.id)]
+    for state in _driver_states(set(driver_ids)) + _charging_station_states(set(charging_station_ids)):
+        db.session.add(state)
+    db.session.flush()
+
+
+def _driver_states(driver_ids):
+    if not driver_ids:
+        return []
+    states = dict((state.driver_id, state) for state in
+            DriverState.query.filter(DriverState.driver_id.in_(driver_ids)))
+
+    last_swaps = _latest(BatteryTransaction.driver_id, driver_ids)
+    last_swaps_out = _latest(BatteryTransaction.driver_id, driver_ids, BatteryTransaction.battery_out_id.isnot(None))
+    last_transactions = dict((driver_id, (transaction_id, transaction_date)) for driver_id, transaction_id, transaction_date in
+            db.session.query(BatteryTransaction.driver_id, BatteryTransaction.id, BatteryTransaction.transaction_date)\
+                    .join(last_swaps, and_(
+                        BatteryTransaction.driver_id == last_swaps.c.key,
+                        BatteryTransaction.transaction_date == last_swaps.c.transaction_date))\
+                    .filter(BatteryTransaction.rejected.is_(False)))
+    battery_energies = dict(db.session.query(BatteryTransaction.driver_id, BatteryTransaction.battery_out_energy)\
+            .join(last_swaps_out, and_(
+                BatteryTransaction.driver_id == last_swaps_out.c.key,
+                BatteryTransaction.transaction_date == last_swaps_out.c.transaction_date))\
+            .filter(BatteryTransaction.rejected.is_(False), BatteryTransaction.battery_out_id.isnot(None)))
+
+    changed = []
+    for driver_id in driver_ids:
+        state = states.get(driver_id) or DriverState(driver_id=driver_id)
+        last_transaction_id, last_transaction_date = last_transactions.get(driver_id, (None, None))
+        values = (battery_energies.get(driver_id) or 0, last_transaction_id, last_transaction_date)
+        if state.id and (state.battery_energy, state.last_transaction_id, state.last_transaction_date) == values:
+            continue
+        state.battery_energy, state.last_transaction_id, state.last_transaction_date = values
+        changed.append(state)
+    return changed
+
+
+def bump_history_versions(driver_ids):
+    '''
+    Bumps the history version of the drivers whose transactions or summaries changed,
+    adding the state of drivers which have none yet
+    '''
+    driver_ids = set(driver_ids)
+    if not driver_ids:
+        return
+    bumped = DriverState.query.filter(DriverState.driver_id.in_(driver_ids))\
+            .update({DriverState.history_version: DriverState.history_version + 1}, synchronize_session=False)
+    if bumped < len(driver_ids):
+        existing = set(driver_id for driver_id, in
+                db.session.query(DriverState.driver_id).filter(DriverState.driver_id.in_(driver_ids)))
+        for driver_id in driver_ids - existing:
+            db.session.add(DriverState(driver_id=driver_id, history_version=1))
+        db.session.flush()
+
+
+def lock_charging_stations(charging_station_ids):
+    '''
+    Locks the rows of the charging stations, in id order, until the end of the database transaction
+
+    A station's stock is recounted from its batteries, so two swaps moving different
+    batteries at the same station recount one after the other, each seeing the other's
+    move, and only one of them creates the station's state
+    '''
+    charging_station_ids = sorted(set(station_id for station_id in charging_station_ids if station_id))
+    if charging_station_ids:
+        ChargingStation.query.filter(ChargingStation.id.in_(charging_station_ids))\
+                .order_by(ChargingStation.id).with_for_update().all()
+
+
+def _charging_station_states(charging_station_ids):
+    if not charging_station_ids:
+        return []
+    lock_charging_stations(charging_station_ids)
+    states = dict((state.charging_station_id, state) for state in
+            ChargingStationState.query.filter(ChargingStationState.charging_station_id.in_(charging_station_ids))\
+                    .populate_existing())
+
+    batteries = db.session.query(Battery.id, Battery.charging_station_id)\
+            .filter(Battery.charging_station_id.in_(charging_station_ids)).all()
+    energies = battery_energies([battery_id for battery_id, station_id in batteries])
+    counts = {}
+    for battery_id, station_id in batteries:
+        count, energy = counts.get(station_id, (0, 0))
+        counts[station_id] = (count + 1, energy + energies.get(battery_id, 0))
+
+    changed = []
+    for station_id in charging_station_ids:
+        state = states.get(station_id) or ChargingStationState(charging_station_id=station_id)
+        values = counts.get(station_id, (0, 0))
+        if state.id and (state.battery_count, state.energy_on_hand) == values:
+            continue
+        state.battery_count, state.energy_on_hand = values
+        changed.append(state)
+    return changed
+
+
+def battery_energies(battery_ids):
+    '''
+    Returns the energy of each battery, as of its last swap in or out
+    '''
+    if not battery_ids:
+        return {}
+    swaps = union_all(
+        select([
+            BatteryTransaction.battery_in_id.label('battery_id'),
+            BatteryTransaction.transaction_date,
+            BatteryTransaction.battery_in_energy.label('energy'),
+            # a battery swapped in and out by the same transaction ends up out
+            db.literal(0).label('swapped_out')])\
+                    .where(and_(BatteryTransaction.rejected.is_(False), BatteryTransaction.battery_in_id.in_(battery_ids))),
+        select([
+            BatteryTransaction.battery_out_id,
+            BatteryTransaction.transaction_date,
+            BatteryTransaction.battery_out_energy,
+            db.literal(1)])\
+                    .where(and_(BatteryTransaction.rejected.is_(False), BatteryTransaction.battery_out_id.in_(battery_ids))),
+    ).alias('swaps')
+    latest = select([swaps.c.battery_id, func.max(swaps.c.transaction_date).label('transaction_date')])\
+            .group_by(swaps.c.battery_id).alias('latest')
+
+    energies = {}
+    for battery_id, energy, swapped_out in db.session.query(swaps.c.battery_id, swaps.c.energy, swaps.c.swapped_out)\
+            .join(latest, and_(
+                swaps.c.battery_id == latest.c.battery_id,
+                swaps.c.transaction_date == latest.c.transaction_date))\
+            .order_by(swaps.c.swapped_out):
+        energies[battery_id] = energy
+    return energies
+
+
+def _latest(key, ids, *criteria):
+    '''
+    Subquery of the latest transaction_date for each value of key
+    '''
+    return db.session.query(key.label('key'), func.max(BatteryTransaction.transaction_date).label('transaction_date'))\
+            .filter(BatteryTransaction.rejected.is_(False), key.in_(ids), *criteria)\
+            .group_by(key).subquery()
+
+
+def driver_list():
+    '''
+    Returns a row for each driver with its name, vehicle, battery, battery energy and last swap
+    '''
+    return db.session.query(
+            Driver.id,
+            Person.name1,
+            Person.name2,
+            Person.name3,
+            Vehicle.vin,
+            Battery.serial.label('battery_serial'),
+            DriverState.battery_energy,
+            DriverState.last_transaction_date)\
+                    .join(Person, Driver.person_id == Person.id)\
+                    .outerjoin(Vehicle, Driver.current_vehicle_id == Vehicle.id)\
+                    .outerjoin(Battery, Vehicle.battery_id == Battery.id)\
+                    .outerjoin(DriverState, DriverState.driver_id == Driver.id)\
+                    .order_by(Driver.id).all()
+
+
+def charging_station_list():
+    '''
+    Returns a row for each charging station with its name, battery count and energy on hand
+    '''
+    return db.session.query(
+            ChargingStation.id,
+            ChargingStation.name,
+            ChargingStation.location,
+            ChargingStationState.battery_count,
+            ChargingStationState.energy_on_hand)\
+                    .outerjoin(ChargingStationState, ChargingStationState.charging_station_id == ChargingStation.id)\
+                    .order_by(ChargingStation.id).all()
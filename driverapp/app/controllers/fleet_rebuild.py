@@ -0,0 +1,181 @@
+'''
+Rebuilding the summaries of every driver from scratch, e.g. after the summary formulas change
+
+Drivers are sharded across a pool of forked worker processes. Each worker opens
+its own connections, and deletes and rolls over each driver's summaries in a
+database transaction of its own. Finished drivers are appended to a checkpoint
+file, so an interrupted rebuild resumes with the drivers it had not finished.
+'''
+import multiprocessing
+import os
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+from app import db
+from app.engine import dispose_engines
+from app.models import Driver, BatteryTransaction, DriverSummary, DriverSummaryBlock
+from app.controllers.summaries import rollover
+from app.controllers.fleet import bump_history_versions
+from app.controllers.records import ride_distance_and_energy_used
+from app.controllers.archive import archive_horizon
+
+# drivers handed to a worker at a time
+REBUILD_SHARD_SIZE = 50
+
+RebuildResult = namedtuple('RebuildResult', ['rebuilt', 'skipped', 'failed'])
+# a driver whose summaries could not be rebuilt, and why
+RebuildFailure = namedtuple('RebuildFailure', ['driver_id', 'message'])
+# a driver whose summary or block totals differ from its transactions, as (ride_distance, energy_used)
+TotalsMismatch = namedtuple('TotalsMismatch', ['driver_id', 'transactions', 'summaries', 'blocks'])
+
+
+def rebuild_driver(driver_id, date=None):
+    '''
+    Deletes the driver's summaries and blocks, and rolls them over again up to date
+
+    Summaries and blocks before the archive horizon are final, and kept
+    '''
+    driver = Driver.query.get(driver_id)
+    summaries = DriverSummary.query.filter(DriverSummary.driver_id == driver_id)
+    blocks = DriverSummaryBlock.query.filter(DriverSummaryBlock.driver_id == driver_id)
+    horizon = archive_horizon()
+    if horizon:
+        summaries = summaries.filter(DriverSummary.start_date >= horizon)
+        blocks = blocks.filter(DriverSummaryBlock.start_date >= horizon)
+    summaries.delete(synchronize_session=False)
+    blocks.delete(synchronize_session=False)
+    for summary in rollover(driver, date or datetime.utcnow()):
+        db.session.add(summary)
+    bump_history_versions([driver_id])
+    db.session.flush()
+
+
+class FleetRebuilder():
+    '''
+    Rebuilds the summaries of every driver with a pool of worker processes
+
+    Worker processes are forked from this one, so they share the app
+    but not its database connections
+    '''
+    def __init__(self, app, workers=4, checkpoint=None, shard_size=REBUILD_SHARD_SIZE):
+        self.app = app
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.shard_size = shard_size
+
+    def run(self, progress=None):
+        '''
+        Rebuilds every driver not in the checkpoint,
+        calling progress(finished, total) as each shard finishes
+        '''
+        finished = read_checkpoint(self.checkpoint)
+        with self.app.app_context():
+            driver_ids = [driver_id for driver_id, in db.session.query(Driver.id).order_by(Driver.id)
+                    if driver_id not in finished]
+            db.session.remove()
+        shards = [driver_ids[i:i + self.shard_size] for i in range(0, len(driver_ids), self.shard_size)]
+        total = len(finished) + len(driver_ids)
+
+        dispose_engines(self.app, db)
+        rebuilt = 0
+        failed = []
+        context = multiprocessing.get_context('fork')
+        with context.Pool(self.workers, initializer=_init_worker, initargs=(self.app,)) as pool:
+            for shard_rebuilt, shard_failed in pool.imap_unordered(_rebuild_shard, shards):
+                write_checkpoint(self.checkpoint, shard_rebuilt)
+                rebuilt += len(shard_rebuilt)
+                failed.extend(shard_failed)
+                if progress:
+                    progress(len(finished) + rebuilt + len(failed), total)
+        return RebuildResult(rebuilt, len(finished), failed)
+
+
+_worker_app = None
+
+
+def _init_worker(app):
+    global _worker_app
+    _worker_app = app
+
+
+def _rebuild_shard(driver_ids):
+    '''
+    Rebuilds each driver in its own database transaction
+
+    Returns the ids of the drivers rebuilt, and the failures
+    '''
+    rebuilt = []
+    failed = []
+    with _worker_app.app_context():
+        try:
+            for driver_id in driver_ids:
+                try:
+                    rebuild_driver(driver_id)
+                    db.session.commit()
+                    rebuilt.append(driver_id)
+                except Exception as err:
+                    db.session.rollback()
+                    failed.append(RebuildFailure(driver_id, str(err)))
+                # summaries are not needed after the commit
+                db.session.expunge_all()
+        finally:
+            db.session.remove()
+    return rebuilt, failed
+
+
+def read_checkpoint(path):
+    '''
+    Returns the ids of the drivers already rebuilt
+    '''
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path) as checkpoint:
+        return set(int(line) for line in checkpoint if line.strip())
+
+
+def write_checkpoint(path, driver_ids):
+    if not path or not driver_ids:
+        return
+    with open(path, 'a') as checkpoint:
+        checkpoint.write(''.join('{}\n'.format(driver_id) for driver_id in driver_ids))
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+
+
+def verify_totals():
+    '''
+    Compares each driver's total ride distance and energy used in its summaries,
+    and in its summary blocks, with the totals of its transactions
+
+    Returns a TotalsMismatch for each driver whose totals differ; only
+    totals from the archive horizon on are compared
+    '''
+    horizon = archive_horizon() or datetime.min
+    last_transaction = aliased(BatteryTransaction)
+    ride_distance, energy_used = ride_distance_and_energy_used(last_transaction)
+    transactions = _totals(db.session.query(
+            BatteryTransaction.driver_id, func.sum(ride_distance), func.sum(energy_used))\
+                    .outerjoin(last_transaction, BatteryTransaction.last_transaction_id == last_transaction.id)\
+                    .filter(BatteryTransaction.rejected.is_(False), BatteryTransaction.transaction_date >= horizon)\
+                    .group_by(BatteryTransaction.driver_id))
+    summaries = _totals(db.session.query(
+            DriverSummary.driver_id, func.sum(DriverSummary.ride_distance), func.sum(DriverSummary.energy_used))\
+                    .filter(DriverSummary.start_date >= horizon)\
+                    .group_by(DriverSummary.driver_id))
+    blocks = _totals(db.session.query(
+            DriverSummaryBlock.driver_id, func.sum(DriverSummaryBlock.ride_distance), func.sum(DriverSummaryBlock.energy_used))\
+                    .filter(DriverSummaryBlock.start_date >= horizon)\
+                    .group_by(DriverSummaryBlock.driver_id))
+
+    mismatches = []
+    for driver_id in sorted(set(transactions) | set(summaries) | set(blocks)):
+        totals = [totals.get(driver_id, (0, 0)) for totals in (transactions, summaries, blocks)]
+        if totals[0] != totals[1] or totals[0] != totals[2]:
+            mismatches.append(TotalsMismatch(driver_id, *totals))
+    return mismatches
+
+
+def _totals(query):
+    return dict((driver_id, (ride_distance or 0, energy_used or 0))
+            for driver_id, ride_distance, energy_used in query)
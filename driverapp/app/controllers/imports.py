@@ -0,0 +1,383 @@
+'''
+Bulk import of historical battery swaps from CSV
+
+Rows are validated a chunk at a time, with drivers, batteries and charging
+stations resolved by their natural keys through lookup dicts built once up front,
+and written with bulk inserts. Derived state is then brought up to date once
+per affected driver and battery, instead of once per row:
+
+- each driver's chain of last_transaction links is recomputed
+- battery locations and vehicle batteries are replayed from the new history
+- summaries are rebuilt from the driver's earliest imported swap
+
+Each inserted swap also gets a swap added event in the outbox.
+
+Odometer readings must not go backwards within a driver's history, as for swaps
+added one by one. Battery locations are not checked against the current state:
+imported swaps are historical, like backdated swaps, and the locations are
+replayed from the merged history instead.
+'''
+import csv
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy.sql.expression import or_, select
+from app import db
+from app.models import Person, Driver, Vehicle, ChargingStation, Battery, BatteryTransaction
+from app.controllers.summaries import rebuild
+from app.controllers.fleet import refresh_fleet_state, bump_history_versions
+from app.controllers.records import link_transactions
+from app.controllers.archive import archive_horizon
+from app.controllers.outbox import SWAP_COLUMNS, record_imported_swaps
+from app.controllers.validation import odometer_bounds
+
+# rows validated and inserted at a time
+IMPORT_BATCH_SIZE = 1000
+
+IMPORT_COLUMNS = (
+    'transaction_date',
+    'driver_phone_number',
+    'vin',
+    'charging_station',
+    'battery_in',
+    'battery_out',
+    'battery_in_energy',
+    'battery_out_energy',
+    'odometer_reading',
+)
+
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S')
+
+RowError = namedtuple('RowError', ['line', 'message'])
+ImportResult = namedtuple('ImportResult', ['imported', 'errors', 'drivers', 'duplicates'])
+
+
+class RowInvalid(ValueError):
+    pass
+
+
+class Lookups():
+    '''
+    Natural key lookups for every driver, battery and charging station
+    '''
+    def __init__(self):
+        self.drivers_by_phone = dict(db.session.query(Person.primary_phone_number, Driver.id)\
+                .join(Driver, Driver.person_id == Person.id))
+        self.drivers_by_vin = dict(db.session.query(Vehicle.vin, Driver.id)\
+                .join(Driver, Driver.current_vehicle_id == Vehicle.id))
+        self.vehicles = dict(db.session.query(Driver.id, Driver.current_vehicle_id))
+        self.batteries = dict((serial, (battery_id, capacity)) for serial, battery_id, capacity in
+                db.session.query(Battery.serial, Battery.id, Battery.capacity))
+        self.charging_stations = dict(db.session.query(ChargingStation.name, ChargingStation.id))
+        self.archive_horizon = archive_horizon()
+        # the idempotency keys of the rows read so far
+        self.idempotency_keys = set()
+
+
+def import_transactions(lines, dry_run=False):
+    '''
+    Imports battery swaps from CSV lines with a header row of IMPORT_COLUMNS
+
+    The driver is found by phone number or vehicle VIN, batteries by serial
+    and charging stations by name. Invalid rows are skipped and reported.
+    Rows with an optional idempotency_key which was already added are skipped.
+
+    Returns an ImportResult; nothing is committed
+    '''
+    lookups = Lookups()
+    errors = []
+    imported = 0
+    duplicates = 0
+    # the earliest imported transaction date for each driver
+    drivers = {}
+    batteries = set()
+
+    def add_batch(batch):
+        batch = _check_odometers(batch, errors)
+        for mapping in batch:
+            driver_id = mapping['driver_id']
+            drivers[driver_id] = min(drivers.get(driver_id, mapping['transaction_date']), mapping['transaction_date'])
+            batteries.update(b for b in (mapping['battery_in_id'], mapping['battery_out_id']) if b)
+        return _insert(batch, dry_run)
+
+    batch = []
+    for line, mapping in _read_rows(lines, lookups, errors):
+        batch.append((line, mapping))
+        if len(batch) == IMPORT_BATCH_SIZE:
+            inserted, skipped = add_batch(batch)
+            imported += inserted
+            duplicates += skipped
+            batch = []
+    inserted, skipped = add_batch(batch)
+    imported += inserted
+    duplicates += skipped
+    errors.sort(key=lambda error: error.line)
+
+    if imported and not dry_run:
+        db.session.flush()
+        for driver_id, start_date in drivers.items():
+            link_transactions(driver_id, start_date)
+        charging_station_ids = _replay_state(drivers, batteries, lookups)
+        refresh_fleet_state(drivers, charging_station_ids)
+        bump_history_versions(drivers)
+        for driver_id, start_date in drivers.items():
+            for summary in rebuild(Driver.query.get(driver_id), start_date):
+                db.session.add(summary)
+        db.session.flush()
+
+    return ImportResult(imported, errors, len(drivers), duplicates)
+
+
+def read_transactions(lines, lookups, errors):
+    '''
+    Yields the BatteryTransaction column values for each valid row,
+    and appends a RowError to errors for each invalid one
+    '''
+    for line, mapping in _read_rows(lines, lookups, errors):
+        yield mapping
+
+
+def _read_rows(lines, lookups, errors):
+    '''
+    Yields the line number and BatteryTransaction column values of each valid row
+    '''
+    rows = csv.DictReader(lines)
+    missing = set(IMPORT_COLUMNS) - set(rows.fieldnames or ())
+    if missing:
+        raise ValueError('Missing columns: {}'.format(', '.join(sorted(missing))))
+
+    for row in rows:
+        try:
+            yield rows.line_num, _validate(row, lookups)
+        except RowInvalid as err:
+            errors.append(RowError(rows.line_num, str(err)))
+
+
+def _check_odometers(batch, errors):
+    '''
+    Returns the column values of the (line, values) pairs of the batch whose odometer
+    readings lie between the driver's swaps before and after them, in the database
+    or earlier in the batch, and appends a RowError to errors for the others
+    '''
+    by_driver = {}
+    for line, mapping in batch:
+        by_driver.setdefault(mapping['driver_id'], []).append((mapping['transaction_date'], line, mapping))
+    valid_lines = set()
+    for driver_id, rows in by_driver.items():
+        rows.sort(key=lambda row: row[:2])
+        first_date, last_date = rows[0][0], rows[-1][0]
+        previous_reading = odometer_bounds(driver_id, first_date)[0]
+        next_reading = odometer_bounds(driver_id, last_date)[1]
+        # the driver's swaps from the first row of the batch to the last
+        swaps = db.session.query(BatteryTransaction.transaction_date, BatteryTransaction.odometer_reading).filter(
+                BatteryTransaction.rejected.is_(False),
+                BatteryTransaction.driver_id == driver_id,
+                BatteryTransaction.odometer_reading.isnot(None),
+                BatteryTransaction.transaction_date.between(first_date, last_date))\
+                        .order_by(BatteryTransaction.transaction_date).all()
+
+        # the lowest reading after each row
+        next_readings = []
+        later = list(swaps)
+        for transaction_date, line, mapping in reversed(rows):
+            while later and later[-1][0] > transaction_date:
+                reading = later.pop()[1]
+                next_reading = reading if next_reading is None else min(next_reading, reading)
+            next_readings.append(next_reading)
+        next_readings.reverse()
+
+        # and the highest before it, which the valid rows raise as they are accepted
+        earlier = 0
+        for (transaction_date, line, mapping), next_reading in zip(rows, next_readings):
+            while earlier < len(swaps) and swaps[earlier][0] < transaction_date:
+                reading = swaps[earlier][1]
+                previous_reading = reading if previous_reading is None else max(previous_reading, reading)
+                earlier += 1
+            reading = mapping['odometer_reading']
+            if previous_reading is not None and reading < previous_reading:
+                errors.append(RowError(line, 'Odometer reading is lower than the previous swap ({})'.format(previous_reading)))
+            elif next_reading is not None and reading > next_reading:
+                errors.append(RowError(line, 'Odometer reading is higher than the next swap ({})'.format(next_reading)))
+            else:
+                valid_lines.add(line)
+                previous_reading = reading
+    return [mapping for line, mapping in batch if line in valid_lines]
+
+
+def _insert(batch, dry_run):
+    '''
+    Inserts the batch, except rows whose idempotency keys were already added,
+    and the outbox events of the inserted rows
+    Returns the number of rows inserted and skipped
+    '''
+    keys = [mapping['idempotency_key'] for mapping in batch if mapping['idempotency_key']]
+    if keys:
+        added = set(key for key, in db.session.query(BatteryTransaction.idempotency_key)\
+                .filter(BatteryTransaction.idempotency_key.in_(keys)))
+        batch = [mapping for mapping in batch if mapping['idempotency_key'] not in added]
+    if batch and not dry_run:
+        record_imported_swaps(_insert_returning(batch))
+    return len(batch), len(keys) - sum(1 for mapping in batch if mapping['idempotency_key'])
+
+
+def _insert_returning(batch):
+    '''
+    Inserts the batch with one statement, and returns the id, transaction_date
+    and outbox SWAP_COLUMNS of the inserted rows
+    '''
+    table = BatteryTransaction.__table__
+    columns = [table.c.id, table.c.transaction_date] + [table.c[column] for column in SWAP_COLUMNS]
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return db.session.execute(table.insert().values(batch).returning(*columns)).fetchall()
+    db.session.bulk_insert_mappings(BatteryTransaction, batch)
+    # sqlite allows one writer at a time, so once the batch is inserted its rows are the last ones
+    return db.session.execute(select(columns).order_by(table.c.id.desc()).limit(len(batch))).fetchall()[::-1]
+
+
+def _validate(row, lookups):
+    '''
+    Returns the BatteryTransaction column values for a row
+    raises RowInvalid if it can not be imported
+    '''
+    transaction_date = _parse_date(row['transaction_date'])
+    if lookups.archive_horizon and transaction_date < lookups.archive_horizon:
+        raise RowInvalid('Swaps before {} have been archived'.format(lookups.archive_horizon.date()))
+
+    phone_number = (row['driver_phone_number'] or '').strip()
+    vin = (row['vin'] or '').strip()
+    if phone_number:
+        driver_id = lookups.drivers_by_phone.get(phone_number)
+    else:
+        driver_id = lookups.drivers_by_vin.get(vin)
+    if not driver_id:
+        raise RowInvalid('Unknown driver {}'.format(phone_number or vin or "''"))
+
+    charging_station_id = lookups.charging_stations.get((row['charging_station'] or '').strip())
+    if not charging_station_id:
+        raise RowInvalid('Unknown charging station {!r}'.format(row['charging_station']))
+
+    battery_in_id, battery_in_energy = _battery(row, 'battery_in', lookups)
+    battery_out_id, battery_out_energy = _battery(row, 'battery_out', lookups)
+    if not battery_in_id and not battery_out_id:
+        raise RowInvalid('No battery in or out')
+
+    idempotency_key = _parse_key(row)
+    if idempotency_key:
+        if idempotency_key in lookups.idempotency_keys:
+            raise RowInvalid('Repeated idempotency_key {!r}'.format(idempotency_key))
+        lookups.idempotency_keys.add(idempotency_key)
+
+    return {
+        'transaction_date': transaction_date,
+        'driver_id': driver_id,
+        'charging_station_id': charging_station_id,
+        'battery_in_id': battery_in_id,
+        'battery_out_id': battery_out_id,
+        'battery_in_energy': battery_in_energy,
+        'battery_out_energy': battery_out_energy,
+        'odometer_reading': _parse_int(row, 'odometer_reading'),
+        'rejected': False,
+        'idempotency_key': idempotency_key,
+    }
+
+
+def _battery(row, field, lookups):
+    serial = (row[field] or '').strip()
+    if not serial:
+        return None, 0
+    if serial not in lookups.batteries:
+        raise RowInvalid('Unknown battery {!r}'.format(serial))
+    battery_id, capacity = lookups.batteries[serial]
+    energy = _parse_int(row, field + '_energy')
+    if energy > capacity:
+        raise RowInvalid('{} is more than the capacity of battery {}'.format(field + '_energy', serial))
+    return battery_id, energy
+
+
+def _parse_key(row):
+    key = (row.get('idempotency_key') or '').strip()
+    if len(key) > 64:
+        raise RowInvalid('idempotency_key is longer than 64 characters')
+    return key or None
+
+
+def _parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime((value or '').strip(), date_format)
+        except ValueError:
+            pass
+    raise RowInvalid('Invalid transaction_date {!r}'.format(value))
+
+
+def _parse_int(row, field):
+    try:
+        value = int(row[field])
+    except (TypeError, ValueError):
+        raise RowInvalid('Invalid {} {!r}'.format(field, row[field]))
+    if value < 0:
+        raise RowInvalid('{} can not be negative'.format(field))
+    return value
+
+
+def _replay_state(drivers, batteries, lookups):
+    '''
+    Replays every transaction since the earliest import which involves the imported drivers
+    or batteries, and saves the resulting battery locations and vehicle batteries
+
+    Only the last transaction for each battery and vehicle decides where it ends up,
+    so this only keeps track of the final state
+
+    Returns the ids of the charging stations whose batteries may have changed
+    '''
+    start_date = min(drivers.values())
+    transactions = db.session.query(
+            BatteryTransaction.driver_id,
+            BatteryTransaction.charging_station_id,
+            BatteryTransaction.battery_in_id,
+            BatteryTransaction.battery_out_id).filter(
+                BatteryTransaction.rejected.is_(False),
+                BatteryTransaction.transaction_date >= start_date,
+                or_(
+                    BatteryTransaction.driver_id.in_(list(drivers)),
+                    BatteryTransaction.battery_in_id.in_(list(batteries)),
+                    BatteryTransaction.battery_out_id.in_(list(batteries))))\
+                            .order_by(BatteryTransaction.transaction_date.asc())\
+                            .yield_per(IMPORT_BATCH_SIZE)
+
+    battery_locations = {}
+    vehicle_batteries = {}
+    # stations the batteries were at, or were swapped at
+    charging_station_ids = set(station_id for station_id, in
+            db.session.query(Battery.charging_station_id).filter(Battery.id.in_(list(batteries))))
+    for driver_id, charging_station_id, battery_in_id, battery_out_id in transactions:
+        charging_station_ids.add(charging_station_id)
+        if battery_in_id:
+            battery_locations[battery_in_id] = charging_station_id
+        if battery_out_id:
+            battery_locations[battery_out_id] = None
+            vehicle_batteries[driver_id] = battery_out_id
+
+    vehicle_batteries = dict((lookups.vehicles[driver_id], battery_id)
+            for driver_id, battery_id in vehicle_batteries.items() if lookups.vehicles.get(driver_id))
+
+    # lock the rows against concurrent swaps, and check their versions when updating them
+    vehicle_versions = _lock_versions(Vehicle, vehicle_batteries)
+    battery_versions = _lock_versions(Battery, battery_locations)
+    db.session.bulk_update_mappings(Vehicle, [
+        {'id': vehicle_id, 'battery_id': battery_id, 'version_id': vehicle_versions[vehicle_id]}
+        for vehicle_id, battery_id in vehicle_batteries.items()])
+    db.session.bulk_update_mappings(Battery, [
+        {'id': battery_id, 'charging_station_id': charging_station_id, 'version_id': battery_versions[battery_id]}
+        for battery_id, charging_station_id in battery_locations.items()])
+    charging_station_ids.discard(None)
+    return charging_station_ids
+
+
+def _lock_versions(model, ids):
+    '''
+    Locks the rows with the given ids, in order, and returns their current versions
+    '''
+    if not ids:
+        return {}
+    return dict(db.session.query(model.id, model.version_id)\
+            .filter(model.id.in_(sorted(ids))).order_by(model.id).with_for_update())
@@ -0,0 +1,118 @@
+'''
+Concurrent ingest of battery swaps
+
+Swaps for different drivers are independent, unless they share a battery.
+Swaps are partitioned into queues so that every swap for a driver, and every
+swap involving a battery, is in the same queue. Each queue is applied in
+transaction_date order by one worker, and queues are processed concurrently.
+
+Row locks (see add_transaction) still protect objects shared outside of a
+queue, such as batteries moved by later transactions being reapplied, so
+partitioning only keeps workers from waiting on each other.
+
+A swap with an idempotency_key which was already added is not applied again,
+so a swap log can be ingested again after an interruption.
+'''
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from app import db
+from app.models import Driver, Battery, ChargingStation
+from app.controllers.transactions import add_transaction, add_transaction_once
+
+IngestResult = namedtuple('IngestResult', ['applied', 'failed', 'queues', 'duplicates'])
+# a swap which was not applied, and why
+IngestFailure = namedtuple('IngestFailure', ['swap', 'message'])
+
+
+def partition(swaps):
+    '''
+    Groups swaps into queues which share no driver or battery with each other
+
+    swaps are dicts of BatteryTransaction column values.
+    Returns the queues, largest first, each ordered by transaction_date
+    '''
+    parents = {}
+
+    def find(key):
+        parents.setdefault(key, key)
+        root = key
+        while parents[root] != root:
+            root = parents[root]
+        while parents[key] != root:
+            parents[key], key = root, parents[key]
+        return root
+
+    for swap in swaps:
+        driver = find(('driver', swap['driver_id']))
+        for battery_id in (swap.get('battery_in_id'), swap.get('battery_out_id')):
+            if battery_id:
+                parents[find(('battery', battery_id))] = driver
+
+    queues = defaultdict(list)
+    for swap in swaps:
+        queues[find(('driver', swap['driver_id']))].append(swap)
+    return sorted((sorted(queue, key=lambda swap: swap['transaction_date']) for queue in queues.values()),
+            key=len, reverse=True)
+
+
+class IngestScheduler():
+    '''
+    Applies swaps with a pool of worker threads, each with its own database session
+
+    The database pool needs at least one connection per worker
+    '''
+    def __init__(self, app, workers=4):
+        self.app = app
+        self.workers = workers
+
+    def run(self, swaps):
+        queues = partition(swaps)
+        applied = 0
+        failed = []
+        duplicates = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for queue_applied, queue_failed, queue_duplicates in pool.map(self.process, queues):
+                applied += queue_applied
+                failed.extend(queue_failed)
+                duplicates += queue_duplicates
+        return IngestResult(applied, failed, len(queues), duplicates)
+
+    def process(self, queue):
+        '''
+        Applies a queue of swaps in order, committing each one
+
+        If a swap fails, the rest of the queue depends on it, so is not applied
+        Returns the number applied, the failures, and the number already added
+        '''
+        duplicates = 0
+        with self.app.app_context():
+            try:
+                for i, swap in enumerate(queue):
+                    try:
+                        transaction, added = add_transaction_once(lambda: apply_swap(swap), swap.get('idempotency_key'))
+                    except Exception as err:
+                        return i - duplicates, [IngestFailure(swap, str(err))] + \
+                                [IngestFailure(s, 'An earlier swap in its queue failed') for s in queue[i + 1:]], duplicates
+                    if not added:
+                        duplicates += 1
+                return len(queue) - duplicates, [], duplicates
+            finally:
+                db.session.remove()
+
+
+def apply_swap(swap):
+    '''
+    Adds a transaction from a dict of BatteryTransaction column values
+    '''
+    battery_in_id = swap.get('battery_in_id')
+    battery_out_id = swap.get('battery_out_id')
+    return add_transaction(
+            driver = Driver.query.get(swap['driver_id']),
+            battery_in = Battery.query.get(battery_in_id) if battery_in_id else None,
+            battery_out = Battery.query.get(battery_out_id) if battery_out_id else None,
+            charging_station = ChargingStation.query.get(swap['charging_station_id']),
+            battery_in_energy = swap.get('battery_in_energy', 0),
+            battery_out_energy = swap.get('battery_out_energy', 0),
+            odometer_reading = swap.get('odometer_reading', 0),
+            transaction_date = swap['transaction_date'],
+            idempotency_key = swap.get('idempotency_key'))
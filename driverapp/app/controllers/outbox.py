@@ -0,0 +1,180 @@
+'''
+Transactional outbox of swap events, for billing, telematics and other downstream consumers
+
+add_transaction appends an event to the outbox table in the same database
+transaction as the swap, so an event exists exactly when its swap was
+committed; the bulk import inserts the events of its swaps in the same way. The relay publishes the waiting events oldest first, in batches,
+to a Redis stream (or a local JSON lines file, in development and tests) and
+deletes them, so the table only holds what is waiting to be published.
+
+Delivery is at least once: if the relay stops between publishing a batch and
+committing its deletion the batch is published again, so consumers should
+ignore event ids they have already seen. Consumers read the stream from the
+last entry id they processed (or the file from a byte offset) instead of
+querying battery_transaction.
+'''
+import json
+import os
+from collections import namedtuple
+from flask import current_app
+from app import db
+from app.models import OutboxEvent
+
+# events published and deleted per database transaction
+OUTBOX_BATCH_SIZE = 500
+
+SWAP_ADDED = 'swap.added'
+# the payload's corrects is the id of the rejected swap it replaces
+SWAP_CORRECTED = 'swap.corrected'
+
+# BatteryTransaction columns in a swap event's payload, besides its id and date
+SWAP_COLUMNS = ('driver_id', 'charging_station_id', 'battery_in_id', 'battery_out_id',
+        'battery_in_energy', 'battery_out_energy', 'odometer_reading')
+
+# an event as published; offset is where a consumer resumes reading after it
+Event = namedtuple('Event', ['id', 'type', 'payload', 'offset'])
+
+
+def record_event(event_type, payload):
+    '''
+    Adds an event to the outbox, to be published when the session commits
+    '''
+    event = OutboxEvent(event_type=event_type, payload=_dumps(payload))
+    db.session.add(event)
+    return event
+
+
+def record_swap(transaction, correction=None):
+    payload = _swap_payload(transaction.id, transaction.transaction_date,
+            {column: getattr(transaction, column) for column in SWAP_COLUMNS})
+    if correction:
+        payload['corrects'] = correction.id
+        return record_event(SWAP_CORRECTED, payload)
+    return record_event(SWAP_ADDED, payload)
+
+
+def record_imported_swaps(rows):
+    '''
+    Bulk inserts the swap added events of inserted battery_transaction rows,
+    with their id, transaction_date and SWAP_COLUMNS
+    '''
+    db.session.bulk_insert_mappings(OutboxEvent, [
+        {'event_type': SWAP_ADDED, 'payload': _dumps(_swap_payload(row.id, row.transaction_date,
+            {column: getattr(row, column) for column in SWAP_COLUMNS}))}
+        for row in rows])
+
+
+def _swap_payload(transaction_id, transaction_date, columns):
+    payload = dict(columns)
+    payload.update(id=transaction_id, date=transaction_date.isoformat())
+    return payload
+
+
+def _dumps(payload):
+    return json.dumps(payload, separators=(',', ':'), sort_keys=True)
+
+
+class RedisStreamPublisher():
+    '''
+    Adds events to a Redis stream, trimmed to about maxlen entries
+    '''
+    def __init__(self, url, stream, maxlen=None):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.stream = stream
+        self.maxlen = maxlen
+
+    def publish(self, events):
+        pipeline = self.client.pipeline(transaction=False)
+        for event in events:
+            pipeline.xadd(self.stream, {'id': event.id, 'type': event.event_type, 'payload': event.payload},
+                    maxlen=self.maxlen, approximate=True)
+        pipeline.execute()
+
+    def read(self, offset='0-0', count=OUTBOX_BATCH_SIZE):
+        '''
+        Returns up to count events after the stream entry id offset
+        '''
+        response = self.client.xread({self.stream: offset}, count=count)
+        if not response:
+            return []
+        return [Event(int(fields[b'id']), fields[b'type'].decode('utf-8'),
+                    json.loads(fields[b'payload'].decode('utf-8')), entry_id.decode('utf-8'))
+                for entry_id, fields in response[0][1]]
+
+
+class FilePublisher():
+    '''
+    Appends events to a JSON lines file
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, events):
+        with open(self.path, 'a') as outbox:
+            outbox.write(''.join('{{"id":{},"type":{},"payload":{}}}\n'.format(
+                event.id, json.dumps(event.event_type), event.payload) for event in events))
+            outbox.flush()
+            os.fsync(outbox.fileno())
+
+    def read(self, offset=0, count=OUTBOX_BATCH_SIZE):
+        '''
+        Returns up to count events after the byte offset
+        '''
+        if not os.path.exists(self.path):
+            return []
+        events = []
+        with open(self.path, 'rb') as outbox:
+            outbox.seek(offset)
+            while len(events) < count:
+                line = outbox.readline()
+                # a line still being written is read next time
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                event = json.loads(line.decode('utf-8'))
+                events.append(Event(event['id'], event['type'], event['payload'], offset))
+        return events
+
+
+def get_publisher(app=None):
+    '''
+    The publisher configured by OUTBOX_PUBLISHER, 'redis', 'file' or 'none'
+    '''
+    config = (app or current_app).config
+    publisher = config.get('OUTBOX_PUBLISHER')
+    if publisher == 'redis':
+        return RedisStreamPublisher(config['OUTBOX_REDIS_URL'], config['OUTBOX_STREAM'], config.get('OUTBOX_STREAM_MAXLEN'))
+    if publisher == 'file':
+        return FilePublisher(config['OUTBOX_FILE'])
+    return None
+
+
+def relay_batch(publisher, batch_size=OUTBOX_BATCH_SIZE):
+    '''
+    Publishes and deletes the oldest events in the outbox, and commits
+
+    Returns the number of events published
+    '''
+    # a second relay waits for this batch, so events are published in order
+    events = OutboxEvent.query.order_by(OutboxEvent.id)\
+            .with_for_update().limit(batch_size).all()
+    if events:
+        publisher.publish(events)
+        OutboxEvent.query.filter(OutboxEvent.id.in_([e.id for e in events])).delete(synchronize_session=False)
+    db.session.commit()
+    return len(events)
+
+
+def relay(publisher, batch_size=OUTBOX_BATCH_SIZE):
+    '''
+    Publishes batches until the outbox is empty
+
+    Returns the number of events published
+    '''
+    published = 0
+    while True:
+        count = relay_batch(publisher, batch_size)
+        published += count
+        if count < batch_size:
+            return published
@@ -0,0 +1,114 @@
+'''
+Read models of transactions, for the summary and replay engines
+
+Rebuilding summaries or replaying swaps only needs a few columns of each
+transaction, and the ride distance and energy used, which depend on the
+transaction before it. TransactionRecords are built from a column query
+joining that transaction, so no mapped objects (with their identity map
+entries, instance state and lazy loaders) are created for them.
+'''
+from sqlalchemy import and_, case
+from sqlalchemy.orm import aliased
+from app import db
+from app.models import BatteryTransaction
+
+# rows fetched from the database at a time
+RECORD_BATCH_SIZE = 1000
+
+
+class TransactionRecord():
+    __slots__ = ('id', 'transaction_date', 'driver_id', 'charging_station_id',
+            'battery_in_id', 'battery_out_id', 'ride_distance', 'energy_used')
+
+    def __init__(self, id, transaction_date, driver_id, charging_station_id,
+            battery_in_id, battery_out_id, ride_distance, energy_used):
+        self.id = id
+        self.transaction_date = transaction_date
+        self.driver_id = driver_id
+        self.charging_station_id = charging_station_id
+        self.battery_in_id = battery_in_id
+        self.battery_out_id = battery_out_id
+        self.ride_distance = ride_distance
+        self.energy_used = energy_used
+
+    def __repr__(self):
+        return '<TransactionRecord {} {}>'.format(self.id, self.transaction_date)
+
+
+def _stream(query):
+    # a server side cursor where the database supports one, so rows are not all fetched at once
+    return query.execution_options(stream_results=True).yield_per(RECORD_BATCH_SIZE)
+
+
+def transaction_records(*criteria):
+    '''
+    Yields a TransactionRecord for each transaction which is not rejected
+    and matches the criteria, in date order
+    '''
+    last_transaction = aliased(BatteryTransaction)
+    query = db.session.query(
+            BatteryTransaction.id,
+            BatteryTransaction.transaction_date,
+            BatteryTransaction.driver_id,
+            BatteryTransaction.charging_station_id,
+            BatteryTransaction.battery_in_id,
+            BatteryTransaction.battery_out_id,
+            BatteryTransaction.battery_in_energy,
+            BatteryTransaction.odometer_reading,
+            BatteryTransaction.last_transaction_id,
+            last_transaction.odometer_reading,
+            last_transaction.battery_out_energy)\
+                    .outerjoin(last_transaction, BatteryTransaction.last_transaction_id == last_transaction.id)\
+                    .filter(BatteryTransaction.rejected.is_(False), *criteria)\
+                    .order_by(BatteryTransaction.transaction_date.asc(), BatteryTransaction.id.asc())
+
+    for (transaction_id, transaction_date, driver_id, charging_station_id, battery_in_id, battery_out_id,
+            battery_in_energy, odometer_reading, last_transaction_id,
+            last_odometer_reading, last_battery_out_energy) in _stream(query):
+        # the same as BatteryTransaction.ride_distance and energy_used
+        ride_distance = odometer_reading - last_odometer_reading if last_transaction_id else 0
+        if last_transaction_id and last_battery_out_energy:
+            energy_used = last_battery_out_energy - battery_in_energy
+        else:
+            energy_used = 0
+        yield TransactionRecord(transaction_id, transaction_date, driver_id, charging_station_id,
+                battery_in_id, battery_out_id, ride_distance, energy_used)
+
+
+def link_transactions(driver_id, start_date):
+    '''
+    Sets last_transaction_id for every transaction of the driver from start_date,
+    to the transaction before it
+    '''
+    previous = db.session.query(BatteryTransaction.id).filter(
+            BatteryTransaction.rejected.is_(False),
+            BatteryTransaction.driver_id == driver_id,
+            BatteryTransaction.transaction_date < start_date)\
+                    .order_by(BatteryTransaction.transaction_date.desc(), BatteryTransaction.id.desc()).first()
+    previous_id = previous[0] if previous else None
+
+    transactions = db.session.query(BatteryTransaction.id, BatteryTransaction.last_transaction_id).filter(
+            BatteryTransaction.rejected.is_(False),
+            BatteryTransaction.driver_id == driver_id,
+            BatteryTransaction.transaction_date >= start_date)\
+                    .order_by(BatteryTransaction.transaction_date.asc(), BatteryTransaction.id.asc())
+
+    changed = []
+    for transaction_id, last_transaction_id in _stream(transactions):
+        if last_transaction_id != previous_id:
+            changed.append({'id': transaction_id, 'last_transaction_id': previous_id})
+        previous_id = transaction_id
+    db.session.bulk_update_mappings(BatteryTransaction, changed)
+    return changed
+
+
+def ride_distance_and_energy_used(last_transaction):
+    '''
+    SQL expressions of BatteryTransaction.ride_distance and energy_used,
+    given an alias of BatteryTransaction joined as the last transaction
+    '''
+    ride_distance = case([(BatteryTransaction.last_transaction_id.isnot(None),
+        BatteryTransaction.odometer_reading - last_transaction.odometer_reading)], else_=0)
+    energy_used = case([(and_(BatteryTransaction.last_transaction_id.isnot(None), last_transaction.battery_out_energy != 0),
+        last_transaction.battery_out_energy - BatteryTransaction.battery_in_energy)], else_=0)
+    return ride_distance, energy_used
@@ -0,0 +1,146 @@
+'''
+Driver lookup by name or phone number, for the typeahead on the transaction forms
+
+Every token of the query must be the start of one of the driver's names
+(name1, name3 or a token of name2) or of their primary phone number.
+
+On Postgres this is a prefix LIKE on each name column, answered from the
+text_pattern_ops indexes on lower(name) and the phone number, and a LIKE on
+the later tokens of name2 ('% token%'), answered from a pg_trgm index on
+lower(name2). Other databases (sqlite in development and tests) search an in
+memory prefix index instead, which is rebuilt whenever drivers are added or
+people changed.
+'''
+from bisect import bisect_left
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.sql.expression import or_
+from app import db
+from app.models import Person, Driver
+
+SEARCH_LIMIT = 10
+
+# the indexes the search needs on Postgres, as created by the migrations
+POSTGRES_INDEXES = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS ix_person_name1_prefix ON person (lower(name1) text_pattern_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_person_name2_prefix ON person (lower(name2) text_pattern_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_person_name2_trgm ON person USING gin (lower(name2) gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_person_name3_prefix ON person (lower(name3) text_pattern_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_person_primary_phone_number_prefix ON person (primary_phone_number text_pattern_ops)',
+]
+
+
+def search_drivers(query, limit=SEARCH_LIMIT):
+    '''
+    Returns (id, display name, phone number) for up to limit drivers matching the query
+    '''
+    tokens = query.lower().split()
+    if not tokens:
+        return []
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return _search_database(tokens, limit)
+    return _prefix_index().search(tokens, limit)
+
+
+def explain_search(query, limit=SEARCH_LIMIT):
+    '''
+    Returns the lines of the Postgres plan for the search
+    '''
+    statement = _search_query(query.lower().split(), limit).statement.compile(dialect=db.session.get_bind().dialect)
+    return [line for line, in db.session.connection().execute('EXPLAIN ' + str(statement), statement.params)]
+
+
+def _search_database(tokens, limit):
+    return [(driver_id, _display_name(name1, name2, name3), phone_number)
+            for driver_id, name1, name2, name3, phone_number in _search_query(tokens, limit)]
+
+
+def _search_query(tokens, limit):
+    query = db.session.query(Driver.id, Person.name1, Person.name2, Person.name3, Person.primary_phone_number)\
+            .join(Person, Driver.person_id == Person.id)
+    for token in tokens:
+        pattern = _escape_like(token) + '%'
+        query = query.filter(or_(
+            func.lower(Person.name1).like(pattern, escape='\\'),
+            func.lower(Person.name2).like(pattern, escape='\\'),
+            func.lower(Person.name2).like('% ' + pattern, escape='\\'),
+            func.lower(Person.name3).like(pattern, escape='\\'),
+            Person.primary_phone_number.like(pattern, escape='\\'),
+            Person.primary_phone_number.like('+' + pattern, escape='\\')))
+    return query.order_by(Person.name1, Person.name3, Driver.id).limit(limit)
+
+
+def _escape_like(token):
+    return token.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _display_name(*names):
+    return ' '.join(name for name in names if name)
+
+
+class PrefixIndex():
+    '''
+    Sorted (key, driver id) pairs, so the keys starting with a prefix
+    are next to each other and found with a binary search
+
+    Matches are returned in order of the matching key, then name,
+    so they can be taken from the start of the range without sorting
+    '''
+    def __init__(self, rows):
+        entries = []
+        self.drivers = {}
+        self.driver_keys = {}
+        for driver_id, name1, name2, name3, phone_number in rows:
+            name = _display_name(name1, name2, name3)
+            self.drivers[driver_id] = (driver_id, name, phone_number)
+            keys = set(name.lower().split())
+            if phone_number:
+                keys.update((phone_number, phone_number.lstrip('+')))
+            self.driver_keys[driver_id] = keys
+            entries.extend((key, name.lower(), driver_id) for key in keys)
+        entries.sort()
+        self.keys = [key for key, name, driver_id in entries]
+        self.ids = [driver_id for key, name, driver_id in entries]
+
+    def range(self, prefix):
+        start = bisect_left(self.keys, prefix)
+        return start, bisect_left(self.keys, prefix + '\uffff', start)
+
+    def search(self, tokens, limit):
+        # walk the range of the token with the fewest matches, checking the other tokens
+        ranges = sorted((self.range(token), token) for token in set(tokens))
+        ranges.sort(key=lambda r: r[0][1] - r[0][0])
+        (start, end), token = ranges[0]
+        other_tokens = [token for r, token in ranges[1:]]
+
+        found = []
+        seen = set()
+        for i in range(start, end):
+            driver_id = self.ids[i]
+            if driver_id in seen:
+                continue
+            seen.add(driver_id)
+            keys = self.driver_keys[driver_id]
+            if all(any(key.startswith(token) for key in keys) for token in other_tokens):
+                found.append(self.drivers[driver_id])
+                if len(found) == limit:
+                    break
+        return found
+
+
+def _prefix_index():
+    '''
+    Returns the prefix index for this app, rebuilding it if drivers were added or people changed
+    '''
+    version = db.session.query(
+            db.session.query(func.max(Driver.id)).as_scalar(),
+            db.session.query(func.max(Person.id)).as_scalar(),
+            db.session.query(func.max(Person.date_modified)).as_scalar()).one()
+    index = current_app.extensions.get('driver_prefix_index')
+    if not index or index[0] != version:
+        rows = db.session.query(Driver.id, Person.name1, Person.name2, Person.name3, Person.primary_phone_number)\
+                .join(Person, Driver.person_id == Person.id)
+        index = (version, PrefixIndex(rows))
+        current_app.extensions['driver_prefix_index'] = index
+    return index[1]
@@ -1,7 +1,9 @@
-from app.models import BatteryTransaction, DriverSummary, Driver
+from app.models import BatteryTransaction, DriverSummary, DriverSummaryBlock, Driver
 from app import db
+from app.controllers.fleet import bump_history_versions
+from app.controllers.records import transaction_records
 from datetime import datetime, timedelta
-from sqlalchemy.sql.expression import or_
+from sqlalchemy.sql.expression import or_, func
 
 import celery
 
@@ -10,6 +12,10 @@ import celery
 # can actually support different time intervals, but for now they don't
 SUMMARY_INTERVAL = timedelta(days=1)
 
+# new and changed summaries are flushed this many at a time,
+# so a long history does not build up pending objects in the session
+SUMMARY_BATCH_SIZE = 500
+
 def get_start_date(start_date):
     '''
     get the nearest midnight before the given date
@@ -20,13 +26,91 @@ def get_start_date(start_date):
 
 def rebuild(driver, start_date, end_date=None):
     '''
-    Deletes all summaries between two dates.
-    Then rebuilds from scratch
+    Recomputes all summaries from start_date up to end_date in memory,
+    then writes back only the summaries whose values changed.
+
+    Cumulative totals are not stored, so summaries after a changed one
+    are not touched; only the blocks holding changed summaries are.
+
+    Transactions are streamed, and changed summaries flushed in batches,
+    so memory use does not grow with the number of transactions.
+
+    Returns the new and modified summaries and blocks
     '''
     db.session.flush()
     end_date = end_date or datetime.utcnow()
-    bad_summaries = DriverSummary.query.filter(DriverSummary.driver == driver, DriverSummary.end_date >= start_date).delete(synchronize_session='fetch')
-    return rollover(driver, end_date)
+    first_day = get_start_date(start_date)
+
+    # without any earlier summaries, everything since the driver started is rebuilt
+    earlier_summary = DriverSummary.query.filter(
+            DriverSummary.driver == driver,
+            DriverSummary.start_date < first_day).first()
+    if not earlier_summary:
+        first_day = get_start_date(driver.date_started)
+
+    existing = dict((summary.start_date, summary) for summary in DriverSummary.query.filter(
+            DriverSummary.driver == driver,
+            DriverSummary.start_date >= first_day))
+
+    daily_totals = _daily_totals(transaction_records(
+            BatteryTransaction.driver_id == driver.id,
+            BatteryTransaction.transaction_date >= first_day,
+            BatteryTransaction.transaction_date <= end_date))
+    if daily_totals:
+        end_date = max(max(daily_totals) + SUMMARY_INTERVAL, end_date)
+
+    changed = []
+    block_changes = {}
+    current_date = first_day
+    while current_date < end_date:
+        ride_distance, energy_used, last_transaction_id = daily_totals.get(current_date, (0, 0, None))
+        summary = existing.get(current_date)
+        if not summary:
+            summary = DriverSummary(driver = driver,
+                    start_date = current_date,
+                    end_date = current_date + SUMMARY_INTERVAL,
+                    ride_distance = 0,
+                    energy_used = 0)
+            changed.append(summary)
+        elif (summary.ride_distance, summary.energy_used, summary.last_transaction_id) != \
+                (ride_distance, energy_used, last_transaction_id):
+            changed.append(summary)
+        else:
+            current_date += SUMMARY_INTERVAL
+            continue
+
+        _add_block_change(block_changes, current_date,
+                ride_distance - summary.ride_distance,
+                energy_used - summary.energy_used)
+        summary.ride_distance = ride_distance
+        summary.energy_used = energy_used
+        summary.last_transaction_id = last_transaction_id
+        db.session.add(summary)
+        if len(changed) % SUMMARY_BATCH_SIZE == 0:
+            db.session.flush()
+        current_date += SUMMARY_INTERVAL
+
+    if changed:
+        bump_history_versions([driver.id])
+    return changed + _update_blocks(driver, block_changes)
+
+
+def _daily_totals(transactions):
+    '''
+    Sums ride distance and energy used per summary interval
+
+    Returns a dict of interval start date to
+    (ride_distance, energy_used, last_transaction_id)
+    '''
+    daily_totals = {}
+    for transaction in transactions:
+        day = get_start_date(transaction.transaction_date)
+        ride_distance, energy_used, last_transaction_id = daily_totals.get(day, (0, 0, None))
+        daily_totals[day] = (
+                ride_distance + transaction.ride_distance,
+                energy_used + transaction.energy_used,
+                transaction.id)
+    return daily_totals
 
 
 def rollover(driver, date):
@@ -34,9 +118,10 @@ def rollover(driver, date):
     Updates all summaries for driver, 
     starts from the last summary, and updates up to and including date
 
-    Fetches all transactiosn in that time range, and reapplies
+    Streams all transactiosn in that time range, and reapplies
 
-    If any new summaries need to be created, create them
+    If any new summaries need to be created, create them;
+    they are added to the session and flushed in batches
     '''
     last_summary = DriverSummary.query.filter(DriverSummary.driver == driver)\
             .order_by(DriverSummary.start_date.desc()).first()
@@ -47,20 +132,171 @@ def rollover(driver, date):
         else:
             last_date = last_summary.start_date
 
-        transactions = BatteryTransaction.query.filter(
-                BatteryTransaction.rejected.is_(False),
-                BatteryTransaction.driver == driver,
+        transactions = transaction_records(
+                BatteryTransaction.driver_id == driver.id,
                 BatteryTransaction.transaction_date > last_date,
-                BatteryTransaction.transaction_date <= date)\
-                        .order_by(BatteryTransaction.transaction_date.asc()).all()
+                BatteryTransaction.transaction_date <= date)
+    else:
+        transactions = transaction_records(
+                BatteryTransaction.driver_id == driver.id,
+                BatteryTransaction.transaction_date <= date)
+
+    block_changes = {}
+
+    def totalled(transactions):
+        for transaction in transactions:
+            _add_block_change(block_changes, transaction.transaction_date,
+                    transaction.ride_distance, transaction.energy_used)
+            yield transaction
+
+    summaries = []
+    for summary in _roll_summaries(driver, date, last_summary, totalled(transactions)):
+        summaries.append(summary)
+        db.session.add(summary)
+        if len(summaries) % SUMMARY_BATCH_SIZE == 0:
+            db.session.flush()
+    if summaries:
+        bump_history_versions([driver.id])
+    return summaries + _update_blocks(driver, block_changes)
+
+
+def _add_block_change(block_changes, date, ride_distance, energy_used):
+    '''
+    Adds a change in ride distance and energy used on date
+    to the changes for the block containing date
+    '''
+    block_start = DriverSummaryBlock.get_start_date(date)
+    block_ride_distance, block_energy_used = block_changes.get(block_start, (0, 0))
+    block_changes[block_start] = (block_ride_distance + ride_distance, block_energy_used + energy_used)
+
+
+def _update_blocks(driver, block_changes):
+    '''
+    Applies changes to the totals of the driver's summary blocks,
+    creating any blocks which do not exist yet
+
+    Returns the new and modified blocks
+    '''
+    block_changes = dict((start_date, change) for start_date, change in block_changes.items()
+            if change != (0, 0))
+    if not block_changes:
+        return []
+
+    blocks = dict((block.start_date, block) for block in DriverSummaryBlock.query.filter(
+            DriverSummaryBlock.driver_id == driver.id,
+            DriverSummaryBlock.start_date.in_(list(block_changes))))
+
+    modified = []
+    for start_date, (ride_distance, energy_used) in sorted(block_changes.items()):
+        block = blocks.get(start_date)
+        if not block:
+            block = DriverSummaryBlock(driver = driver,
+                    start_date = start_date,
+                    end_date = DriverSummaryBlock.get_end_date(start_date),
+                    ride_distance = 0,
+                    energy_used = 0)
+        block.ride_distance += ride_distance
+        block.energy_used += energy_used
+        modified.append(block)
+    return modified
+
+
+def recompute_blocks(driver, start_date=None, end_date=None):
+    '''
+    Sets the totals of the driver's blocks holding start_date up to end_date
+    (or all of them) to the sums of their daily summaries
+
+    rebuild and rollover change blocks by the change in their summaries, so they
+    rely on the two agreeing; this brings them back in line when they do not.
+    Returns the new and modified blocks
+    '''
+    summaries = db.session.query(DriverSummary.start_date, DriverSummary.ride_distance, DriverSummary.energy_used)\
+            .filter(DriverSummary.driver_id == driver.id)
+    blocks = DriverSummaryBlock.query.filter(DriverSummaryBlock.driver_id == driver.id)
+    if start_date:
+        start_date = DriverSummaryBlock.get_start_date(start_date)
+        summaries = summaries.filter(DriverSummary.start_date >= start_date)
+        blocks = blocks.filter(DriverSummaryBlock.start_date >= start_date)
+    if end_date:
+        # up to the end of the block holding end_date
+        end_date = DriverSummaryBlock.get_end_date(DriverSummaryBlock.get_start_date(end_date))
+        summaries = summaries.filter(DriverSummary.start_date < end_date)
+        blocks = blocks.filter(DriverSummaryBlock.start_date < end_date)
+
+    totals = {}
+    for summary_start, ride_distance, energy_used in summaries:
+        _add_block_change(totals, summary_start, ride_distance, energy_used)
+    blocks = dict((block.start_date, block) for block in blocks)
+
+    modified = []
+    for block_start in sorted(set(totals) | set(blocks)):
+        ride_distance, energy_used = totals.get(block_start, (0, 0))
+        block = blocks.get(block_start)
+        if not block:
+            block = DriverSummaryBlock(driver = driver,
+                    start_date = block_start,
+                    end_date = DriverSummaryBlock.get_end_date(block_start),
+                    ride_distance = 0,
+                    energy_used = 0)
+        elif (block.ride_distance, block.energy_used) == (ride_distance, energy_used):
+            continue
+        block.ride_distance = ride_distance
+        block.energy_used = energy_used
+        modified.append(block)
+    return modified
+
+
+def cumulative_totals(driver, date):
+    '''
+    Returns the driver's total ride distance and energy used
+    up to and including the summary for date
+
+    Sums the blocks before date's block, then the summaries within it,
+    so the cost does not grow with the length of the driver's history
+    '''
+    return _cumulative_totals(driver.id, date)
+
+
+def _cumulative_totals(driver_id, date):
+    block_start = DriverSummaryBlock.get_start_date(date)
+    blocks_ride_distance, blocks_energy_used = db.session.query(
+            func.coalesce(func.sum(DriverSummaryBlock.ride_distance), 0),
+            func.coalesce(func.sum(DriverSummaryBlock.energy_used), 0))\
+                    .filter(DriverSummaryBlock.driver_id == driver_id,
+                            DriverSummaryBlock.start_date < block_start).one()
+    days_ride_distance, days_energy_used = db.session.query(
+            func.coalesce(func.sum(DriverSummary.ride_distance), 0),
+            func.coalesce(func.sum(DriverSummary.energy_used), 0))\
+                    .filter(DriverSummary.driver_id == driver_id,
+                            DriverSummary.start_date >= block_start,
+                            DriverSummary.start_date <= get_start_date(date)).one()
+    return blocks_ride_distance + days_ride_distance, blocks_energy_used + days_energy_used
+
+
+def get_summaries(driver, start_date=None, end_date=None):
+    '''
+    Returns the driver's summaries from start_date up to end_date
+    in date order, with their cumulative totals set
+    '''
+    query = DriverSummary.query.filter(DriverSummary.driver_id == driver.id)
+    if start_date:
+        start_date = get_start_date(start_date)
+        query = query.filter(DriverSummary.start_date >= start_date)
+        ride_distance, energy_used = cumulative_totals(driver, start_date - SUMMARY_INTERVAL)
     else:
-        transactions = BatteryTransaction.query.filter(
-                BatteryTransaction.rejected.is_(False),
-                BatteryTransaction.driver == driver,
-                BatteryTransaction.transaction_date <= date)\
-                        .order_by(BatteryTransaction.transaction_date.asc()).all()
+        ride_distance, energy_used = 0, 0
+    if end_date:
+        query = query.filter(DriverSummary.start_date < end_date)
+
+    summaries = query.order_by(DriverSummary.start_date.asc()).all()
+    for summary in summaries:
+        ride_distance += summary.ride_distance
+        energy_used += summary.energy_used
+        summary.cumulative_ride_distance = ride_distance
+        summary.cumulative_energy_used = energy_used
+    return summaries
+
 
-    return _rollover(driver, date, last_summary, transactions)
 
 
 def _rollover(driver, end_date, last_summary, transactions):
@@ -75,14 +311,16 @@ def _rollover(driver, end_date, last_summary, transactions):
     assumes that all the transactions have not yet been applied, 
     and are in the correct date rande
     '''
-    new_summaries = []
+    return list(_roll_summaries(driver, end_date, last_summary, transactions))
 
-    if len(transactions) > 0:
-        end_date = max(transactions[-1].transaction_date, end_date)
-        next_transaction = transactions[0]
-        transactions = transactions[1:]
-    else:
-        next_transaction = None
+
+def _roll_summaries(driver, end_date, last_summary, transactions):
+    '''
+    Yields the summaries of _rollover one at a time, reading transactions,
+    which can be any iterable in ascending order of transaction date, as it goes
+    '''
+    transactions = iter(transactions)
+    next_transaction = next(transactions, None)
 
     # if no last summary, create one when the driver started
     if not last_summary:
@@ -91,27 +329,24 @@ def _rollover(driver, end_date, last_summary, transactions):
                 start_date = start_date,
                 end_date = start_date + SUMMARY_INTERVAL,
                 ride_distance = 0,
-                energy_used = 0,
-                cumulative_ride_distance = 0,
-                cumulative_energy_used = 0)
+                energy_used = 0)
 
     current_summary = last_summary
 
     current_date = current_summary.start_date
 
-    # until we are past the specified end date, create new summaries for each time interval
-    # (if they don't exist)
+    # until we are past the specified end date (or the last transaction), create new summaries
+    # for each time interval (if they don't exist)
     # and apply any unapplied transactions to them
-    while (current_date < end_date):
+    while current_date < end_date or \
+            (next_transaction and next_transaction.transaction_date >= current_date):
         # if the current date is beyond the end_date of the current summary, create a new summary
         if current_summary.end_date <= current_date:
             new_summary = DriverSummary(driver = driver,
                     start_date = current_summary.end_date,
                     end_date = current_summary.end_date + SUMMARY_INTERVAL,
                     ride_distance = 0,
-                    energy_used = 0,
-                    cumulative_ride_distance = current_summary.cumulative_ride_distance,
-                    cumulative_energy_used = current_summary.cumulative_energy_used)
+                    energy_used = 0)
             current_summary = new_summary
         # apply transactions until there are either no more transaction or
         # the next transaction is out of the date range for the current summary
@@ -119,28 +354,24 @@ def _rollover(driver, end_date, last_summary, transactions):
                 next_transaction.transaction_date >= current_summary.start_date and \
                 next_transaction.transaction_date < current_summary.end_date):
             current_summary.apply_transaction(next_transaction)
-            if len(transactions) == 0:
-                next_transaction = None
-            else:
-                next_transaction = transactions[0]
-                transactions = transactions[1:]
+            next_transaction = next(transactions, None)
         # every iteration, SOMETHING happend
-        new_summaries.append(current_summary)
+        yield current_summary
         current_date += SUMMARY_INTERVAL
 
-    return new_summaries
-
 def rollover_all():
     '''
     Rolls over all summaries for currently active drivers to a new date
     '''
     now = datetime.utcnow()
     drivers = Driver.query.filter(Driver.date_started < now, 
-            _or(Driver.date_ended is None, Driver.date_ended > now))\
+            or_(Driver.date_ended.is_(None), Driver.date_ended > now))\
                     .all()
 
     for driver in drivers:
-        rollover(driver, now)
+        for summary in rollover(driver, now):
+            db.session.add(summary)
+    db.session.flush()
 
 def update_summaries(transaction):
     '''
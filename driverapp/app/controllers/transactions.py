@@ -1,9 +1,17 @@
-from app.models import BatteryTransaction, DriverSummary
+from app.models import BatteryTransaction, DriverSummary, Driver, Vehicle, Battery, ChargingStation
 from app import db, login
+from app.counters import station_counters, station_stock
+from app.broadcast import broadcaster
 from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.sql.expression import or_
 
 from app.controllers.summaries import update_summaries
+from app.controllers.fleet import refresh_fleet_state, lock_charging_stations, bump_history_versions
+from app.controllers.records import transaction_records, link_transactions
+from app.controllers.validation import validate_transaction
+from app.controllers.outbox import record_swap
 
 def add_transaction(
         driver=None, 
@@ -14,7 +22,8 @@ def add_transaction(
         battery_out_energy=0, 
         odometer_reading=0, 
         correction=None, 
-        transaction_date=None):
+        transaction_date=None,
+        idempotency_key=None):
     '''
     Adds a battery transaction
 
@@ -28,7 +37,23 @@ def add_transaction(
 
     finally, it updates the summaries.
     This could be done in a background task. if that was working
+
+    The drivers, vehicles and batteries involved are locked first,
+    so concurrent swaps on any of them happen one after the other
+
+    Returns the new transaction
     '''
+    if correction:
+        drivers = (driver, correction.driver)
+        batteries = [b for b in (battery_in, battery_out, correction.battery_in, correction.battery_out) if b]
+    else:
+        drivers = (driver,)
+        batteries = [b for b in (battery_in, battery_out) if b]
+    lock_objects(drivers, batteries, [charging_station, correction.charging_station if correction else None])
+    if correction:
+        # a concurrent correction of the same swap waits here, then finds it rejected
+        correction = BatteryTransaction.query.filter_by(id=correction.id)\
+                .with_for_update().populate_existing().one()
 
     if not transaction_date:
         # a correction has the same transaction date
@@ -37,6 +62,10 @@ def add_transaction(
         else:
             transaction_date = datetime.utcnow()
 
+    # reject an invalid swap before anything is written
+    validate_transaction(driver, battery_in, battery_out, charging_station,
+            battery_in_energy, battery_out_energy, odometer_reading, transaction_date, correction)
+
     # the last transaction which is not rejected, and has the same driver
     last_transaction = BatteryTransaction.query.filter(
             BatteryTransaction.rejected.is_(False),
@@ -55,7 +84,8 @@ def add_transaction(
             odometer_reading = odometer_reading,
             last_transaction = last_transaction,
             transaction_date = transaction_date,
-            correction = correction)
+            correction = correction,
+            idempotency_key = idempotency_key)
 
     db.session.add(new_transaction)
 
@@ -63,36 +93,181 @@ def add_transaction(
     if correction:
         correction.rejected = True
         db.session.add(correction)
-
-        drivers = (driver, correction.driver)
-        batteries = [b for b in (battery_in, battery_out, correction.battery_in, correction.battery_out) if b]
-    else:
-        drivers = (driver,)
-        batteries = [b for b in (battery_in, battery_out) if b]
     db.session.flush()
 
     # for any transactions with a transactio date later than this one, 
     # if they apply to the same objects as this transaction or its correction
     # they may need to be reapplied to get the correct current state
-    later_transactions = BatteryTransaction.query.filter(BatteryTransaction.rejected.is_(False),
+    later_transactions = list(transaction_records(
+                BatteryTransaction.transaction_date > transaction_date,
                 or_(
                     BatteryTransaction.driver_id.in_([d.id for d in drivers]), 
                     BatteryTransaction.battery_in_id.in_([b.id for b in batteries]),
-                    BatteryTransaction.battery_out_id.in_([b.id for b in batteries]),
-                    BatteryTransaction.transaction_date > transaction_date)
-                ).order_by(BatteryTransaction.transaction_date.asc()).all()
+                    BatteryTransaction.battery_out_id.in_([b.id for b in batteries]))))
 
-    # save any modified objects
-    modified = new_transaction.add_transaction(later_transactions, correction)
+    # stations the batteries are leaving
+    charging_station_ids = set(b.charging_station_id for b in batteries)
+
+    new_transaction.add_transaction(correction=correction)
+    replay(later_transactions)
+    if correction:
+        # transactions which followed the correction follow its replacement instead
+        for affected in drivers:
+            link_transactions(affected.id, min(transaction_date, correction.transaction_date))
 
-    for m in modified:
-        db.session.add(m)
-    for driver in drivers:
-        db.session.add(driver.current_vehicle)
+    # save any modified objects
+    for affected in drivers:
+        db.session.add(affected.current_vehicle)
     for battery in batteries:
         db.session.add(battery)
     db.session.flush()
 
+    # update the read models of the fleet state
+    charging_station_ids.update(b.charging_station_id for b in batteries)
+    charging_station_ids.update(t.charging_station_id for t in later_transactions)
+    charging_station_ids.discard(None)
+    refresh_fleet_state(
+            [d.id for d in drivers] + [t.driver_id for t in later_transactions],
+            charging_station_ids)
+
+    # rendered history of the drivers whose transactions or summaries may have changed
+    bump_history_versions([d.id for d in drivers] + [t.driver_id for t in later_transactions])
+
+    # published to downstream consumers, counted on the station dashboard
+    # and shown on the open station and driver pages, once this commits
+    record_swap(new_transaction, correction)
+    stock = station_stock(db.session, charging_station_ids)
+    station_counters.record(db.session, new_transaction, correction, stock)
+    broadcaster.record(db.session, new_transaction, correction, stock)
+
     # finally, update summaries
     update_summaries(new_transaction)
+    return new_transaction
+
+
+
+def replay(transactions):
+    '''
+    Reapplies the battery moves of transactions, given as TransactionRecords
+    in date order, to the batteries and vehicles they involve
+    '''
+    batteries = _by_id(Battery, set(battery_id for t in transactions
+        for battery_id in (t.battery_in_id, t.battery_out_id) if battery_id))
+    charging_stations = _by_id(ChargingStation, set(t.charging_station_id for t in transactions if t.battery_in_id))
+    drivers = _by_id(Driver, set(t.driver_id for t in transactions if t.battery_out_id))
+    # loaded together, rather than one by one through driver.current_vehicle
+    _by_id(Vehicle, set(d.current_vehicle_id for d in drivers.values() if d.current_vehicle_id))
+
+    for transaction in transactions:
+        if transaction.battery_in_id:
+            batteries[transaction.battery_in_id].charging_station = charging_stations.get(transaction.charging_station_id)
+        if transaction.battery_out_id:
+            battery_out = batteries[transaction.battery_out_id]
+            battery_out.charging_station = None
+            drivers[transaction.driver_id].current_vehicle.battery = battery_out
 
+
+def _by_id(model, ids):
+    if not ids:
+        return {}
+    return dict((instance.id, instance) for instance in model.query.filter(model.id.in_(list(ids))))
+
+
+def lock_objects(drivers, batteries, charging_stations=()):
+    '''
+    Locks the rows of the drivers, their vehicles, the batteries, and the
+    charging stations given and those the batteries are at, until the end
+    of the database transaction, and reloads them
+
+    Rows are always locked in the same order, so two swaps
+    locking some of the same rows can not deadlock
+    '''
+    driver_ids = sorted(set(d.id for d in drivers if d.id))
+    if not driver_ids:
+        return
+    locked_drivers = Driver.query.filter(Driver.id.in_(driver_ids))\
+            .order_by(Driver.id).with_for_update().populate_existing().all()
+
+    vehicle_ids = sorted(set(d.current_vehicle_id for d in locked_drivers if d.current_vehicle_id))
+    if vehicle_ids:
+        Vehicle.query.filter(Vehicle.id.in_(vehicle_ids))\
+                .order_by(Vehicle.id).with_for_update().populate_existing().all()
+
+    battery_ids = sorted(set(b.id for b in batteries if b.id))
+    locked_batteries = []
+    if battery_ids:
+        locked_batteries = Battery.query.filter(Battery.id.in_(battery_ids))\
+                .order_by(Battery.id).with_for_update().populate_existing().all()
+
+    # their stock is recounted by refresh_fleet_state
+    lock_charging_stations([s.id for s in charging_stations if s] +
+            [b.charging_station_id for b in locked_batteries])
+
+
+# deadlock and serialization failure
+CONFLICT_ERROR_CODES = ('40P01', '40001')
+
+def is_conflict(error):
+    '''
+    True if the error was caused by a concurrent change, and retrying could succeed
+    '''
+    if isinstance(error, StaleDataError):
+        return True
+    if not isinstance(error, OperationalError):
+        return False
+    # sqlite has no error codes, and locks the whole database
+    return getattr(error.orig, 'pgcode', None) in CONFLICT_ERROR_CODES or \
+            str(error.orig) == 'database is locked'
+
+
+def retry_on_conflict(func, attempts=3):
+    '''
+    Calls func and commits, starting again from a fresh database transaction if a
+    concurrent change conflicted with it. func must load everything it depends on itself.
+
+    Returns the result of func
+    '''
+    for attempt in range(attempts):
+        try:
+            result = func()
+            db.session.commit()
+            return result
+        except (StaleDataError, OperationalError) as err:
+            db.session.rollback()
+            if not is_conflict(err) or attempt == attempts - 1:
+                raise
+        except Exception:
+            # e.g. an invalid swap, which should not leave its locks or changes behind
+            db.session.rollback()
+            raise
+
+
+def submitted_transaction(idempotency_key):
+    '''
+    The transaction added with the idempotency key, if any
+    '''
+    if not idempotency_key:
+        return None
+    return BatteryTransaction.query.filter_by(idempotency_key=idempotency_key).first()
+
+
+def add_transaction_once(func, idempotency_key):
+    '''
+    Calls func, which adds a transaction with the idempotency key, through
+    retry_on_conflict, unless a transaction with the key was already added
+
+    A retried submission returns the transaction its first submission added,
+    without locking, validating or updating anything. Returns the transaction,
+    and True if this call added it
+    '''
+    existing = submitted_transaction(idempotency_key)
+    if existing:
+        return existing, False
+    try:
+        return retry_on_conflict(func), True
+    except IntegrityError:
+        # a concurrent submission with the same key committed first
+        existing = submitted_transaction(idempotency_key)
+        if not existing:
+            raise
+        return existing, False
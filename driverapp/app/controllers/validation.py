@@ -0,0 +1,105 @@
+'''
+Checks of a battery swap against the current state, before it is written
+
+A swap recorded with a battery that is not where the swap says it is, an
+energy the battery can not hold or an odometer reading going backwards
+leaves negative energy and distances in the summaries, which then take a
+correction, and a replay of every later swap, to put right.
+
+Each check reads the locked driver, vehicle and batteries, or runs one
+indexed query, so validating does not depend on the length of the history.
+'''
+from sqlalchemy.sql.expression import or_
+from app import db
+from app.models import BatteryTransaction
+from app.controllers.archive import archive_horizon
+
+
+class TransactionValidationError(ValueError):
+    '''
+    Raised when a swap is invalid; errors are (form field, message) pairs
+    '''
+    def __init__(self, errors):
+        super(TransactionValidationError, self).__init__('; '.join(message for field, message in errors))
+        self.errors = errors
+
+
+def validate_transaction(
+        driver,
+        battery_in,
+        battery_out,
+        charging_station,
+        battery_in_energy,
+        battery_out_energy,
+        odometer_reading,
+        transaction_date,
+        correction=None):
+    '''
+    Raises TransactionValidationError if the swap is not consistent with the current
+    state of its driver and batteries, or with the driver's swaps before and after it
+    '''
+    errors = []
+    # a swap is corrected once; correct its replacement instead
+    if correction and correction.rejected:
+        errors.append(('id', 'Transaction {} has already been corrected'.format(correction.id)))
+    # summaries before the archive horizon are final
+    horizon = archive_horizon()
+    if horizon and transaction_date < horizon:
+        errors.append(('transaction_date', 'Swaps before {} have been archived'.format(horizon.date())))
+
+    for field, battery, energy in (
+            ('battery_in_energy', battery_in, battery_in_energy),
+            ('battery_out_energy', battery_out, battery_out_energy)):
+        if battery and energy is not None and not 0 <= energy <= battery.capacity:
+            errors.append((field, 'Energy must be between 0 and the capacity of battery {} ({})'.format(
+                battery.serial, battery.capacity)))
+
+    # the current locations are only where the batteries were at the time of
+    # the swap if nothing has moved them since; otherwise the replay decides
+    if not correction and not _has_later_transactions(driver, (battery_in, battery_out), transaction_date):
+        vehicle = driver.current_vehicle
+        vehicle_battery_id = vehicle.battery_id if vehicle else None
+        # a battery swapped in is at the station when the battery out is taken, even if it is the same one
+        if battery_out and battery_out != battery_in and battery_out.charging_station_id != charging_station.id:
+            errors.append(('battery_out_id', 'Battery {} is not at {}'.format(battery_out.serial, charging_station.name)))
+        if battery_in and battery_in.id != vehicle_battery_id:
+            errors.append(('battery_in_id', "Battery {} is not on the driver's vehicle".format(battery_in.serial)))
+        elif not battery_in and vehicle_battery_id:
+            errors.append(('battery_in_id', "The battery on the driver's vehicle must be swapped in"))
+
+    previous_reading, next_reading = odometer_bounds(driver.id, transaction_date, correction)
+    if odometer_reading is not None:
+        if previous_reading is not None and odometer_reading < previous_reading:
+            errors.append(('odometer_reading', 'Odometer reading is lower than the previous swap ({})'.format(previous_reading)))
+        if next_reading is not None and odometer_reading > next_reading:
+            errors.append(('odometer_reading', 'Odometer reading is higher than the next swap ({})'.format(next_reading)))
+
+    if errors:
+        raise TransactionValidationError(errors)
+
+
+def _has_later_transactions(driver, batteries, transaction_date):
+    battery_ids = [b.id for b in batteries if b]
+    involved = [BatteryTransaction.driver_id == driver.id]
+    if battery_ids:
+        involved += [BatteryTransaction.battery_in_id.in_(battery_ids), BatteryTransaction.battery_out_id.in_(battery_ids)]
+    return db.session.query(BatteryTransaction.query.filter(
+            BatteryTransaction.rejected.is_(False),
+            BatteryTransaction.transaction_date > transaction_date,
+            or_(*involved)).exists()).scalar()
+
+
+def odometer_bounds(driver_id, transaction_date, correction=None):
+    '''
+    Returns the odometer readings of the driver's swaps just before and just after transaction_date
+    '''
+    query = db.session.query(BatteryTransaction.odometer_reading).filter(
+            BatteryTransaction.rejected.is_(False),
+            BatteryTransaction.driver_id == driver_id)
+    if correction:
+        query = query.filter(BatteryTransaction.id != correction.id)
+    previous = query.filter(BatteryTransaction.transaction_date < transaction_date)\
+            .order_by(BatteryTransaction.transaction_date.desc()).first()
+    following = query.filter(BatteryTransaction.transaction_date > transaction_date)\
+            .order_by(BatteryTransaction.transaction_date.asc()).first()
+    return previous[0] if previous else None, following[0] if following else None
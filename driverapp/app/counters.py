@@ -0,0 +1,238 @@
+'''
+Live swap counters for the station dashboard
+
+The dashboard shows each station's swaps in the last hour and the batteries and
+energy in stock, refreshed every few seconds, so it reads counters kept outside
+the database instead of querying battery_transaction.
+
+Each station's recent swaps are a sorted set of transaction ids scored by the
+time of the swap; a window is counted with ZCOUNT, and swaps older than
+STATION_COUNTERS_WINDOW are trimmed as new ones are added. The stock is copied
+from the station's ChargingStationState, so applying an update twice is harmless.
+Updates are collected on the session and sent in one pipeline once it commits,
+so a rolled back swap is never counted.
+
+The counters are a cache of the database; flask rebuild-station-counters
+recomputes them, e.g. after Redis was flushed. They are kept in Redis when
+STATION_COUNTERS_REDIS_URL is set, and not kept at all otherwise; in process
+counters (simple) only see their own process's swaps, and are for development
+and tests.
+'''
+import threading
+from calendar import timegm
+from collections import namedtuple
+from datetime import datetime, timedelta
+from time import time
+from flask import current_app
+from sqlalchemy import event
+from app.routing import RoutingSession
+
+# session.info key of the counter updates to send when the session commits
+PENDING_KEY = 'station_counters'
+
+# a station's name, and its batteries and energy in stock
+StationStock = namedtuple('StationStock', ['charging_station_id', 'name', 'battery_count', 'energy_on_hand'])
+# what the dashboard shows for a station
+StationCounts = namedtuple('StationCounts', ['charging_station_id', 'name', 'swaps', 'battery_count', 'energy_on_hand'])
+
+
+def _timestamp(date):
+    # transaction dates are naive UTC
+    return timegm(date.utctimetuple())
+
+
+class SimpleBackend():
+    '''
+    In process counters
+    '''
+    def __init__(self):
+        self.swaps = {}
+        self.stock = {}
+        self.lock = threading.Lock()
+
+    def apply(self, added, removed, stock, trim_before):
+        with self.lock:
+            for station_id, transaction_id, timestamp in added:
+                self.swaps.setdefault(station_id, {})[transaction_id] = timestamp
+            for station_id, transaction_id in removed:
+                self.swaps.get(station_id, {}).pop(transaction_id, None)
+            for station in stock:
+                self.stock[station.charging_station_id] = station
+            # only the stations swapped at are trimmed; read ignores old swaps of the others
+            for station_id in set(station_id for station_id, transaction_id, timestamp in added):
+                swaps = self.swaps[station_id]
+                for transaction_id in [t for t, timestamp in swaps.items() if timestamp < trim_before]:
+                    del swaps[transaction_id]
+
+    def replace(self, added, stock, trim_before):
+        with self.lock:
+            self.swaps = {}
+            self.stock = {}
+        self.apply(added, [], stock, trim_before)
+
+    def read(self, since):
+        with self.lock:
+            return [StationCounts(station.charging_station_id, station.name,
+                        sum(1 for timestamp in self.swaps.get(station.charging_station_id, {}).values() if timestamp >= since),
+                        station.battery_count, station.energy_on_hand)
+                    for station in self.stock.values()]
+
+
+class RedisBackend():
+    '''
+    Counters in Redis: a set of the station ids, a hash of each station's
+    stock and a sorted set of each station's recent swaps
+    '''
+    STATIONS_KEY = 'station-counters:stations'
+
+    def __init__(self, url=None, client=None):
+        if client is None:
+            import redis
+            client = redis.StrictRedis.from_url(url)
+        self.client = client
+
+    def _swaps_key(self, station_id):
+        return 'station-counters:swaps:{}'.format(station_id)
+
+    def _stock_key(self, station_id):
+        return 'station-counters:stock:{}'.format(station_id)
+
+    def apply(self, added, removed, stock, trim_before, pipeline=None):
+        pipe = pipeline or self.client.pipeline(transaction=False)
+        stations = set()
+        for station_id, transaction_id, timestamp in added:
+            pipe.zadd(self._swaps_key(station_id), {transaction_id: timestamp})
+            stations.add(station_id)
+        for station_id, transaction_id in removed:
+            pipe.zrem(self._swaps_key(station_id), transaction_id)
+        for station in stock:
+            pipe.hset(self._stock_key(station.charging_station_id), mapping={
+                'name': station.name, 'battery_count': station.battery_count, 'energy_on_hand': station.energy_on_hand})
+            stations.add(station.charging_station_id)
+        if stations:
+            pipe.sadd(self.STATIONS_KEY, *stations)
+        for station_id in set(station_id for station_id, transaction_id, timestamp in added):
+            pipe.zremrangebyscore(self._swaps_key(station_id), '-inf', '({}'.format(trim_before))
+        if not pipeline:
+            pipe.execute()
+
+    def replace(self, added, stock, trim_before):
+        station_ids = [int(station_id) for station_id in self.client.smembers(self.STATIONS_KEY)]
+        pipe = self.client.pipeline(transaction=True)
+        for station_id in station_ids:
+            pipe.delete(self._swaps_key(station_id), self._stock_key(station_id))
+        pipe.delete(self.STATIONS_KEY)
+        self.apply(added, [], stock, trim_before, pipe)
+        pipe.execute()
+
+    def read(self, since):
+        station_ids = sorted(int(station_id) for station_id in self.client.smembers(self.STATIONS_KEY))
+        pipe = self.client.pipeline(transaction=False)
+        for station_id in station_ids:
+            pipe.hgetall(self._stock_key(station_id))
+            pipe.zcount(self._swaps_key(station_id), since, '+inf')
+        results = pipe.execute()
+        counts = []
+        for i, station_id in enumerate(station_ids):
+            stock, swaps = results[2 * i], results[2 * i + 1]
+            counts.append(StationCounts(station_id, stock.get(b'name', b'').decode('utf-8'), swaps,
+                int(stock.get(b'battery_count', 0)), int(stock.get(b'energy_on_hand', 0))))
+        return counts
+
+
+class StationCounters():
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('STATION_COUNTERS', 'none')
+        app.config.setdefault('STATION_COUNTERS_WINDOW', 60 * 60)
+        backend = app.config['STATION_COUNTERS']
+        if backend == 'redis':
+            backend = RedisBackend(app.config['STATION_COUNTERS_REDIS_URL'])
+        elif backend == 'simple':
+            backend = SimpleBackend()
+        else:
+            backend = None
+        app.extensions['station_counters'] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions.get('station_counters')
+
+    def record(self, session, transaction, correction=None, stock=()):
+        '''
+        Counts the swap, and updates the StationStock of its stations, once the session commits
+        '''
+        if not self.backend:
+            return
+        pending = session.info.setdefault(PENDING_KEY, {'added': [], 'removed': [], 'stock': {}})
+        if transaction.charging_station_id:
+            pending['added'].append((transaction.charging_station_id, transaction.id, _timestamp(transaction.transaction_date)))
+        if correction and correction.charging_station_id:
+            pending['removed'].append((correction.charging_station_id, correction.id))
+        pending['stock'].update((station.charging_station_id, station) for station in stock)
+
+    def counts(self, now=None):
+        '''
+        Returns the StationCounts of every station, by name
+        '''
+        if not self.backend:
+            return []
+        since = (now or time()) - current_app.config['STATION_COUNTERS_WINDOW']
+        return sorted(self.backend.read(since), key=lambda counts: counts.name)
+
+    def rebuild(self, session, now=None):
+        '''
+        Replaces the counters with the recent swaps and the stock from the database
+        '''
+        from app.models import BatteryTransaction
+        if not self.backend:
+            return
+        now = now or datetime.utcnow()
+        since = now - timedelta(seconds=current_app.config['STATION_COUNTERS_WINDOW'])
+        added = [(station_id, transaction_id, _timestamp(transaction_date))
+                for station_id, transaction_id, transaction_date in session.query(
+                    BatteryTransaction.charging_station_id, BatteryTransaction.id, BatteryTransaction.transaction_date)\
+                            .filter(BatteryTransaction.rejected.is_(False),
+                                BatteryTransaction.charging_station_id.isnot(None),
+                                BatteryTransaction.transaction_date >= since)]
+        self.backend.replace(added, station_stock(session), _timestamp(since))
+
+    def _apply(self, session):
+        pending = session.info.pop(PENDING_KEY, None)
+        if pending and self.backend:
+            trim_before = time() - current_app.config['STATION_COUNTERS_WINDOW']
+            self.backend.apply(pending['added'], pending['removed'], pending['stock'].values(), trim_before)
+
+
+def station_stock(session, charging_station_ids=None):
+    '''
+    Returns the StationStock of the given stations, or of every station, from their ChargingStationState
+
+    Read before the session commits, as nothing can be read once it has
+    '''
+    from app.models import ChargingStation, ChargingStationState
+    if charging_station_ids is not None and not charging_station_ids:
+        return []
+    query = session.query(ChargingStation.id, ChargingStation.name,
+            ChargingStationState.battery_count, ChargingStationState.energy_on_hand)\
+                    .outerjoin(ChargingStationState, ChargingStationState.charging_station_id == ChargingStation.id)
+    if charging_station_ids is not None:
+        query = query.filter(ChargingStation.id.in_(list(charging_station_ids)))
+    return [StationStock(station_id, name, battery_count or 0, energy_on_hand or 0)
+            for station_id, name, battery_count, energy_on_hand in query]
+
+
+station_counters = StationCounters()
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def count_committed(session):
+    station_counters._apply(session)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_rolled_back(session):
+    session.info.pop(PENDING_KEY, None)
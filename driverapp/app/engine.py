@@ -0,0 +1,135 @@
+'''
+Engine and connection pool configuration
+
+Flask-SQLAlchemy applies the pool size, overflow, timeout and recycle settings
+itself; everything else in the SQLALCHEMY_POOL_* and SQLALCHEMY_STATEMENT_TIMEOUT
+config is applied here, by listening to events on each engine as it is created.
+'''
+import os
+import weakref
+import flask_sqlalchemy
+from sqlalchemy import event, exc, orm, select
+from sqlalchemy.pool import NullPool
+from app.routing import RoutingSession
+
+# connections inherited from a parent process are kept referenced here, instead
+# of being closed, since closing them would also close the parent's connection
+_inherited_connections = []
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    def __init__(self, *args, **kwargs):
+        super(SQLAlchemy, self).__init__(*args, **kwargs)
+        self._configured_engines = weakref.WeakSet()
+
+    def apply_pool_defaults(self, app, options):
+        super(SQLAlchemy, self).apply_pool_defaults(app, options)
+        if app.config.get('SQLALCHEMY_PGBOUNCER'):
+            # PgBouncer is the pool; holding connections here would only pin server connections
+            options['poolclass'] = NullPool
+            for option in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(option, None)
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername == 'sqlite':
+            # sqlite files do not use a queue pool, so the pool sizes do not apply
+            for option in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(option, None)
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_engine(self, app=None, bind=None):
+        engine = super(SQLAlchemy, self).get_engine(app, bind)
+        if engine not in self._configured_engines:
+            configure_engine(engine, self.get_app(app).config)
+            self._configured_engines.add(engine)
+        return engine
+
+
+def configure_engine(engine, config):
+    '''
+    Adds fork safety, pre-ping and statement timeouts to an engine
+    '''
+    event.listen(engine, 'connect', _record_pid)
+    event.listen(engine, 'checkout', _check_pid)
+
+    if config.get('SQLALCHEMY_POOL_PRE_PING'):
+        event.listen(engine, 'engine_connect', _ping_connection)
+
+    timeout = config.get('SQLALCHEMY_STATEMENT_TIMEOUT')
+    if timeout and engine.dialect.name == 'postgresql':
+        if config.get('SQLALCHEMY_PGBOUNCER'):
+            # session settings would leak to other clients of the same server connection
+            event.listen(engine, 'begin', _set_local_statement_timeout(timeout))
+        else:
+            event.listen(engine, 'connect', _set_statement_timeout(timeout))
+
+
+def dispose_engines(app, db):
+    '''
+    Closes every pooled connection of the app's engines
+
+    Call this in a parent process before it forks workers,
+    so that no connection is inherited by the workers
+    '''
+    with app.app_context():
+        db.get_engine(app).dispose()
+        for bind in app.config.get('SQLALCHEMY_BINDS') or ():
+            db.get_engine(app, bind).dispose()
+
+
+def _record_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    '''
+    Connections can not be shared between processes, so a connection
+    created before a fork is replaced with a new one in the child
+    '''
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        _inherited_connections.append(dbapi_connection)
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+                'Connection belongs to pid {}, attempting to check out in pid {}'.format(
+                    connection_record.info['pid'], pid))
+
+
+def _ping_connection(connection, branch):
+    '''
+    Tests a connection as it is checked out,
+    so that connections dropped by the server are replaced before use
+    '''
+    if branch:
+        return
+
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as err:
+        # the whole pool is invalidated when the connection was stale, so try once more
+        if err.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+def _set_statement_timeout(timeout):
+    def set_statement_timeout(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SET statement_timeout = {:d}'.format(timeout))
+        cursor.close()
+        dbapi_connection.commit()
+    return set_statement_timeout
+
+
+def _set_local_statement_timeout(timeout):
+    def set_local_statement_timeout(connection):
+        connection.execute('SET LOCAL statement_timeout = {:d}'.format(timeout))
+    return set_local_statement_timeout
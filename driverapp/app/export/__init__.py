@@ -0,0 +1,5 @@
+from flask import Blueprint
+
+bp = Blueprint('export', __name__)
+
+from app.export import routes
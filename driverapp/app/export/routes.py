@@ -0,0 +1,44 @@
+from datetime import datetime
+from flask import Response, abort, request, stream_with_context
+from flask_login import login_required
+from app.export import bp
+from app.controllers.exports import EXPORTS, FORMATS, HAS_PYARROW
+from app.routing import replica_reads
+
+
+def _date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        abort(400)
+
+
+@bp.route('/<any(transactions, summaries):export>.<any(csv, parquet):export_format>', methods=['GET'])
+@login_required
+@replica_reads
+def export(export, export_format):
+    '''
+    Streams transactions or summaries as csv or parquet
+
+    Filtered by the start and end (YYYY-MM-DD), driver_id and
+    charging_station_id (transactions only) query arguments
+    '''
+    if export_format == 'parquet' and not HAS_PYARROW:
+        abort(404)
+
+    filters = {
+        'start_date': _date_arg('start'),
+        'end_date': _date_arg('end'),
+        'driver_id': request.args.get('driver_id', type=int),
+    }
+    if export == 'transactions':
+        filters['charging_station_id'] = request.args.get('charging_station_id', type=int)
+
+    columns, rows = EXPORTS[export]
+    mimetype, chunks = FORMATS[export_format]
+    return Response(stream_with_context(chunks(columns, rows(**filters))),
+            mimetype=mimetype,
+            headers={'Content-Disposition': 'attachment; filename={}.{}'.format(export, export_format)})
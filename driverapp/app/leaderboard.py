@@ -0,0 +1,352 @@
+'''
+Driver leaderboard, by efficiency (km/kWh) over a week or a month
+
+Managers rank drivers by their ride distance over energy used in a week (from
+Monday) or a calendar month. Rather than totalling every swap for a ranking,
+each period of a window is a sorted set of driver ids scored by efficiency,
+with a hash of the totals each score was computed from, so the top drivers and
+a driver's rank are ZREVRANGE and ZREVRANK, logarithmic in the number of drivers.
+
+Any change to a DriverSummary, through a swap, a correction, a rebuild or an
+import, marks its driver's periods. Before the session commits their totals
+are read from the summaries, and once it commits they replace the driver's
+entries, so applying them twice is harmless and a rolled back change is never
+ranked. Drivers who used no energy in a period are not ranked, and periods
+which ended more than LEADERBOARD_RETENTION days ago are not kept.
+
+The leaderboard is a cache of the summaries; flask rebuild-leaderboard
+recomputes it. It is kept in Redis when LEADERBOARD_REDIS_URL is set, and not
+kept at all otherwise; an in process leaderboard (simple) only sees its own
+process's changes, and is for development and tests.
+'''
+import threading
+from bisect import bisect_left, insort
+from calendar import timegm
+from collections import namedtuple
+from datetime import datetime, timedelta
+from time import time
+from flask import current_app, has_app_context
+from sqlalchemy import event, func
+from app.routing import RoutingSession
+
+# session.info keys of the driver summaries changed, and of the totals to rank once it commits
+CHANGED_KEY = 'leaderboard_changed'
+PENDING_KEY = 'leaderboard'
+
+# a driver's place in a period, from 1
+Standing = namedtuple('Standing', ['rank', 'driver_id', 'efficiency', 'ride_distance', 'energy_used'])
+# a driver's totals over a period
+PeriodTotals = namedtuple('PeriodTotals', ['window', 'start_date', 'driver_id', 'ride_distance', 'energy_used'])
+
+
+def _day(date):
+    return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def week_start(date):
+    return _day(date) - timedelta(days=date.weekday())
+
+
+def week_end(start_date):
+    return start_date + timedelta(days=7)
+
+
+def month_start(date):
+    return _day(date).replace(day=1)
+
+
+def month_end(start_date):
+    if start_date.month == 12:
+        return start_date.replace(year=start_date.year + 1, month=1)
+    return start_date.replace(month=start_date.month + 1)
+
+
+# the start of the period holding a date, and the end of a period, of each window
+WINDOWS = {
+    'week': (week_start, week_end),
+    'month': (month_start, month_end),
+}
+
+
+def period_start(window, date):
+    return WINDOWS[window][0](date)
+
+
+def period_end(window, start_date):
+    return WINDOWS[window][1](start_date)
+
+
+def _timestamp(date):
+    # summary dates are naive UTC
+    return timegm(date.utctimetuple())
+
+
+def _efficiency(ride_distance, energy_used):
+    return ride_distance / energy_used
+
+
+class _SimplePeriod():
+    '''
+    The drivers of a period, ranked in a sorted list of (-efficiency, driver_id)
+    '''
+    def __init__(self):
+        self.ranked = []
+        self.totals = {}
+
+    def set(self, driver_id, ride_distance, energy_used):
+        if driver_id in self.totals:
+            old = self.totals.pop(driver_id)
+            if old[1] > 0:
+                del self.ranked[bisect_left(self.ranked, (-_efficiency(*old), driver_id))]
+        if energy_used > 0:
+            insort(self.ranked, (-_efficiency(ride_distance, energy_used), driver_id))
+            self.totals[driver_id] = (ride_distance, energy_used)
+
+    def standing(self, index, driver_id):
+        ride_distance, energy_used = self.totals[driver_id]
+        return Standing(index + 1, driver_id, round(_efficiency(ride_distance, energy_used), 2), ride_distance, energy_used)
+
+
+class SimpleBackend():
+    '''
+    In process leaderboard
+    '''
+    def __init__(self):
+        self.periods = {}
+        self.lock = threading.Lock()
+
+    def apply(self, totals, retention):
+        with self.lock:
+            for window, start_date, driver_id, ride_distance, energy_used in totals:
+                self.periods.setdefault((window, start_date), _SimplePeriod()).set(driver_id, ride_distance, energy_used)
+            expired = time() - retention
+            for window, start_date in list(self.periods):
+                if _timestamp(period_end(window, start_date)) < expired:
+                    del self.periods[(window, start_date)]
+
+    def replace(self, window, start_date, totals, retention):
+        with self.lock:
+            self.periods.pop((window, start_date), None)
+        self.apply(totals, retention)
+
+    def top(self, window, start_date, count):
+        with self.lock:
+            period = self.periods.get((window, start_date))
+            if not period:
+                return []
+            return [period.standing(i, driver_id) for i, (score, driver_id) in enumerate(period.ranked[:count])]
+
+    def rank(self, window, start_date, driver_id):
+        with self.lock:
+            period = self.periods.get((window, start_date))
+            if not period or driver_id not in period.totals:
+                return None
+            index = bisect_left(period.ranked, (-_efficiency(*period.totals[driver_id]), driver_id))
+            return period.standing(index, driver_id)
+
+
+class RedisBackend():
+    '''
+    A sorted set of driver ids scored by efficiency for each period,
+    and a hash of each driver's "ride_distance,energy_used"
+    '''
+    def __init__(self, url=None, client=None):
+        if client is None:
+            import redis
+            client = redis.StrictRedis.from_url(url)
+        self.client = client
+
+    def _key(self, window, start_date):
+        return 'leaderboard:{}:{:%Y-%m-%d}'.format(window, start_date)
+
+    def _totals_key(self, window, start_date):
+        return 'leaderboard:{}:{:%Y-%m-%d}:totals'.format(window, start_date)
+
+    def apply(self, totals, retention, pipeline=None):
+        pipe = pipeline or self.client.pipeline(transaction=False)
+        periods = set()
+        for window, start_date, driver_id, ride_distance, energy_used in totals:
+            key = self._key(window, start_date)
+            if energy_used > 0:
+                pipe.zadd(key, {driver_id: _efficiency(ride_distance, energy_used)})
+                pipe.hset(self._totals_key(window, start_date), driver_id, '{},{}'.format(ride_distance, energy_used))
+            else:
+                pipe.zrem(key, driver_id)
+                pipe.hdel(self._totals_key(window, start_date), driver_id)
+            periods.add((window, start_date))
+        for window, start_date in periods:
+            expire_at = _timestamp(period_end(window, start_date)) + retention
+            pipe.expireat(self._key(window, start_date), expire_at)
+            pipe.expireat(self._totals_key(window, start_date), expire_at)
+        if not pipeline:
+            pipe.execute()
+
+    def replace(self, window, start_date, totals, retention):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(self._key(window, start_date), self._totals_key(window, start_date))
+        self.apply(totals, retention, pipe)
+        pipe.execute()
+
+    def top(self, window, start_date, count):
+        entries = self.client.zrevrange(self._key(window, start_date), 0, count - 1, withscores=True)
+        if not entries:
+            return []
+        totals = self.client.hmget(self._totals_key(window, start_date), [driver_id for driver_id, score in entries])
+        return [self._standing(i, driver_id, score, driver_totals)
+                for i, ((driver_id, score), driver_totals) in enumerate(zip(entries, totals))]
+
+    def rank(self, window, start_date, driver_id):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zrevrank(self._key(window, start_date), driver_id)
+        pipe.zscore(self._key(window, start_date), driver_id)
+        pipe.hget(self._totals_key(window, start_date), driver_id)
+        index, score, totals = pipe.execute()
+        if index is None:
+            return None
+        return self._standing(index, driver_id, score, totals)
+
+    def _standing(self, index, driver_id, score, totals):
+        ride_distance, energy_used = (int(total) for total in (totals or b'0,0').split(b','))
+        return Standing(index + 1, int(driver_id), round(score, 2), ride_distance, energy_used)
+
+
+class Leaderboard():
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LEADERBOARD', 'none')
+        app.config.setdefault('LEADERBOARD_RETENTION', 366)
+        backend = app.config['LEADERBOARD']
+        if backend == 'redis':
+            backend = RedisBackend(app.config['LEADERBOARD_REDIS_URL'])
+        elif backend == 'simple':
+            backend = SimpleBackend()
+        else:
+            backend = None
+        app.extensions['leaderboard'] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions.get('leaderboard')
+
+    @property
+    def retention(self):
+        return current_app.config['LEADERBOARD_RETENTION'] * 24 * 60 * 60
+
+    def top(self, window, count=10, date=None):
+        '''
+        Returns the Standings of the count most efficient drivers in the window's period holding date
+        '''
+        if not self.backend:
+            return []
+        return self.backend.top(window, period_start(window, date or datetime.utcnow()), count)
+
+    def rank(self, window, driver_id, date=None):
+        '''
+        Returns the driver's Standing in the window's period holding date, or None if it is not ranked
+        '''
+        if not self.backend:
+            return None
+        return self.backend.rank(window, period_start(window, date or datetime.utcnow()), driver_id)
+
+    def rebuild(self, session, periods=2, now=None):
+        '''
+        Replaces the current and the periods - 1 before it, of every window, with the
+        totals of the summaries, and returns the number of drivers ranked in each
+        '''
+        if not self.backend:
+            return {}
+        now = now or datetime.utcnow()
+        ranked = {}
+        for window in sorted(WINDOWS):
+            start_date = period_start(window, now)
+            for i in range(periods):
+                totals = period_totals(session, window, start_date)
+                self.backend.replace(window, start_date, totals, self.retention)
+                ranked[(window, start_date)] = sum(1 for t in totals if t.energy_used > 0)
+                start_date = period_start(window, start_date - timedelta(days=1))
+        return ranked
+
+    def _record_changes(self, session):
+        if not has_app_context() or not self.backend:
+            return
+        from app.models import DriverSummary
+        changed = session.info.setdefault(CHANGED_KEY, set())
+        for summary in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(summary, DriverSummary):
+                driver_id = summary.driver_id or (summary.driver.id if summary.driver else None)
+                if driver_id:
+                    changed.add((driver_id, summary.start_date))
+
+    def _read_totals(self, session):
+        '''
+        Reads the totals of the periods holding the changed summaries,
+        before the session commits, as nothing can be read once it has
+        '''
+        if not session.info.get(CHANGED_KEY):
+            return
+        # the last changes are only seen once they are flushed
+        session.flush()
+        changed = session.info.pop(CHANGED_KEY)
+        expired = datetime.utcnow() - timedelta(seconds=self.retention)
+        periods = {}
+        for driver_id, date in changed:
+            for window in WINDOWS:
+                start_date = period_start(window, date)
+                if period_end(window, start_date) >= expired:
+                    periods.setdefault((window, start_date), set()).add(driver_id)
+        pending = session.info.setdefault(PENDING_KEY, [])
+        for (window, start_date), driver_ids in sorted(periods.items()):
+            pending.extend(period_totals(session, window, start_date, driver_ids))
+
+    def _apply(self, session):
+        pending = session.info.pop(PENDING_KEY, None)
+        if pending and self.backend:
+            self.backend.apply(pending, self.retention)
+
+
+def period_totals(session, window, start_date, driver_ids=None):
+    '''
+    Returns the PeriodTotals of the given drivers, or of every driver with
+    summaries, in the window's period starting at start_date
+    '''
+    from app.models import DriverSummary
+    query = session.query(DriverSummary.driver_id,
+            func.sum(DriverSummary.ride_distance), func.sum(DriverSummary.energy_used))\
+                    .filter(DriverSummary.start_date >= start_date,
+                            DriverSummary.start_date < period_end(window, start_date))\
+                    .group_by(DriverSummary.driver_id)
+    if driver_ids is not None:
+        query = query.filter(DriverSummary.driver_id.in_(list(driver_ids)))
+    totals = dict((driver_id, (ride_distance or 0, energy_used or 0)) for driver_id, ride_distance, energy_used in query)
+    # drivers without summaries left in the period are removed
+    for driver_id in driver_ids or ():
+        totals.setdefault(driver_id, (0, 0))
+    return [PeriodTotals(window, start_date, driver_id, ride_distance, energy_used)
+            for driver_id, (ride_distance, energy_used) in sorted(totals.items())]
+
+
+leaderboard = Leaderboard()
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def record_summary_changes(session, flush_context, instances):
+    leaderboard._record_changes(session)
+
+
+@event.listens_for(RoutingSession, 'before_commit')
+def read_period_totals(session):
+    leaderboard._read_totals(session)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def rank_committed(session):
+    leaderboard._apply(session)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_rolled_back(session):
+    session.info.pop(CHANGED_KEY, None)
+    session.info.pop(PENDING_KEY, None)
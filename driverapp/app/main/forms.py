@@ -1,6 +1,7 @@
+from uuid import uuid4
 from flask import request
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, TextAreaField, SelectField, IntegerField
+from wtforms import StringField, SubmitField, TextAreaField, SelectField, IntegerField, HiddenField
 from wtforms.validators import ValidationError, DataRequired, Length
 from app.models import User
 
@@ -40,6 +41,8 @@ class BatteryTransactionForm(FlaskForm):
     odometer_reading = IntegerField('Enter odometer reading', validators=[DataRequired()])
     battery_in_energy = IntegerField('Battery in energy', validators=[DataRequired()])
     battery_out_energy = IntegerField('Battery out energy', validators=[DataRequired()])
+    # generated when the form is shown, so submitting it again does not add another swap
+    idempotency_key = HiddenField(default=lambda: uuid4().hex, validators=[Length(max=64)])
  
     submit = SubmitField('Submit')
 
@@ -1,14 +1,34 @@
 from datetime import datetime
 from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app
+    jsonify, current_app, abort, Response, stream_with_context
 from flask_login import current_user, login_required
+from werkzeug.urls import url_parse
 from app import db
 from app.main.forms import EditProfileForm, EmptyForm, DriverForm, ChargingStationForm, BatteryForm, BatteryTransactionForm, BatteryTransactionEditForm
-from app.models import User, Person, Driver, Vehicle, ChargingStation, Battery, BatteryTransaction, DriverSummary
+from app.models import User, Person, Driver, Vehicle, ChargingStation, Battery, BatteryTransaction, DriverSummary, \
+        ChargingStationState, DriverState, BatteryTransactionArchive
 from app.main import bp
+from app.routing import replica_reads
 from datetime import datetime, timedelta
 
-from app.controllers.transactions import add_transaction
+from app.controllers.transactions import add_transaction, add_transaction_once, submitted_transaction, \
+        lock_objects, retry_on_conflict
+from app.controllers.validation import TransactionValidationError
+from app.controllers.summaries import get_summaries
+from app.controllers.fleet import driver_list, charging_station_list
+from app.controllers.search import search_drivers
+from app.controllers.archive import with_archived
+from app.cache import fragment_cache, lazy
+from app.counters import station_counters
+from app.leaderboard import leaderboard, WINDOWS, period_start, period_end
+from app.broadcast import broadcaster, station_channel, driver_channel
+
+# history entries shown on the battery page, unless the limit argument is given
+BATTERY_HISTORY_LIMIT = 1000
+# seconds between refreshes of the dashboard counters
+DASHBOARD_REFRESH = 5
+# drivers shown on the leaderboard, unless the limit argument is given
+LEADERBOARD_SIZE = 20
                 
 @bp.before_app_request
 def before_request():
@@ -23,8 +43,9 @@ def index():
 
 @bp.route('/drivers/', methods=['GET'])
 @login_required
+@replica_reads
 def drivers():
-    drivers = Driver.query.all()
+    drivers = driver_list()
     return render_template('drivers.html', title='Home', drivers=drivers)
 
 '''
@@ -59,65 +80,209 @@ def edit_driver(driver_id):
 '''
 
 
+def selected_driver_choices(driver_id):
+    '''
+    Choices for a driver select which only has the selected driver
+    '''
+    driver = Driver.query.get(int(driver_id)) if str(driver_id or '').isdigit() else None
+    return [(str(driver.id), driver.display_name)] if driver else []
+
+@bp.route('/drivers/search/', methods=['GET'])
+@login_required
+@replica_reads
+def driver_search():
+    drivers = search_drivers(request.args.get('q', ''))
+    return jsonify(drivers=[{'id': driver_id, 'name': name, 'phone_number': phone_number}
+        for driver_id, name, phone_number in drivers])
+
+
 @bp.route('/driver/<int:driver_id>/', methods=['GET'])
 @login_required
+@replica_reads
 def driver_detail(driver_id):
+    '''
+    The driver's history, including its archived transactions if the archived argument is 1
+    '''
     driver = Driver.query.filter_by(id=driver_id).first_or_404()
+    archived = request.args.get('archived', 0, type=int)
     transactions = BatteryTransaction.query.filter(
             BatteryTransaction.driver == driver,
             BatteryTransaction.rejected.is_(False))\
                     .order_by(BatteryTransaction.transaction_date.asc())
-    summaries = DriverSummary.query.filter_by(driver_id=driver_id)
-    return render_template('driver_detail.html', driver=driver, transactions=transactions, summaries=summaries)
+    # only loaded if the rendered tables are not cached
+    if archived:
+        transactions = lazy(with_archived, transactions, BatteryTransactionArchive.driver_id == driver.id)
+    summaries = lazy(get_summaries, driver)
+    standings = [(window, leaderboard.rank(window, driver.id)) for window in sorted(WINDOWS)]
+    return render_template('driver_detail.html', driver=driver, transactions=transactions, summaries=summaries,
+            standings=standings, archived=archived, fragment_key=driver_fragment_key(driver, archived),
+            events_url=url_for('main.driver_events', driver_id=driver.id) if broadcaster.streams else None)
+
+@bp.route('/driver/<int:driver_id>/events/', methods=['GET'])
+@login_required
+def driver_events(driver_id):
+    Driver.query.filter_by(id=driver_id).first_or_404()
+    return _event_stream([driver_channel(driver_id)])
+
+
+def driver_fragment_key(driver, archived=False):
+    '''
+    Cache key for the driver's history tables, as of their version,
+    with or without its archived transactions
+    '''
+    version = db.session.query(DriverState.history_version).filter(DriverState.driver_id == driver.id).scalar()
+    return fragment_cache.key('driver', driver.id, '{}{}'.format(version, '-archived' if archived else ''))
 
 
 @bp.route('/charging_stations/', methods=['GET'])
 @login_required
 def charging_stations():
-    charging_stations = ChargingStation.query.all()
+    charging_stations = charging_station_list()
     return render_template('charging_stations.html', title='Home', charging_stations=charging_stations)
 
+@bp.route('/dashboard/', methods=['GET'])
+@login_required
+def dashboard():
+    return render_template('dashboard.html', title='Dashboard', stations=station_counters.counts(),
+            refresh=DASHBOARD_REFRESH)
+
+@bp.route('/dashboard/stations/', methods=['GET'])
+@login_required
+def dashboard_stations():
+    '''
+    Swaps in the last hour and stock of every station, read only from the counters
+    '''
+    return jsonify({'stations': [counts._asdict() for counts in station_counters.counts()]})
+
+@bp.route('/leaderboard/', methods=['GET'])
+@login_required
+def leaderboard_page():
+    '''
+    The most efficient drivers of the week or month (the window argument)
+    holding the date argument (YYYY-MM-DD, today by default), read only from the leaderboard
+    '''
+    window = request.args.get('window', 'week')
+    if window not in WINDOWS:
+        abort(400)
+    start_date = period_start(window, _date_arg('date') or datetime.utcnow())
+    standings = leaderboard.top(window, request.args.get('limit', LEADERBOARD_SIZE, type=int), start_date)
+    drivers = dict((driver.id, driver) for driver in
+            Driver.query.filter(Driver.id.in_([standing.driver_id for standing in standings]))) if standings else {}
+    return render_template('leaderboard.html', title='Leaderboard', window=window, windows=sorted(WINDOWS),
+            start_date=start_date, end_date=period_end(window, start_date), standings=standings, drivers=drivers)
+
 @bp.route('/charging_station/<int:charging_station_id>/', methods=['GET'])
 @login_required
 def charging_station_detail(charging_station_id):
+    '''
+    The station's stock and history, including its archived transactions if the archived argument is 1
+    '''
     charging_station = ChargingStation.query.filter_by(id=charging_station_id).first_or_404()
+    archived = request.args.get('archived', 0, type=int)
     transactions = BatteryTransaction.query.filter(
             BatteryTransaction.charging_station==charging_station,
             BatteryTransaction.rejected.is_(False))\
                     .order_by(BatteryTransaction.transaction_date.asc())
+    if archived:
+        transactions = with_archived(transactions, BatteryTransactionArchive.charging_station_id == charging_station.id)
     batteries = Battery.query.filter_by(charging_station=charging_station)
-    return render_template('charging_station_detail.html', charging_station=charging_station, batteries=batteries, transactions=transactions)
+    state = ChargingStationState.query.filter_by(charging_station_id=charging_station.id).first()
+    return render_template('charging_station_detail.html', charging_station=charging_station, batteries=batteries,
+            transactions=transactions, state=state, archived=archived,
+            events_url=url_for('main.charging_station_events', charging_station_id=charging_station.id) if broadcaster.streams else None)
+
+@bp.route('/charging_station/<int:charging_station_id>/events/', methods=['GET'])
+@login_required
+def charging_station_events(charging_station_id):
+    ChargingStation.query.filter_by(id=charging_station_id).first_or_404()
+    return _event_stream([station_channel(charging_station_id)])
+
+def _event_stream(channels):
+    '''
+    Server-sent events of the swaps on the channels
+    '''
+    if not broadcaster.streams:
+        abort(404)
+    # the stream stays open as long as the page, without holding a database connection
+    db.session.remove()
+    return Response(stream_with_context(broadcaster.stream(channels)), mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @bp.route('/battery/<int:battery_id>/', methods=['GET'])
 @login_required
+@replica_reads
 def battery_detail(battery_id):
+    '''
+    The battery's history, latest first, filtered by the start and end
+    (YYYY-MM-DD, end is exclusive) and limit query arguments, and
+    including its archived transactions if the archived argument is 1
+
+    The page is streamed as the history is read, a batch at a time
+    '''
     battery = Battery.query.filter_by(id=battery_id).first_or_404()
-    battery_history = Battery.get_history(battery)
-    return render_template('battery_detail.html', battery=battery, battery_history=battery_history)
+    start_date = _date_arg('start')
+    end_date = _date_arg('end')
+    limit = request.args.get('limit', BATTERY_HISTORY_LIMIT, type=int)
+    archived = request.args.get('archived', 0, type=int)
+    battery_history = battery.iter_history(start_date, end_date, limit, archived=archived)
+    return Response(stream_with_context(_stream_template('battery_detail.html',
+            battery=battery, battery_history=battery_history, start_date=start_date, end_date=end_date, limit=limit,
+            archived=archived)))
+
+def _date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        abort(400)
+
+def _stream_template(template_name, **context):
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(50)
+    return stream
+
+def add_form_errors(form, error):
+    '''
+    Shows the errors of an invalid swap on the form fields they concern
+    '''
+    for field, message in error.errors:
+        # the new swap form has no battery in field, as it is the battery on the vehicle
+        getattr(form, field, form.driver_id).errors.append(message)
 
 @bp.route('/transactions/edit/<int:transaction_id>/', methods=['GET', 'POST'])
 @login_required
 def edit_transaction(transaction_id):
     correction = BatteryTransaction.query.filter_by(id=transaction_id).first_or_404()
-    charging_station = correction.charging_station
     form = BatteryTransactionEditForm(obj=correction)
     form.battery_out_id.choices = [(b.id, b.id) for b in Battery.query.all()]
     form.battery_in_id.choices = [(b.id, b.id) for b in Battery.query.all()]
-    form.driver_id.choices = [(d.id, d.display_name) for d in Driver.query.all()]
+    # other drivers are found with the typeahead search
+    form.driver_id.choices = selected_driver_choices(form.driver_id.data)
     if form.validate_on_submit():
-        driver = Driver.query.filter_by(id=form.driver_id.data).first()
-        battery_out = Battery.query.filter_by(id=form.battery_out_id.data).first()
-        battery_in = Battery.query.filter_by(id=form.battery_in_id.data).first()
-        new_transaction = add_transaction(
-                driver = driver,
-                battery_in = battery_in,
-                battery_out = battery_out,
-                charging_station = charging_station,
-                battery_in_energy = form.battery_in_energy.data,
-                battery_out_energy = form.battery_out_energy.data,
-                odometer_reading = form.odometer_reading.data,
-                correction = correction)
-        db.session.commit()
+        def correct():
+            # locked and checked again by add_transaction
+            correction = BatteryTransaction.query.get(transaction_id)
+            driver = Driver.query.filter_by(id=form.driver_id.data).first()
+            battery_out = Battery.query.filter_by(id=form.battery_out_id.data).first()
+            battery_in = Battery.query.filter_by(id=form.battery_in_id.data).first()
+            return add_transaction(
+                    driver = driver,
+                    battery_in = battery_in,
+                    battery_out = battery_out,
+                    charging_station = correction.charging_station,
+                    battery_in_energy = form.battery_in_energy.data,
+                    battery_out_energy = form.battery_out_energy.data,
+                    odometer_reading = form.odometer_reading.data,
+                    correction = correction)
+        try:
+            retry_on_conflict(correct)
+        except TransactionValidationError as err:
+            add_form_errors(form, err)
+            return render_template('wform.html', title='Home', form=form, next=request.path)
         flash('Transaction added')
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
@@ -131,20 +296,33 @@ def new_transaction(charging_station_id):
     charging_station = ChargingStation.query.filter_by(id=charging_station_id).first_or_404()
     form = BatteryTransactionForm()
     form.battery_out_id.choices = [(b.id, b.id) for b in Battery.query.filter_by(charging_station=charging_station)]
-    form.driver_id.choices = [(d.id, d.display_name) for d in Driver.query.all()]
-    if form.validate_on_submit():
-        driver = Driver.query.filter_by(id=form.driver_id.data).first()
-        battery_out = Battery.query.filter_by(id=form.battery_out_id.data).first()
-        new_transaction = add_transaction(
-                driver = driver,
-                battery_in = driver.current_vehicle.battery,
-                battery_out = battery_out,
-                charging_station = charging_station,
-                battery_in_energy = form.battery_in_energy.data,
-                battery_out_energy = form.battery_out_energy.data,
-                odometer_reading = form.odometer_reading.data)
-        db.session.commit()
-        flash('Transaction added')
+    # drivers are found with the typeahead search
+    form.driver_id.choices = [('', '')] + selected_driver_choices(form.driver_id.data)
+    # a resubmitted form is not validated again, as its battery out has left the station
+    submitted = submitted_transaction(form.idempotency_key.data) if form.is_submitted() else None
+    if submitted or form.validate_on_submit():
+        added = False
+        if not submitted:
+            def swap():
+                driver = Driver.query.filter_by(id=form.driver_id.data).first()
+                battery_out = Battery.query.filter_by(id=form.battery_out_id.data).first()
+                # the battery coming in is only known once the vehicle is locked
+                lock_objects([driver], [battery_out])
+                return add_transaction(
+                        driver = driver,
+                        battery_in = driver.current_vehicle.battery,
+                        battery_out = battery_out,
+                        charging_station = charging_station,
+                        battery_in_energy = form.battery_in_energy.data,
+                        battery_out_energy = form.battery_out_energy.data,
+                        odometer_reading = form.odometer_reading.data,
+                        idempotency_key = form.idempotency_key.data or None)
+            try:
+                submitted, added = add_transaction_once(swap, form.idempotency_key.data)
+            except TransactionValidationError as err:
+                add_form_errors(form, err)
+                return render_template('wform.html', title='Home', form=form, next=request.path)
+        flash('Transaction added' if added else 'Transaction {} was already added'.format(submitted.id))
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
             next_page = url_for('main.index')
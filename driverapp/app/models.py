@@ -4,13 +4,18 @@ from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import db, login
 from datetime import datetime, timedelta
-from sqlalchemy.orm import relationship
+import heapq
+from itertools import islice
+from sqlalchemy.orm import relationship, joinedload
 
 from sqlalchemy.ext.declarative import declared_attr
 from flask_login import current_user
 from sqlalchemy.orm import class_mapper
 from sqlalchemy.orm.attributes import get_history
-from sqlalchemy.sql.expression import or_
+from sqlalchemy.sql.expression import or_, and_
+
+# transactions loaded per query when iterating over a battery's history
+HISTORY_BATCH_SIZE = 500
 
 class Base(db.Model):
     """Base model class to implement db columns and features every model should have"""
@@ -81,6 +86,8 @@ class Person(ChangeDataMixin, CreationDataMixin, Base):
     name3 = db.Column(db.String(), index=True, default='')
     # a person can have several phone numbers, but they need to have exactly one primary number
     primary_phone_number = db.Column(db.String(), index=True, nullable=False, unique=True)
+    # when the person was last changed, so the in memory driver search sees renames
+    date_modified = db.Column(db.DateTime, index=True, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     @property
     def display_name(self):
@@ -101,12 +108,10 @@ class Person(ChangeDataMixin, CreationDataMixin, Base):
         first and last tokens, agnostic of name ordering
         '''
         name_tokens = name_str.split()
-        if len(tokens) > 0:
+        if len(name_tokens) > 0:
             self.name1 = name_tokens[0]
-        if len(tokens) > 1:
-            self.name3 = name_tokens[-1]
-        if len(tokens) > 2:
-            self.name2 = name_tokens[1:-1]
+        self.name3 = name_tokens[-1] if len(name_tokens) > 1 else ''
+        self.name2 = ' '.join(name_tokens[1:-1])
 
 
 class Driver(ChangeDataMixin, CreationDataMixin, Base):
@@ -134,6 +139,10 @@ class Vehicle(ChangeDataMixin, CreationDataMixin, Base):
     battery = relationship('Battery', backref='vehicle', uselist=False, lazy='select')
     odometer_reading = db.Column(db.Integer(), default=0)
 
+    # incremented on every update, so an update based on a stale read fails
+    version_id = db.Column(db.Integer(), nullable=False)
+    __mapper_args__ = {'version_id_col': version_id}
+
     @property
     def display_name(self):
         return self.vin
@@ -155,6 +164,10 @@ class Battery(ChangeDataMixin, CreationDataMixin, Base):
     charging_station = relationship('ChargingStation', backref='batteries', lazy='select')
     #last_energy = db.Column(db.Integer(), default=0)
 
+    # incremented on every update, so an update based on a stale read fails
+    version_id = db.Column(db.Integer(), nullable=False)
+    __mapper_args__ = {'version_id_col': version_id}
+
     @property
     def current_energy(self):
         '''
@@ -176,37 +189,106 @@ class Battery(ChangeDataMixin, CreationDataMixin, Base):
         else:
             return last_transaction.battery_out_energy
 
-    def get_history(self):
+    def get_history(self, start_date=None, end_date=None, limit=None, archived=False):
         '''
         Returns all transactions related to this battery
         '''
-        transactions = BatteryTransaction.query.filter(BatteryTransaction.rejected.is_(False), 
-                or_(
-                    BatteryTransaction.battery_in == self,
-                    BatteryTransaction.battery_out == self)
-                )\
-            .order_by(BatteryTransaction.transaction_date.desc()).all()
+        return list(self.iter_history(start_date, end_date, limit, archived=archived))
 
-        return self._get_history(transactions)
+    def iter_history(self, start_date=None, end_date=None, limit=None, batch_size=HISTORY_BATCH_SIZE, archived=False):
+        '''
+        Yields the history of this battery, latest first, from start_date up to
+        (not including) end_date, and at most limit entries, including
+        the archived transactions if archived is set
+
+        Transactions are loaded batch_size at a time, continuing after the last
+        one seen, so only one batch is ever held in memory
+        '''
+        if not archived:
+            for transactions in self._iter_batches(BatteryTransaction, start_date, end_date, limit, batch_size):
+                for entry in self._get_history(transactions):
+                    yield entry
+            return
+
+        # the latest of either table first, until limit entries have been taken from both
+        transactions = heapq.merge(*[
+                (t for batch in self._iter_batches(model, start_date, end_date, limit, batch_size) for t in batch)
+                for model in (BatteryTransaction, BatteryTransactionArchive)],
+                key=lambda t: (t.transaction_date, t.id), reverse=True)
+        batch = []
+        for transaction in islice(transactions, limit):
+            batch.append(transaction)
+            if len(batch) == batch_size:
+                for entry in self._get_history(batch):
+                    yield entry
+                batch = []
+        for entry in self._get_history(batch):
+            yield entry
+
+    def _iter_batches(self, model, start_date, end_date, limit, batch_size):
+        '''
+        Yields batches of the transactions of model (BatteryTransaction
+        or its archive) related to this battery, latest first
+        '''
+        query = model.query\
+                .filter(model.rejected.is_(False),
+                    or_(
+                        model.battery_in_id == self.id,
+                        model.battery_out_id == self.id))
+        if model is BatteryTransaction:
+            query = query.options(joinedload(BatteryTransaction.last_transaction))
+        if start_date:
+            query = query.filter(model.transaction_date >= start_date)
+        if end_date:
+            query = query.filter(model.transaction_date < end_date)
+        query = query.order_by(model.transaction_date.desc(), model.id.desc())
+
+        remaining = limit
+        last = None
+        while remaining is None or remaining > 0:
+            batch_query = query
+            if last:
+                batch_query = batch_query.filter(or_(
+                    model.transaction_date < last.transaction_date,
+                    and_(
+                        model.transaction_date == last.transaction_date,
+                        model.id < last.id)))
+            size = batch_size if remaining is None else min(batch_size, remaining)
+            transactions = batch_query.limit(size).all()
+            yield transactions
+            if len(transactions) < size:
+                return
+            if remaining is not None:
+                remaining -= len(transactions)
+            last = transactions[-1]
 
     def _get_history(self, transactions):
         '''
         For batteries, we want a different format than regular transactions
+
+        The drivers and charging stations of the transactions are loaded together
         '''
+        BatteryTransactionArchive.load_last_transactions(transactions)
+        owners = self._get_owners(transactions)
         history = []
         for transaction in transactions:
-            if transaction.battery_in == self:
-                owner = transaction.charging_station
+            last_transaction = transaction.previous_transaction
+            if transaction.battery_in_id == self.id:
+                owner = owners[ChargingStation, transaction.charging_station_id]
                 energy = transaction.battery_in_energy
                 distance = transaction.ride_distance
                 efficiency = transaction.efficiency
                 charge_amount = ''
             else:
-                owner = transaction.driver
+                owner = owners[Driver, transaction.driver_id]
                 energy = transaction.battery_out_energy
                 distance = ''
                 efficiency = ''
-                charge_amount = transaction.charge_amount
+                # as BatteryTransaction.charge_amount, without loading the batteries
+                if last_transaction and last_transaction.battery_in_id:
+                    charge_amount = last_transaction.battery_in_energy - transaction.battery_out_energy
+                else:
+                    charge_amount = None
 
             history.append({
                 'date': transaction.transaction_date,
@@ -219,33 +301,37 @@ class Battery(ChangeDataMixin, CreationDataMixin, Base):
 
         return history
 
-class BatteryTransaction(ChangeDataMixin, CreationDataMixin, Base):
-    battery_in_id = db.Column(db.Integer, db.ForeignKey('battery.id'), index=True)
-    battery_in = relationship(Battery, lazy='select', foreign_keys='BatteryTransaction.battery_in_id')
-    battery_out_id = db.Column(db.Integer, db.ForeignKey('battery.id'), index=True)
-    battery_out = relationship(Battery, lazy='select', foreign_keys='BatteryTransaction.battery_out_id')
-    
-    driver_id = db.Column(db.Integer, db.ForeignKey('driver.id'), index=True, nullable=False)
-    driver = relationship(Driver, lazy='select')
-
-    charging_station_id = db.Column(db.ForeignKey('charging_station.id'), index=True)
-    charging_station = relationship('ChargingStation', lazy='select')
-
-    battery_in_energy = db.Column(db.Integer())
-    battery_out_energy = db.Column(db.Integer())
-
-    odometer_reading = db.Column(db.Integer())
-
-    rejected = db.Column(db.Boolean(), default='False')
-
-    correction_id = db.Column(db.ForeignKey('battery_transaction.id'), index=True)
-    correction = relationship('BatteryTransaction', foreign_keys='BatteryTransaction.correction_id', uselist=False, lazy='select')
-
-    last_transaction_id = db.Column(db.ForeignKey('battery_transaction.id'), index=True)
-    last_transaction = relationship('BatteryTransaction', foreign_keys='BatteryTransaction.last_transaction_id', remote_side='BatteryTransaction.id')
+    def _get_owners(self, transactions):
+        '''
+        Returns the charging stations the battery was swapped in at,
+        and the drivers it was swapped out to, by (class, id)
+        '''
+        station_ids = set(t.charging_station_id for t in transactions if t.battery_in_id == self.id)
+        driver_ids = set(t.driver_id for t in transactions if t.battery_in_id != self.id)
+        owners = dict(((ChargingStation, station_id), None) for station_id in station_ids)
+        if station_ids:
+            for station in ChargingStation.query.filter(ChargingStation.id.in_(station_ids)):
+                owners[ChargingStation, station.id] = station
+        if driver_ids:
+            for driver in Driver.query.filter(Driver.id.in_(driver_ids)):
+                owners[Driver, driver.id] = driver
+        return owners
+
+class SwapMixin():
+    '''
+    What is derived from a swap and the driver's swap before it, for swaps
+    in battery_transaction and in its archive
+    '''
+    archived = False
 
-    #note that this may be different from date_added
-    transaction_date = db.Column(db.DateTime(), index=True, nullable=False)
+    @property
+    def previous_transaction(self):
+        '''
+        The last transaction, which may have been archived
+        '''
+        if self.last_transaction is not None or self.last_transaction_id is None:
+            return self.last_transaction
+        return BatteryTransactionArchive.query.get(self.last_transaction_id)
 
     @property
     def efficiency(self):
@@ -256,8 +342,9 @@ class BatteryTransaction(ChangeDataMixin, CreationDataMixin, Base):
 
     @property
     def charge_amount(self):
-        if self.last_transaction and self.battery_out and self.last_transaction.battery_in:
-            return self.last_transaction.battery_in_energy - self.battery_out_energy
+        previous = self.previous_transaction
+        if previous and self.battery_out and previous.battery_in:
+            return previous.battery_in_energy - self.battery_out_energy
 
     @property
     def ride_distance(self):
@@ -265,8 +352,9 @@ class BatteryTransaction(ChangeDataMixin, CreationDataMixin, Base):
         if this is not the first transaction for a driver, the distance traveled is
         the odometer reading for the last transaction - this transactions odometer reading
         '''
-        if self.last_transaction:
-            return self.odometer_reading - self.last_transaction.odometer_reading
+        previous = self.previous_transaction
+        if previous:
+            return self.odometer_reading - previous.odometer_reading
         else:
             return 0
 
@@ -277,11 +365,54 @@ class BatteryTransaction(ChangeDataMixin, CreationDataMixin, Base):
         had a battery out, the energy used is
         the last_transaction's battery_out_energy - this transactions battery_in_energy
         '''
-        if self.last_transaction and self.last_transaction.battery_out_energy:
-            return self.last_transaction.battery_out_energy - self.battery_in_energy
+        previous = self.previous_transaction
+        if previous and previous.battery_out_energy:
+            return previous.battery_out_energy - self.battery_in_energy
         else:
             return 0
 
+
+class BatteryTransaction(SwapMixin, ChangeDataMixin, CreationDataMixin, Base):
+    battery_in_id = db.Column(db.Integer, db.ForeignKey('battery.id'), index=True)
+    battery_in = relationship(Battery, lazy='select', foreign_keys='BatteryTransaction.battery_in_id')
+    battery_out_id = db.Column(db.Integer, db.ForeignKey('battery.id'), index=True)
+    battery_out = relationship(Battery, lazy='select', foreign_keys='BatteryTransaction.battery_out_id')
+    
+    driver_id = db.Column(db.Integer, db.ForeignKey('driver.id'), index=True, nullable=False)
+    driver = relationship(Driver, lazy='select')
+
+    charging_station_id = db.Column(db.ForeignKey('charging_station.id'), index=True)
+    charging_station = relationship('ChargingStation', lazy='select')
+
+    battery_in_energy = db.Column(db.Integer())
+    battery_out_energy = db.Column(db.Integer())
+
+    odometer_reading = db.Column(db.Integer())
+
+    rejected = db.Column(db.Boolean(), default=False)
+
+    # not foreign keys, as either may have been moved to the archive; see controllers.archive
+    correction_id = db.Column(db.Integer(), index=True)
+    correction = relationship('BatteryTransaction', uselist=False, lazy='select',
+            primaryjoin='foreign(BatteryTransaction.correction_id) == remote(BatteryTransaction.id)')
+
+    last_transaction_id = db.Column(db.Integer(), index=True)
+    last_transaction = relationship('BatteryTransaction',
+            primaryjoin='foreign(BatteryTransaction.last_transaction_id) == remote(BatteryTransaction.id)')
+
+    #note that this may be different from date_added
+    transaction_date = db.Column(db.DateTime(), index=True, nullable=False)
+
+    # set by the client submitting the swap, so a retried submission is only added once
+    idempotency_key = db.Column(db.String(64), index=True, unique=True)
+
+    # the swaps of a driver or battery just before or after a date, for validating new swaps
+    __table_args__ = (
+        db.Index('ix_battery_transaction_driver_id_transaction_date', 'driver_id', 'transaction_date'),
+        db.Index('ix_battery_transaction_battery_in_id_transaction_date', 'battery_in_id', 'transaction_date'),
+        db.Index('ix_battery_transaction_battery_out_id_transaction_date', 'battery_out_id', 'transaction_date'),
+    )
+
     def add_transaction(self, later_transactions=None, correction=None, transaction_date=None):
         '''
         Aligns derived fields in other objects with this transactions
@@ -304,7 +435,7 @@ class BatteryTransaction(ChangeDataMixin, CreationDataMixin, Base):
 
         for transaction in later_transactions:
             if correction and transaction.last_transaction_id == correction.id:
-                transaction.last_transction = self
+                transaction.last_transaction = self
                 modified.append(transaction)
             transaction.transaction_actions()
         return modified
@@ -349,11 +480,15 @@ class DriverSummary(Base):
     ride_distance = db.Column(db.Integer(), nullable=False)
     energy_used = db.Column(db.Integer(), nullable=False)
 
-    cumulative_ride_distance = db.Column(db.Integer(), nullable=False)
-    cumulative_energy_used = db.Column(db.Integer(), nullable=False)
+    # cumulative totals are not stored, so that a backdated change does not rewrite every later summary
+    # they are derived from DriverSummaryBlock totals; see summaries.get_summaries
+    cumulative_ride_distance = None
+    cumulative_energy_used = None
 
-    last_transaction_id = db.Column(db.ForeignKey('battery_transaction.id'))
-    last_transaction = relationship('BatteryTransaction', foreign_keys='DriverSummary.last_transaction_id')
+    # not a foreign key, as the transaction may have been archived
+    last_transaction_id = db.Column(db.Integer())
+    last_transaction = relationship('BatteryTransaction',
+            primaryjoin='foreign(DriverSummary.last_transaction_id) == BatteryTransaction.id')
 
     def __repr__(self):
         return '<Summary {}: {}-{} for driver {}>'.format(self.id, self.start_date, self.end_date, self.driver)
@@ -365,11 +500,166 @@ class DriverSummary(Base):
     def apply_transaction(self, ride):
         self.ride_distance += ride.ride_distance
         self.energy_used += ride.energy_used
-        self.cumulative_ride_distance += ride.ride_distance
-        self.cumulative_energy_used += ride.energy_used
         self.last_transaction_id = ride.id
 
 
+class DriverSummaryBlock(Base):
+    '''
+    Totals of a driver's summaries over a longer interval (a calendar month)
+
+    Cumulative totals up to any date are the sum of the blocks before it
+    plus the daily summaries in its own block, so a backdated change only
+    touches its own summary and block instead of every later summary
+    '''
+    driver_id = db.Column(db.Integer, db.ForeignKey('driver.id'), index=True, nullable=False)
+    driver = relationship(Driver, lazy='select')
+    start_date = db.Column(db.DateTime(), index=True, nullable=False)
+    end_date = db.Column(db.DateTime(), index=True, nullable=False)
+
+    ride_distance = db.Column(db.Integer(), nullable=False)
+    energy_used = db.Column(db.Integer(), nullable=False)
+
+    def __repr__(self):
+        return '<SummaryBlock {}: {}-{} for driver {}>'.format(self.id, self.start_date, self.end_date, self.driver)
+
+    @classmethod
+    def get_start_date(cls, date):
+        return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def get_end_date(cls, start_date):
+        return (start_date.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+class BatteryTransactionArchive(SwapMixin, Base):
+    '''
+    A rejected or aged swap, moved out of battery_transaction with its id,
+    so references to it by id still find it; see controllers.archive
+    '''
+    __tablename__ = 'battery_transaction_archive'
+    archived = True
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False, nullable=False)
+    battery_in_id = db.Column(db.Integer, db.ForeignKey('battery.id'))
+    battery_in = relationship(Battery, lazy='select', foreign_keys='BatteryTransactionArchive.battery_in_id')
+    battery_out_id = db.Column(db.Integer, db.ForeignKey('battery.id'))
+    battery_out = relationship(Battery, lazy='select', foreign_keys='BatteryTransactionArchive.battery_out_id')
+    driver_id = db.Column(db.Integer, db.ForeignKey('driver.id'), nullable=False)
+    driver = relationship(Driver, lazy='select')
+    charging_station_id = db.Column(db.ForeignKey('charging_station.id'))
+    charging_station = relationship('ChargingStation', lazy='select')
+
+    battery_in_energy = db.Column(db.Integer())
+    battery_out_energy = db.Column(db.Integer())
+    odometer_reading = db.Column(db.Integer())
+    rejected = db.Column(db.Boolean(), default=False)
+    correction_id = db.Column(db.Integer())
+    last_transaction_id = db.Column(db.Integer())
+    transaction_date = db.Column(db.DateTime(), nullable=False)
+
+    date_added = db.Column(db.DateTime)
+    creator_id = db.Column(db.ForeignKey('user.id'))
+    date_archived = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    # a driver's, station's or battery's history, read only when asked for, and the archive horizon
+    __table_args__ = (
+        db.Index('ix_battery_transaction_archive_rejected_transaction_date', 'rejected', 'transaction_date'),
+        db.Index('ix_battery_transaction_archive_charging_station_id_transaction_date', 'charging_station_id', 'transaction_date'),
+        db.Index('ix_battery_transaction_archive_driver_id_transaction_date', 'driver_id', 'transaction_date'),
+        db.Index('ix_battery_transaction_archive_battery_in_id_transaction_date', 'battery_in_id', 'transaction_date'),
+        db.Index('ix_battery_transaction_archive_battery_out_id_transaction_date', 'battery_out_id', 'transaction_date'),
+    )
+
+    # the columns copied from battery_transaction
+    COPIED_COLUMNS = ('id', 'battery_in_id', 'battery_out_id', 'driver_id', 'charging_station_id',
+            'battery_in_energy', 'battery_out_energy', 'odometer_reading', 'rejected', 'correction_id',
+            'last_transaction_id', 'transaction_date', 'date_added', 'creator_id')
+
+    @property
+    def last_transaction(self):
+        if self.last_transaction_id is None:
+            return None
+        if '_last_transaction' not in self.__dict__:
+            self._last_transaction = BatteryTransactionArchive.query.get(self.last_transaction_id) \
+                    or BatteryTransaction.query.get(self.last_transaction_id)
+        return self._last_transaction
+
+    @property
+    def correction(self):
+        if self.correction_id is None:
+            return None
+        return BatteryTransaction.query.get(self.correction_id) \
+                or BatteryTransactionArchive.query.get(self.correction_id)
+
+    def __repr__(self):
+        return '<BatteryTransactionArchive {}>'.format(self.id)
+
+    @classmethod
+    def load_last_transactions(cls, transactions):
+        '''
+        Finds the last transactions of the archived transactions among
+        transactions with one query of each table, instead of one per transaction
+        '''
+        archived = [t for t in transactions if t.archived and t.last_transaction_id is not None]
+        ids = list(set(t.last_transaction_id for t in archived))
+        if not ids:
+            return
+        found = {}
+        for model in (cls, BatteryTransaction):
+            found.update((t.id, t) for t in model.query.filter(model.id.in_(ids)))
+        for transaction in archived:
+            transaction._last_transaction = found.get(transaction.last_transaction_id)
+
+
+class DriverState(Base):
+    '''
+    Read model of what the drivers list shows for a driver, which would
+    otherwise need the history of its transactions
+
+    Maintained by the transaction path, see controllers.fleet
+    '''
+    driver_id = db.Column(db.Integer, db.ForeignKey('driver.id'), index=True, nullable=False, unique=True)
+    # energy of the battery on the driver's vehicle, when it was swapped out
+    battery_energy = db.Column(db.Integer(), nullable=False, default=0)
+    last_transaction_id = db.Column(db.ForeignKey('battery_transaction.id'))
+    last_transaction_date = db.Column(db.DateTime())
+    # bumped whenever the driver's transactions or summaries change, keys the driver page's cached tables
+    history_version = db.Column(db.Integer(), nullable=False, default=0, server_default='0')
+
+    def __repr__(self):
+        return '<DriverState for driver {}>'.format(self.driver_id)
+
+
+class ChargingStationState(Base):
+    '''
+    Read model of the batteries on hand at a charging station
+
+    Maintained by the transaction path, see controllers.fleet
+    '''
+    charging_station_id = db.Column(db.Integer, db.ForeignKey('charging_station.id'), index=True, nullable=False, unique=True)
+    battery_count = db.Column(db.Integer(), nullable=False, default=0)
+    energy_on_hand = db.Column(db.Integer(), nullable=False, default=0)
+
+    def __repr__(self):
+        return '<ChargingStationState for charging station {}>'.format(self.charging_station_id)
+
+
+class OutboxEvent(Base):
+    '''
+    A change for downstream consumers, written in the same database
+    transaction as the change itself
+
+    Published and deleted by the relay, see controllers.outbox
+    '''
+    event_type = db.Column(db.String(), nullable=False)
+    # compact JSON
+    payload = db.Column(db.Text(), nullable=False)
+    date_added = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return '<OutboxEvent {} {}>'.format(self.id, self.event_type)
+
+
 class User(UserMixin, Base):
     '''
     Boilerplate user model
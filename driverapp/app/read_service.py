@@ -0,0 +1,224 @@
+'''
+Asynchronous read service for driver, battery and charging station state
+
+The station app polls small lookups, such as which battery is on a driver's
+vehicle, far more often than anything else. Through the Flask app each poll
+holds a sync gunicorn worker while it waits on the database. This service
+answers them from an asyncio event loop instead, so one process serves many
+concurrent polls while their queries wait.
+
+Queries are built from the tables declared in app.models, and run through
+asyncpg on Postgres. Other databases (sqlite in development and tests) run them
+through a SQLAlchemy engine on a thread pool instead. Responses are JSON;
+missing entities are 404s.
+
+Run it with
+
+    python read_service.py
+
+and set READ_SERVICE_TOKEN to require an "Authorization: Bearer <token>" header.
+It refuses to start without a token unless READ_SERVICE_INSECURE is set, since
+it serves driver names and phone numbers.
+'''
+import asyncio
+import hmac
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from aiohttp import web
+from sqlalchemy import bindparam, case, create_engine, or_, select
+from sqlalchemy.dialects import postgresql
+from app.models import Person, Driver, Vehicle, Battery, ChargingStation, BatteryTransaction, \
+        DriverState, ChargingStationState
+
+# which battery is on the driver's vehicle, and the last swap
+DRIVER_STATE = select([
+        Driver.id,
+        Person.name1,
+        Person.name2,
+        Person.name3,
+        Person.primary_phone_number.label('phone_number'),
+        Vehicle.id.label('vehicle_id'),
+        Vehicle.vin,
+        Battery.id.label('battery_id'),
+        Battery.serial.label('battery_serial'),
+        DriverState.battery_energy,
+        DriverState.last_transaction_id,
+        DriverState.last_transaction_date])\
+                .select_from(Driver.__table__
+                    .join(Person.__table__, Driver.person_id == Person.id)
+                    .outerjoin(Vehicle.__table__, Driver.current_vehicle_id == Vehicle.id)
+                    .outerjoin(Battery.__table__, Vehicle.battery_id == Battery.id)
+                    .outerjoin(DriverState.__table__, DriverState.driver_id == Driver.id))\
+                .where(Driver.id == bindparam('id'))
+
+# the energy of a battery when it last went in or out of a vehicle
+_last_swap = BatteryTransaction.__table__.alias('last_swap')
+_battery_energy = select([case([(_last_swap.c.battery_out_id == Battery.id, _last_swap.c.battery_out_energy)],
+            else_=_last_swap.c.battery_in_energy)])\
+                    .where(_last_swap.c.rejected.is_(False))\
+                    .where(or_(_last_swap.c.battery_in_id == Battery.id, _last_swap.c.battery_out_id == Battery.id))\
+                    .order_by(_last_swap.c.transaction_date.desc())\
+                    .limit(1).as_scalar()
+
+# where the battery is: at a charging station, or on a vehicle (and which driver's)
+BATTERY_STATE = select([
+        Battery.id,
+        Battery.serial,
+        Battery.capacity,
+        Battery.voltage,
+        _battery_energy.label('energy'),
+        ChargingStation.id.label('charging_station_id'),
+        ChargingStation.name.label('charging_station'),
+        Vehicle.id.label('vehicle_id'),
+        Vehicle.vin,
+        Driver.id.label('driver_id')])\
+                .select_from(Battery.__table__
+                    .outerjoin(ChargingStation.__table__, Battery.charging_station_id == ChargingStation.id)
+                    .outerjoin(Vehicle.__table__, Vehicle.battery_id == Battery.id)
+                    .outerjoin(Driver.__table__, Driver.current_vehicle_id == Vehicle.id))\
+                .where(Battery.id == bindparam('id'))
+
+CHARGING_STATION_STATE = select([
+        ChargingStation.id,
+        ChargingStation.name,
+        ChargingStation.location,
+        ChargingStationState.battery_count,
+        ChargingStationState.energy_on_hand])\
+                .select_from(ChargingStation.__table__
+                    .outerjoin(ChargingStationState.__table__, ChargingStationState.charging_station_id == ChargingStation.id))\
+                .where(ChargingStation.id == bindparam('id'))
+
+CHARGING_STATION_BATTERIES = select([Battery.id, Battery.serial])\
+        .where(Battery.charging_station_id == bindparam('id'))\
+        .order_by(Battery.id)
+
+
+class EngineStore():
+    '''
+    Runs queries through a SQLAlchemy engine, on a pool of threads
+    '''
+    def __init__(self, url, workers=10):
+        self.url = url
+        self.workers = workers
+
+    async def open(self):
+        self.engine = create_engine(self.url)
+        self.executor = ThreadPoolExecutor(self.workers)
+
+    async def close(self):
+        self.executor.shutdown()
+        self.engine.dispose()
+
+    async def fetch(self, query, **params):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self._fetch, query, params)
+
+    def _fetch(self, query, params):
+        with self.engine.connect() as connection:
+            return [dict(row) for row in connection.execute(query, **params)]
+
+
+class AsyncpgStore():
+    '''
+    Runs queries through a pool of asyncpg connections
+    '''
+    def __init__(self, url, min_size=2, max_size=10):
+        # asyncpg takes postgresql:// urls, without a driver name
+        self.url = re.sub(r'^postgresql\+\w+://', 'postgresql://', url)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statements = {}
+
+    async def open(self):
+        import asyncpg
+        self.pool = await asyncpg.create_pool(self.url, min_size=self.min_size, max_size=self.max_size)
+
+    async def close(self):
+        await self.pool.close()
+
+    async def fetch(self, query, **params):
+        sql, names, defaults = self._compile(query)
+        rows = await self.pool.fetch(sql, *[params[name] if name in params else defaults[name] for name in names])
+        return [dict(row) for row in rows]
+
+    def _compile(self, query):
+        if query not in self.statements:
+            compiled = query.compile(dialect=postgresql.dialect(paramstyle='numeric'))
+            # asyncpg numbers its parameters $1, $2...
+            sql = re.sub(r':(\d+)', r'$\1', str(compiled))
+            # parameters such as limits have their values in the query
+            self.statements[query] = (sql, compiled.positiontup, compiled.params)
+        return self.statements[query]
+
+
+def get_store(config):
+    url = config.get('READ_SERVICE_DATABASE_URI') or config['SQLALCHEMY_DATABASE_URI']
+    size = config.get('READ_SERVICE_POOL_SIZE') or 10
+    if url.startswith('postgresql'):
+        return AsyncpgStore(url, max_size=size)
+    return EngineStore(url, size)
+
+
+def _json(row):
+    return dict((key, value.isoformat() if isinstance(value, datetime) else value) for key, value in row.items())
+
+
+async def _one(request, query):
+    rows = await request.app['store'].fetch(query, id=int(request.match_info['id']))
+    if not rows:
+        raise web.HTTPNotFound()
+    return rows[0]
+
+
+async def driver_state(request):
+    driver = await _one(request, DRIVER_STATE)
+    driver['name'] = ' '.join(name for name in (driver.pop('name1'), driver.pop('name2'), driver.pop('name3')) if name)
+    return web.json_response(_json(driver))
+
+
+async def battery_state(request):
+    return web.json_response(_json(await _one(request, BATTERY_STATE)))
+
+
+async def charging_station_state(request):
+    station = await _one(request, CHARGING_STATION_STATE)
+    station['battery_count'] = station['battery_count'] or 0
+    station['energy_on_hand'] = station['energy_on_hand'] or 0
+    station['batteries'] = await request.app['store'].fetch(CHARGING_STATION_BATTERIES, id=station['id'])
+    return web.json_response(_json(station))
+
+
+def _check_token(token):
+    @web.middleware
+    async def check_token(request, handler):
+        authorization = request.headers.get('Authorization', '').encode('utf-8')
+        if not hmac.compare_digest(authorization, 'Bearer {}'.format(token).encode('utf-8')):
+            raise web.HTTPUnauthorized()
+        return await handler(request)
+    return check_token
+
+
+def create_read_app(config_class, store=None):
+    '''
+    The read service's aiohttp application, reading through store
+    if given, otherwise through the store for the configured database
+    '''
+    config = dict((key, getattr(config_class, key)) for key in dir(config_class) if key.isupper())
+    token = config.get('READ_SERVICE_TOKEN')
+    if not token and not config.get('READ_SERVICE_INSECURE'):
+        raise RuntimeError('READ_SERVICE_TOKEN is not set; set READ_SERVICE_INSECURE to serve without authentication')
+    app = web.Application(middlewares=[_check_token(token)] if token else [])
+    app['store'] = store or get_store(config)
+
+    async def open_store(app):
+        await app['store'].open()
+
+    async def close_store(app):
+        await app['store'].close()
+
+    app.on_startup.append(open_store)
+    app.on_cleanup.append(close_store)
+    app.router.add_get(r'/drivers/{id:\d+}', driver_state)
+    app.router.add_get(r'/batteries/{id:\d+}', battery_state)
+    app.router.add_get(r'/charging_stations/{id:\d+}', charging_station_state)
+    return app
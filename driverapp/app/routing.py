@@ -0,0 +1,61 @@
+'''
+Read replica routing
+
+Views decorated with `replica_reads` send their queries to the 'replica' bind
+in SQLALCHEMY_BINDS. Writes, and every read after a write, go to the primary;
+so does every read by a user for REPLICA_LAG seconds after they last wrote,
+so that they always see their own changes.
+'''
+from functools import wraps
+from time import time
+from flask import g, session, has_app_context, has_request_context, current_app
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+REPLICA_BIND = 'replica'
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        super(RoutingSession, self).__init__(db, **options)
+        self.db = db
+        self.has_written = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.use_replica():
+            return self.db.get_engine(self.app, bind=REPLICA_BIND)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def use_replica(self):
+        if self._flushing or self.has_written or not has_app_context():
+            return False
+        if not g.get('replica_reads'):
+            return False
+        return REPLICA_BIND in (self.app.config.get('SQLALCHEMY_BINDS') or ())
+
+
+def replica_reads(view):
+    '''
+    Marks a view as read only, so its queries can be sent to the replica
+    '''
+    @wraps(view)
+    def decorated_view(*args, **kwargs):
+        if session.get('primary_until', 0) <= time():
+            g.replica_reads = True
+        return view(*args, **kwargs)
+    return decorated_view
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _record_write(db_session, flush_context):
+    db_session.has_written = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _stick_to_primary(db_session):
+    '''
+    The replica may lag behind what was just committed,
+    so the user's following requests read from the primary for a while
+    '''
+    if db_session.has_written and has_request_context():
+        session['primary_until'] = time() + current_app.config.get('REPLICA_LAG', 0)
@@ -1,9 +1,15 @@
 from app import create_app, db
-from app.models import DriverSummary
+from app.engine import dispose_engines
+from app.controllers.summaries import rollover_all
+from app.controllers.drift import find_drift, drifted_block_drivers, repair_drift
+from app.controllers.outbox import get_publisher, relay
+from app.controllers.archive import archive_cutoff, archive_transactions
 from celery import Celery
+from celery.signals import worker_init
+from config import WorkerConfig
 
-app = create_app()
-app.app_context().push()
+# tasks run in an app context of their own, see ContextTask
+app = create_app(WorkerConfig, web=False)
 
 
 def create_celery_app(app=None): 
@@ -14,7 +20,7 @@ def create_celery_app(app=None):
     :param app: Flask app 
     :return: Celery app 
     """ 
-    app = app or create_app() 
+    app = app or create_app(WorkerConfig, web=False) 
  
     celery = Celery(app.import_name, broker=app.config['CELERY_BROKER_URL']) 
     celery.conf.update(app.config) 
@@ -32,9 +38,52 @@ def create_celery_app(app=None):
 
 celery = create_celery_app(app)
 
-def summary_rollver(date=None):
-    if not date:
-        date = datetime.utcnow()
+@worker_init.connect
+def dispose_before_fork(**kwargs):
+    '''
+    The worker's pool processes are forked after this,
+    so none of them should inherit a connection
+    '''
+    dispose_engines(app, db)
+
+@celery.task
+def check_summaries(repair=True):
+    '''
+    Nightly check of the summaries against the transactions
+
+    Returns the number of drifted ranges, and of drivers with drifted blocks
+    '''
+    ranges = find_drift()
+    block_driver_ids = drifted_block_drivers()
+    if repair:
+        repair_drift(ranges, block_driver_ids)
+        db.session.commit()
+    return len(ranges), len(block_driver_ids)
+
+@celery.task
+def relay_outbox():
+    '''
+    Publishes the swap events waiting in the outbox, run every few seconds
+
+    Returns the number of events published
+    '''
+    publisher = get_publisher(app)
+    return relay(publisher) if publisher else 0
+
+@celery.task
+def archive_swaps():
+    '''
+    Moves rejected swaps, and swaps older than ARCHIVE_AFTER_YEARS, to the archive, run monthly
+
+    Returns the number of swaps archived
+    '''
+    return archive_transactions(archive_cutoff(app.config['ARCHIVE_AFTER_YEARS']))
+
+@celery.task
+def rollover_summaries():
+    '''
+    Rolls the summaries of the active drivers over to now, run nightly
+    '''
+    rollover_all()
+    db.session.commit()
 
-    for driver in Driver.query.all():
-        DriverSummary.rollover(driver, date) 
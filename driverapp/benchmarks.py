@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+'''
+Benchmarks for the transaction and summary engines
+
+Each benchmark builds its own data in a throwaway sqlite database,
+so it can be run anywhere the unit tests can, e.g.
+
+    python benchmarks.py rebuild
+
+Benchmarks using several connections run against BENCHMARK_DATABASE_URI
+if it is set; its tables are dropped and recreated
+'''
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from app import create_app, db
+from app.models import Person, Driver, Vehicle, Battery, ChargingStation, BatteryTransaction, DriverSummary, \
+        DriverSummaryBlock
+from app.controllers.summaries import get_start_date, rollover, rebuild, _daily_totals
+from app.controllers.records import transaction_records
+from app.controllers.drift import find_drift, drifted_block_drivers, repair_drift
+from app.controllers.transactions import add_transaction
+from app.controllers.ingest import IngestScheduler
+from app.controllers.search import search_drivers, explain_search, POSTGRES_INDEXES
+from config import Config
+
+
+class BenchmarkConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+
+
+class WriteCounter():
+    '''
+    Counts statements and rows written through an engine, by statement type
+    '''
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = {}
+        self.rows = {}
+
+    def __enter__(self):
+        event.listen(self.engine, 'after_cursor_execute', self.after_cursor_execute)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        verb = statement.split(None, 1)[0].upper()
+        if verb not in ('INSERT', 'UPDATE', 'DELETE'):
+            return
+        self.statements[verb] = self.statements.get(verb, 0) + 1
+        if cursor.rowcount >= 0:
+            rows = cursor.rowcount
+        else:
+            rows = len(parameters) if executemany else 1
+        self.rows[verb] = self.rows.get(verb, 0) + rows
+
+    def report(self, title):
+        print(title)
+        for verb in ('INSERT', 'UPDATE', 'DELETE'):
+            print('  {:<7} {:>6} statements {:>6} rows'.format(
+                verb, self.statements.get(verb, 0), self.rows.get(verb, 0)))
+
+
+def create_driver_history(days, start_date=None):
+    '''
+    Creates one driver with a swap every day for the given number of days
+    Returns the driver and its transactions
+    '''
+    start_date = start_date or datetime.utcnow() - timedelta(days=days + 1)
+    charging_station = ChargingStation(name='Kacyiru')
+    batteries = [Battery(serial='B-{}'.format(i), voltage=120, capacity=200,
+        charging_station=charging_station) for i in range(2)]
+    vehicle = Vehicle(vin='I-0')
+    person = Person(name1='Mugisha', primary_phone_number='+2600')
+    driver = Driver(person=person, current_vehicle=vehicle, date_started=start_date)
+    db.session.add_all([charging_station, vehicle, person, driver] + batteries)
+    db.session.flush()
+
+    for day in range(days):
+        battery_in = vehicle.battery
+        battery_out = batteries[(day + 1) % 2] if battery_in else batteries[0]
+        add_transaction(
+                driver = driver,
+                battery_in = battery_in,
+                battery_out = battery_out,
+                charging_station = charging_station,
+                battery_in_energy = 100 if battery_in else 0,
+                battery_out_energy = 200,
+                odometer_reading = day * 30,
+                transaction_date = start_date + timedelta(days=day, hours=1))
+    db.session.commit()
+    transactions = BatteryTransaction.query.filter(BatteryTransaction.driver == driver)\
+            .order_by(BatteryTransaction.transaction_date.asc()).all()
+    return driver, transactions
+
+
+def legacy_rebuild(driver, start_date, end_date=None):
+    '''
+    The original rebuild: delete every summary from start_date and roll over again
+
+    Summary blocks are not kept consistent;
+    this is only here to compare the volume of writes
+    '''
+    db.session.flush()
+    end_date = end_date or datetime.utcnow()
+    DriverSummary.query.filter(DriverSummary.driver == driver, DriverSummary.end_date >= start_date)\
+            .delete(synchronize_session='fetch')
+    return rollover(driver, end_date)
+
+
+def bench_rebuild(days=180):
+    '''
+    Rewrites caused by correcting the energy of a swap made `days` ago
+    '''
+    for title, rebuild_function in (('delete and recreate', legacy_rebuild), ('diff in place', rebuild)):
+        app = create_app(BenchmarkConfig)
+        with app.app_context():
+            db.create_all()
+            driver, transactions = create_driver_history(days)
+            correction = transactions[1]
+            correction.battery_in_energy -= 10
+            with WriteCounter(db.engine) as counter:
+                for summary in rebuild_function(driver, correction.transaction_date):
+                    db.session.add(summary)
+                db.session.commit()
+            counter.report('{} ({} days of summaries)'.format(title, days))
+            db.session.remove()
+            db.drop_all()
+
+
+def bench_ingest(drivers=16, days=20, workers=(1, 2, 4, 8)):
+    '''
+    Swaps per second applied by the ingest scheduler with different numbers of workers
+
+    sqlite allows one writer at a time, so throughput only scales on postgres
+    '''
+    path = None
+    database_uri = os.environ.get('BENCHMARK_DATABASE_URI')
+    if not database_uri:
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        database_uri = 'sqlite:///' + path
+
+    class IngestConfig(BenchmarkConfig):
+        SQLALCHEMY_DATABASE_URI = database_uri
+        SQLALCHEMY_POOL_SIZE = max(workers)
+
+    print('ingest ({} drivers, {} swaps each, {})'.format(drivers, days, database_uri.split(':')[0]))
+    app = create_app(IngestConfig)
+    with app.app_context():
+        for worker_count in workers:
+            db.drop_all()
+            db.create_all()
+            start_date = datetime.utcnow() - timedelta(days=days + 1)
+            swaps = []
+            for i in range(drivers):
+                charging_station = ChargingStation(name='Kacyiru {}'.format(i))
+                batteries = [Battery(serial='B-{}-{}'.format(i, b), voltage=120, capacity=200,
+                    charging_station=charging_station) for b in range(2)]
+                person = Person(name1='Mugisha', primary_phone_number='+260{}'.format(i))
+                driver = Driver(person=person, current_vehicle=Vehicle(vin='I-{}'.format(i)), date_started=start_date)
+                db.session.add_all([charging_station, driver] + batteries)
+                db.session.flush()
+                for day in range(days):
+                    swaps.append({
+                        'driver_id': driver.id,
+                        'battery_in_id': batteries[day % 2].id if day else None,
+                        'battery_out_id': batteries[(day + 1) % 2].id,
+                        'charging_station_id': charging_station.id,
+                        'battery_in_energy': 100 if day else 0,
+                        'battery_out_energy': 200,
+                        'odometer_reading': day * 30,
+                        'transaction_date': start_date + timedelta(days=day, hours=1),
+                    })
+            db.session.commit()
+            db.session.remove()
+
+            started = time.time()
+            result = IngestScheduler(app, worker_count).run(swaps)
+            elapsed = time.time() - started
+            print('  {:>2} workers {:>6.2f}s {:>7.1f} swaps/s {} failed'.format(
+                worker_count, elapsed, result.applied / elapsed, len(result.failed)))
+        db.session.remove()
+        db.drop_all()
+    if path:
+        os.remove(path)
+
+
+def bench_search(drivers=100000, queries=('m', 'mug', 'mugisha', 'kato hab', '2567', '+256787')):
+    '''
+    Driver typeahead search latency with a large number of drivers
+    '''
+    database_uri = os.environ.get('BENCHMARK_DATABASE_URI', 'sqlite://')
+
+    class SearchConfig(BenchmarkConfig):
+        SQLALCHEMY_DATABASE_URI = database_uri
+
+    names = ['Gahigi', 'Gasimba', 'Habimana', 'Kato', 'Mazimpaka', 'Mugisha', 'Mugabo', 'Ntwali', 'Rusanganwa', 'Uwase']
+    random.seed(0)
+    app = create_app(SearchConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.bulk_insert_mappings(Person, [{
+            'id': i + 1,
+            'name1': '{}{}'.format(random.choice(names), i % 100 or ''),
+            'name2': random.choice(names) if i % 3 else '',
+            'name3': random.choice(names),
+            'primary_phone_number': '+2567{:08d}'.format(i)} for i in range(drivers)])
+        db.session.bulk_insert_mappings(Driver, [{'person_id': i + 1, 'date_started': datetime.utcnow()}
+            for i in range(drivers)])
+        postgres = db.engine.dialect.name == 'postgresql'
+        if postgres:
+            for statement in POSTGRES_INDEXES:
+                db.session.execute(statement)
+            db.session.execute('ANALYZE person')
+        db.session.commit()
+
+        print('search ({} drivers, {})'.format(drivers, database_uri.split(':')[0]))
+        started = time.time()
+        search_drivers('warm up')
+        print('  {:<10} {:>8.1f}ms'.format('first', (time.time() - started) * 1000))
+        for query in queries:
+            started = time.time()
+            for i in range(20):
+                results = search_drivers(query)
+            print('  {:<10} {:>8.2f}ms {:>3} results'.format(query, (time.time() - started) * 1000 / 20, len(results)))
+            if postgres:
+                # the scans of the plan, which should all be on indexes
+                for line in explain_search(query):
+                    if 'Scan' in line:
+                        print('    ' + line.strip())
+        db.session.remove()
+        db.drop_all()
+
+
+def measure(function):
+    '''
+    Returns the seconds taken and peak bytes allocated by function
+    '''
+    tracemalloc.start()
+    started = time.time()
+    function()
+    elapsed = time.time() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def insert_transactions(driver_id, count, start_date, interval, first_id=1):
+    '''
+    Inserts count linked transactions for the driver, interval apart,
+    each riding 30 and using 100 energy
+    '''
+    batch = []
+    for i in range(count):
+        batch.append({
+            'id': first_id + i,
+            'driver_id': driver_id,
+            'battery_in_energy': 100,
+            'battery_out_energy': 200,
+            'odometer_reading': i * 30,
+            'last_transaction_id': first_id + i - 1 if i else None,
+            'rejected': False,
+            'transaction_date': start_date + interval * i})
+        if len(batch) == 10000 or i == count - 1:
+            db.session.execute(BatteryTransaction.__table__.insert(), batch)
+            batch = []
+
+
+def bench_records(transactions=1000000, days=1000):
+    '''
+    Time and peak memory of rebuilding the summaries of a driver with a million transactions,
+    reading them as mapped objects and as TransactionRecords
+    '''
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        start_date = datetime.utcnow() - timedelta(days=days + 1)
+        person = Person(name1='Mugisha', primary_phone_number='+2600')
+        driver = Driver(person=person, date_started=start_date)
+        db.session.add_all([person, driver])
+        db.session.flush()
+        insert_transactions(driver.id, transactions, start_date, timedelta(days=days) / transactions)
+        db.session.commit()
+
+        def mapped_objects():
+            _daily_totals(BatteryTransaction.query.filter(
+                BatteryTransaction.rejected.is_(False),
+                BatteryTransaction.driver_id == driver.id)\
+                        .order_by(BatteryTransaction.transaction_date.asc()).all())
+            db.session.expunge_all()
+
+        def records():
+            _daily_totals(transaction_records(BatteryTransaction.driver_id == driver.id))
+
+        def rebuild_summaries():
+            for summary in rebuild(Driver.query.get(driver.id), start_date):
+                db.session.add(summary)
+            db.session.flush()
+
+        print('records ({} transactions over {} days)'.format(transactions, days))
+        for title, function in (('mapped objects', mapped_objects), ('records', records), ('rebuild', rebuild_summaries)):
+            elapsed, peak = measure(function)
+            print('  {:<15} {:>7.2f}s {:>8.1f}MB peak'.format(title, elapsed, peak / 1024 / 1024))
+        db.session.remove()
+        db.drop_all()
+
+
+def bench_drift(drivers=1000, days=365, drifted=0.01):
+    '''
+    Time taken by the nightly summary check over a fleet with a year of daily swaps
+    '''
+    database_uri = os.environ.get('BENCHMARK_DATABASE_URI', 'sqlite://')
+
+    class DriftConfig(BenchmarkConfig):
+        SQLALCHEMY_DATABASE_URI = database_uri
+
+    random.seed(0)
+    app = create_app(DriftConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        start_date = get_start_date(datetime.utcnow() - timedelta(days=days + 1))
+        summaries = []
+        blocks = {}
+        for d in range(drivers):
+            driver = Driver(person=Person(name1='Mugisha', primary_phone_number='+260{}'.format(d)), date_started=start_date)
+            db.session.add(driver)
+            db.session.flush()
+            insert_transactions(driver.id, days, start_date + timedelta(hours=1), timedelta(days=1), d * days + 1)
+            for day in range(days):
+                ride_distance, energy_used = (30, 100) if day else (0, 0)
+                if random.random() < drifted:
+                    energy_used += 1
+                summary_start = start_date + timedelta(days=day)
+                summaries.append({'driver_id': driver.id, 'start_date': summary_start,
+                    'end_date': summary_start + timedelta(days=1), 'ride_distance': ride_distance, 'energy_used': energy_used})
+                block_start = DriverSummaryBlock.get_start_date(summary_start)
+                block_ride_distance, block_energy_used = blocks.get((driver.id, block_start), (0, 0))
+                blocks[driver.id, block_start] = (block_ride_distance + ride_distance, block_energy_used + energy_used)
+        db.session.bulk_insert_mappings(DriverSummary, summaries)
+        db.session.bulk_insert_mappings(DriverSummaryBlock, [{'driver_id': driver_id, 'start_date': block_start,
+            'end_date': DriverSummaryBlock.get_end_date(block_start), 'ride_distance': ride_distance, 'energy_used': energy_used}
+            for (driver_id, block_start), (ride_distance, energy_used) in blocks.items()])
+        db.session.commit()
+
+        print('drift ({} drivers, {} days, {})'.format(drivers, days, database_uri.split(':')[0]))
+        started = time.time()
+        ranges = find_drift()
+        print('  {:<15} {:>7.2f}s {:>6} drifted ranges'.format('daily summaries', time.time() - started, len(ranges)))
+        started = time.time()
+        block_driver_ids = drifted_block_drivers()
+        print('  {:<15} {:>7.2f}s {:>6} drivers'.format('blocks', time.time() - started, len(block_driver_ids)))
+        started = time.time()
+        repair_drift(ranges, block_driver_ids)
+        db.session.commit()
+        print('  {:<15} {:>7.2f}s'.format('repair', time.time() - started))
+        db.session.remove()
+        db.drop_all()
+
+
+def bench_reads(drivers=200, requests=1000, concurrency=50, latency=0.002):
+    '''
+    Driver state lookups per second: the sync driver page, served one request at a time
+    like a sync gunicorn worker, and the read service with many requests in flight
+
+    Every query waits latency seconds first, as it would for a database across a network;
+    sqlite answers from memory, so without it the comparison is only of the frameworks
+    '''
+    import asyncio
+    from aiohttp import ClientSession
+    from aiohttp.test_utils import TestServer
+    from app.models import User
+    from app.read_service import EngineStore, create_read_app
+
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+    class ReadConfig(BenchmarkConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        WTF_CSRF_ENABLED = False
+        READ_SERVICE_INSECURE = True
+
+    class LatentStore(EngineStore):
+        async def fetch(self, query, **params):
+            await asyncio.sleep(latency)
+            return await super(LatentStore, self).fetch(query, **params)
+
+    random.seed(0)
+    app = create_app(ReadConfig)
+    with app.app_context():
+        db.create_all()
+        charging_station = ChargingStation(name='Kacyiru')
+        db.session.add(charging_station)
+        for i in range(drivers):
+            vehicle = Vehicle(vin='I-{}'.format(i), battery=Battery(serial='B-{}'.format(i), voltage=120, capacity=200))
+            db.session.add(Driver(person=Person(name1='Mugisha', primary_phone_number='+260{}'.format(i)),
+                current_vehicle=vehicle, date_started=datetime.utcnow()))
+        user = User(username='susan')
+        user.set_password('cat')
+        db.session.add(user)
+        db.session.commit()
+        driver_ids = [random.randint(1, drivers) for i in range(requests)]
+
+        print('reads ({} requests, {:.0f}ms latency per query)'.format(requests, latency * 1000))
+        client = app.test_client()
+        client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+
+        def wait(*args):
+            time.sleep(latency)
+        event.listen(db.engine, 'before_cursor_execute', wait)
+        started = time.time()
+        for driver_id in driver_ids:
+            assert client.get('/driver/{}/'.format(driver_id)).status_code == 200
+        elapsed = time.time() - started
+        event.remove(db.engine, 'before_cursor_execute', wait)
+        print('  {:<22} {:>7.2f}s {:>7.1f} requests/s'.format('sync driver page', elapsed, requests / elapsed))
+        db.session.remove()
+
+    async def read_all():
+        server = TestServer(create_read_app(ReadConfig, LatentStore(ReadConfig.SQLALCHEMY_DATABASE_URI)))
+        await server.start_server()
+        semaphore = asyncio.Semaphore(concurrency)
+        try:
+            async with ClientSession() as session:
+                async def get(driver_id):
+                    async with semaphore:
+                        async with session.get(server.make_url('/drivers/{}'.format(driver_id))) as response:
+                            assert response.status == 200
+                            await response.read()
+                started = time.time()
+                await asyncio.gather(*[get(driver_id) for driver_id in driver_ids])
+                return time.time() - started
+        finally:
+            await server.close()
+
+    elapsed = asyncio.get_event_loop().run_until_complete(read_all())
+    print('  {:<22} {:>7.2f}s {:>7.1f} requests/s'.format(
+        'read service ({})'.format(concurrency), elapsed, requests / elapsed))
+    os.remove(path)
+
+
+# how each kind of process starts the app
+STARTUP_MODES = (
+    ('web', 'import driverapp', {}),
+    ('cli', 'import driverapp', {'APP_MODE': 'cli'}),
+    ('celery worker', 'import app.tasks', {}),
+    ('script', 'import app; app.create_app(web=False)', {}),
+)
+
+# imported by the app, and slow to import
+HEAVY_MODULES = ('alembic', 'flask_migrate', 'flask_bootstrap', 'celery.app', 'pyarrow', 'numpy')
+
+STARTUP_SCRIPT = '''
+import sys, time
+started = time.perf_counter()
+{}
+print(time.perf_counter() - started)
+print(' '.join(m for m in {!r} if m in sys.modules))
+'''
+
+
+def bench_startup(runs=7):
+    '''
+    Times starting the app in a new interpreter for each kind of process, and lists the
+    slow imports it pays for; the median of runs, after one run to write bytecode
+    '''
+    print('startup')
+    for name, statement, environ in STARTUP_MODES:
+        script = STARTUP_SCRIPT.format(statement, HEAVY_MODULES)
+        env = dict(os.environ, **environ)
+        times = []
+        for i in range(runs + 1):
+            output = subprocess.check_output([sys.executable, '-c', script], env=env,
+                    cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True)
+            elapsed, modules = output.split('\n')[-3:-1]
+            times.append(float(elapsed))
+        print('  {:<15} {:>6.3f}s  {}'.format(name, statistics.median(times[1:]), modules or '-'))
+
+
+BENCHMARKS = {
+    'drift': bench_drift,
+    'ingest': bench_ingest,
+    'reads': bench_reads,
+    'rebuild': bench_rebuild,
+    'records': bench_records,
+    'search': bench_search,
+    'startup': bench_startup,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -5,6 +5,11 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(basedir, '.env'))
 
 
+def env_int(name, default=None):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
 class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URI') or \
@@ -12,6 +17,115 @@ class Config(object):
     #SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # connection pool settings, applied to the engine in app/engine.py
+    SQLALCHEMY_POOL_SIZE = env_int('SQLALCHEMY_POOL_SIZE')
+    SQLALCHEMY_MAX_OVERFLOW = env_int('SQLALCHEMY_MAX_OVERFLOW')
+    SQLALCHEMY_POOL_TIMEOUT = env_int('SQLALCHEMY_POOL_TIMEOUT')
+    SQLALCHEMY_POOL_RECYCLE = env_int('SQLALCHEMY_POOL_RECYCLE')
+    # test connections when they are checked out of the pool, and reconnect if they are stale
+    SQLALCHEMY_POOL_PRE_PING = False
+    # server side statement timeout in milliseconds (postgres only)
+    SQLALCHEMY_STATEMENT_TIMEOUT = env_int('SQLALCHEMY_STATEMENT_TIMEOUT')
+    # when connecting through PgBouncer in transaction pooling mode, PgBouncer does the pooling
+    # and session settings are set per transaction instead of per connection
+    SQLALCHEMY_PGBOUNCER = bool(os.environ.get('SQLALCHEMY_PGBOUNCER'))
+
+    # read only views are sent to the replica when one is configured; see app/routing.py
+    SQLALCHEMY_BINDS = {'replica': os.environ['REPLICA_DATABASE_URI']} \
+        if os.environ.get('REPLICA_DATABASE_URI') else None
+    # seconds after a user writes during which their reads still go to the primary
+    REPLICA_LAG = env_int('REPLICA_LAG', 10)
+
+    # rendered fragment cache, 'simple' (in process), 'redis' or 'none'; see app/cache.py
+    FRAGMENT_CACHE = os.environ.get('FRAGMENT_CACHE') or 'simple'
+    FRAGMENT_CACHE_REDIS_URL = os.environ.get('FRAGMENT_CACHE_REDIS_URL') or 'redis://localhost:6379/1'
+    FRAGMENT_CACHE_TIMEOUT = env_int('FRAGMENT_CACHE_TIMEOUT', 60 * 60)
+
+    # the asynchronous read service, see app/read_service.py; by default it reads from the replica if there is one
+    READ_SERVICE_DATABASE_URI = os.environ.get('READ_SERVICE_DATABASE_URI') or os.environ.get('REPLICA_DATABASE_URI')
+    READ_SERVICE_POOL_SIZE = env_int('READ_SERVICE_POOL_SIZE', 10)
+    # when set, requests need an "Authorization: Bearer <token>" header
+    READ_SERVICE_TOKEN = os.environ.get('READ_SERVICE_TOKEN')
+    # without a token the service refuses to start, unless this is set
+    READ_SERVICE_INSECURE = bool(os.environ.get('READ_SERVICE_INSECURE'))
+
+    # live swap counters for the station dashboard, 'simple' (in process), 'redis' or 'none'; see app/counters.py
+    # redis when STATION_COUNTERS_REDIS_URL is set, as simple counters only see their own process's swaps
+    STATION_COUNTERS = os.environ.get('STATION_COUNTERS') or \
+            ('redis' if os.environ.get('STATION_COUNTERS_REDIS_URL') else 'none')
+    STATION_COUNTERS_REDIS_URL = os.environ.get('STATION_COUNTERS_REDIS_URL') or 'redis://localhost:6379/3'
+    # seconds of swaps counted
+    STATION_COUNTERS_WINDOW = env_int('STATION_COUNTERS_WINDOW', 60 * 60)
+
+    # live swap events for the station and driver pages, 'simple' (in process), 'redis' or 'none'; see app/broadcast.py
+    # redis when BROADCAST_REDIS_URL is set, as simple broadcasting only sees its own process's swaps
+    BROADCAST = os.environ.get('BROADCAST') or ('redis' if os.environ.get('BROADCAST_REDIS_URL') else 'none')
+    BROADCAST_REDIS_URL = os.environ.get('BROADCAST_REDIS_URL') or 'redis://localhost:6379/4'
+    BROADCAST_KEEPALIVE = env_int('BROADCAST_KEEPALIVE', 15)
+    # pages only open event streams when the web workers are threaded or async, see gunicorn.conf.py
+    BROADCAST_STREAMS = bool(os.environ.get('BROADCAST_STREAMS'))
+
+    # weekly and monthly driver efficiency rankings, 'simple' (in process), 'redis' or 'none'; see app/leaderboard.py
+    # redis when LEADERBOARD_REDIS_URL is set, as a simple leaderboard only sees its own process's changes
+    LEADERBOARD = os.environ.get('LEADERBOARD') or ('redis' if os.environ.get('LEADERBOARD_REDIS_URL') else 'none')
+    LEADERBOARD_REDIS_URL = os.environ.get('LEADERBOARD_REDIS_URL') or 'redis://localhost:6379/5'
+    # days a period is kept after it ends
+    LEADERBOARD_RETENTION = env_int('LEADERBOARD_RETENTION', 366)
+
+    # where the relay publishes swap events, 'redis' (a stream), 'file' (JSON lines) or 'none'; see app/controllers/outbox.py
+    OUTBOX_PUBLISHER = os.environ.get('OUTBOX_PUBLISHER') or 'redis'
+    OUTBOX_REDIS_URL = os.environ.get('OUTBOX_REDIS_URL') or 'redis://localhost:6379/2'
+    OUTBOX_STREAM = os.environ.get('OUTBOX_STREAM') or 'swaps'
+    # approximate number of events kept in the stream
+    OUTBOX_STREAM_MAXLEN = env_int('OUTBOX_STREAM_MAXLEN', 1000000)
+    OUTBOX_FILE = os.environ.get('OUTBOX_FILE') or os.path.join(basedir, 'outbox.jsonl')
+
+    # swaps older than this many years are moved to the archive by archive-swaps; see app/controllers/archive.py
+    ARCHIVE_AFTER_YEARS = env_int('ARCHIVE_AFTER_YEARS', 3)
+
     CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL') or 'redis://localhost:6379/0'
     CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND') or CELERY_BROKER_URL
 
+
+class WebConfig(Config):
+    '''
+    Profile for gunicorn web workers
+
+    Sync workers serve one request at a time, so each process needs only
+    a small pool, and slow queries are cut off before the request times out
+    '''
+    SQLALCHEMY_POOL_SIZE = env_int('SQLALCHEMY_POOL_SIZE', 2)
+    SQLALCHEMY_MAX_OVERFLOW = env_int('SQLALCHEMY_MAX_OVERFLOW', 2)
+    SQLALCHEMY_POOL_TIMEOUT = env_int('SQLALCHEMY_POOL_TIMEOUT', 10)
+    SQLALCHEMY_POOL_RECYCLE = env_int('SQLALCHEMY_POOL_RECYCLE', 1800)
+    SQLALCHEMY_POOL_PRE_PING = True
+    SQLALCHEMY_STATEMENT_TIMEOUT = env_int('SQLALCHEMY_STATEMENT_TIMEOUT', 15000)
+
+
+class WorkerConfig(Config):
+    '''
+    Profile for celery workers and command line tasks
+
+    Each worker process runs one task at a time, and summary rebuilds
+    can legitimately run for minutes
+    '''
+    SQLALCHEMY_POOL_SIZE = env_int('SQLALCHEMY_POOL_SIZE', 1)
+    SQLALCHEMY_MAX_OVERFLOW = env_int('SQLALCHEMY_MAX_OVERFLOW', 1)
+    SQLALCHEMY_POOL_TIMEOUT = env_int('SQLALCHEMY_POOL_TIMEOUT', 30)
+    SQLALCHEMY_POOL_RECYCLE = env_int('SQLALCHEMY_POOL_RECYCLE', 1800)
+    SQLALCHEMY_POOL_PRE_PING = True
+    SQLALCHEMY_STATEMENT_TIMEOUT = env_int('SQLALCHEMY_STATEMENT_TIMEOUT', 600000)
+
+
+profiles = {
+    'web': WebConfig,
+    'worker': WorkerConfig,
+}
+
+
+def get_config(profile=None):
+    '''
+    Returns the config class for a deployment profile,
+    by default the one named by the APP_PROFILE environment variable
+    '''
+    return profiles[profile or os.environ.get('APP_PROFILE') or 'web']
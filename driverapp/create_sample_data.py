@@ -4,6 +4,8 @@ from app import create_app, db
 from app.models import Person, Driver, Vehicle, Battery, ChargingStation, BatteryTransaction, DriverSummary
 from app.controllers.summaries import rollover
 from app.controllers.transactions import add_transaction
+from app.controllers.validation import TransactionValidationError
+from app.controllers.fleet import refresh_fleet_state
 from  sqlalchemy.sql.expression import func
 from random import randint
 
@@ -137,15 +139,19 @@ def create_sample_data():
             driver.current_vehicle.odometer_reading = distance
             db.session.add(driver.current_vehicle)
 
-            new_transaction = add_transaction(
-                    driver = driver,
-                    battery_in = driver.current_vehicle.battery,
-                    battery_out = battery_out,
-                    charging_station = charging_station,
-                    battery_in_energy = battery_in_energy,
-                    battery_out_energy = battery_out_energy,
-                    odometer_reading = distance,
-                    transaction_date = current_hour)
+            try:
+                new_transaction = add_transaction(
+                        driver = driver,
+                        battery_in = driver.current_vehicle.battery,
+                        battery_out = battery_out,
+                        charging_station = charging_station,
+                        battery_in_energy = battery_in_energy,
+                        battery_out_energy = battery_out_energy,
+                        odometer_reading = distance,
+                        transaction_date = current_hour)
+            except TransactionValidationError as err:
+                print('skipped swap: {}'.format(err))
+                continue
             db.session.flush()
             if driver.current_vehicle.battery != battery_out:
                 import pdb; pdb.set_trace()
@@ -154,11 +160,13 @@ def create_sample_data():
         for driver in drivers:
             print(driver.current_vehicle.battery)
             rollover(driver, date)
+    # stations and drivers without any swaps
+    refresh_fleet_state()
     db.session.commit()
 
 
 if __name__ == '__main__':
-    app = create_app()
+    app = create_app(web=False)
     app_context = app.app_context()
     app_context.push()
     db.create_all()
@@ -1,3 +1,7 @@
-from app import create_app, db
+import os
+from app import create_app, db, cli
+from config import get_config
 
-app = create_app()
+# APP_MODE=cli skips the web extensions and blueprints, for commands other than run and db
+app = create_app(get_config(), web=os.environ.get('APP_MODE') != 'cli')
+cli.register(app)
@@ -0,0 +1,25 @@
+import os
+
+bind = ':5000'
+workers = int(os.environ.get('WEB_CONCURRENCY') or 3)
+worker_class = 'sync'
+# more than one thread runs gthread workers, so open event streams do not hold a whole worker each
+threads = int(os.environ.get('GUNICORN_THREADS') or 1)
+timeout = 30
+# the driver and station pages only open event streams (app/broadcast.py) when workers serve
+# other requests meanwhile; with sync workers a stream would block a worker until it times out
+raw_env = ['BROADCAST_STREAMS=1'] if threads > 1 or worker_class != 'sync' else []
+accesslog = '-'
+errorlog = '-'
+
+
+def pre_fork(server, worker):
+    '''
+    When the app is preloaded in the master, drop any connections it made,
+    so that they are not inherited by the workers
+    '''
+    if server.cfg.preload_app:
+        from driverapp import app
+        from app import db
+        from app.engine import dispose_engines
+        dispose_engines(app, db)
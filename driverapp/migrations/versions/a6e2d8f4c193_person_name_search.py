@@ -0,0 +1,30 @@
+"""person name search
+
+Revision ID: a6e2d8f4c193
+Revises: d4e9a1c7b358
+Create Date: 2026-10-21 10:12:44.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6e2d8f4c193'
+down_revision = 'd4e9a1c7b358'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('person', sa.Column('date_modified', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_person_date_modified'), 'person', ['date_modified'], unique=False)
+    # LIKE '% token%' on the later tokens of name2, which the prefix indexes cannot answer
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute('CREATE INDEX ix_person_name2_trgm ON person USING gin (lower(name2) gin_trgm_ops)')
+
+
+def downgrade():
+    op.drop_index('ix_person_name2_trgm', table_name='person')
+    op.drop_index(op.f('ix_person_date_modified'), table_name='person')
+    op.drop_column('person', 'date_modified')
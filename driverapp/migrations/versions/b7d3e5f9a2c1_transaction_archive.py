@@ -0,0 +1,60 @@
+"""transaction archive
+
+Revision ID: b7d3e5f9a2c1
+Revises: f2d8c6a41b97
+Create Date: 2026-10-20 09:12:44.815630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d3e5f9a2c1'
+down_revision = 'f2d8c6a41b97'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # transactions referenced by id may be moved to the archive
+    op.drop_constraint('battery_transaction_correction_id_fkey', 'battery_transaction', type_='foreignkey')
+    op.drop_constraint('battery_transaction_last_transaction_id_fkey', 'battery_transaction', type_='foreignkey')
+    op.drop_constraint('driver_summary_last_transaction_id_fkey', 'driver_summary', type_='foreignkey')
+
+    op.create_table('battery_transaction_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('battery_in_id', sa.Integer(), nullable=True),
+    sa.Column('battery_out_id', sa.Integer(), nullable=True),
+    sa.Column('driver_id', sa.Integer(), nullable=False),
+    sa.Column('charging_station_id', sa.Integer(), nullable=True),
+    sa.Column('battery_in_energy', sa.Integer(), nullable=True),
+    sa.Column('battery_out_energy', sa.Integer(), nullable=True),
+    sa.Column('odometer_reading', sa.Integer(), nullable=True),
+    sa.Column('rejected', sa.Boolean(), nullable=True),
+    sa.Column('correction_id', sa.Integer(), nullable=True),
+    sa.Column('last_transaction_id', sa.Integer(), nullable=True),
+    sa.Column('transaction_date', sa.DateTime(), nullable=False),
+    sa.Column('date_added', sa.DateTime(), nullable=True),
+    sa.Column('creator_id', sa.Integer(), nullable=True),
+    sa.Column('date_archived', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['battery_in_id'], ['battery.id'], ),
+    sa.ForeignKeyConstraint(['battery_out_id'], ['battery.id'], ),
+    sa.ForeignKeyConstraint(['charging_station_id'], ['charging_station.id'], ),
+    sa.ForeignKeyConstraint(['creator_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['driver_id'], ['driver.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_battery_transaction_archive_rejected_transaction_date', 'battery_transaction_archive', ['rejected', 'transaction_date'], unique=False)
+    op.create_index('ix_battery_transaction_archive_charging_station_id_transaction_date', 'battery_transaction_archive', ['charging_station_id', 'transaction_date'], unique=False)
+    op.create_index('ix_battery_transaction_archive_driver_id_transaction_date', 'battery_transaction_archive', ['driver_id', 'transaction_date'], unique=False)
+    op.create_index('ix_battery_transaction_archive_battery_in_id_transaction_date', 'battery_transaction_archive', ['battery_in_id', 'transaction_date'], unique=False)
+    op.create_index('ix_battery_transaction_archive_battery_out_id_transaction_date', 'battery_transaction_archive', ['battery_out_id', 'transaction_date'], unique=False)
+
+
+def downgrade():
+    # fails if any archived transaction is still referenced; move them back first
+    op.drop_table('battery_transaction_archive')
+    op.create_foreign_key('driver_summary_last_transaction_id_fkey', 'driver_summary', 'battery_transaction', ['last_transaction_id'], ['id'])
+    op.create_foreign_key('battery_transaction_last_transaction_id_fkey', 'battery_transaction', 'battery_transaction', ['last_transaction_id'], ['id'])
+    op.create_foreign_key('battery_transaction_correction_id_fkey', 'battery_transaction', 'battery_transaction', ['correction_id'], ['id'])
@@ -0,0 +1,30 @@
+"""person prefix indexes
+
+Revision ID: c81f4b7a2e05
+Revises: a3c5d9e1f240
+Create Date: 2026-10-19 20:05:13.551902
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81f4b7a2e05'
+down_revision = 'a3c5d9e1f240'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # prefix LIKE searches for the driver typeahead; pattern ops work whatever the collation
+    op.execute('CREATE INDEX ix_person_name1_prefix ON person (lower(name1) text_pattern_ops)')
+    op.execute('CREATE INDEX ix_person_name2_prefix ON person (lower(name2) text_pattern_ops)')
+    op.execute('CREATE INDEX ix_person_name3_prefix ON person (lower(name3) text_pattern_ops)')
+    op.execute('CREATE INDEX ix_person_primary_phone_number_prefix ON person (primary_phone_number text_pattern_ops)')
+
+
+def downgrade():
+    op.drop_index('ix_person_primary_phone_number_prefix', table_name='person')
+    op.drop_index('ix_person_name3_prefix', table_name='person')
+    op.drop_index('ix_person_name2_prefix', table_name='person')
+    op.drop_index('ix_person_name1_prefix', table_name='person')
@@ -0,0 +1,27 @@
+"""transaction date indexes
+
+Revision ID: e4a7b2c9d315
+Revises: c81f4b7a2e05
+Create Date: 2026-10-19 21:42:37.104518
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a7b2c9d315'
+down_revision = 'c81f4b7a2e05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_battery_transaction_driver_id_transaction_date', 'battery_transaction', ['driver_id', 'transaction_date'], unique=False)
+    op.create_index('ix_battery_transaction_battery_in_id_transaction_date', 'battery_transaction', ['battery_in_id', 'transaction_date'], unique=False)
+    op.create_index('ix_battery_transaction_battery_out_id_transaction_date', 'battery_transaction', ['battery_out_id', 'transaction_date'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_battery_transaction_battery_out_id_transaction_date', table_name='battery_transaction')
+    op.drop_index('ix_battery_transaction_battery_in_id_transaction_date', table_name='battery_transaction')
+    op.drop_index('ix_battery_transaction_driver_id_transaction_date', table_name='battery_transaction')
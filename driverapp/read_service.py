@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+import os
+from aiohttp import web
+from app.read_service import create_read_app
+from config import get_config
+
+app = create_read_app(get_config())
+
+if __name__ == '__main__':
+    web.run_app(app, port=int(os.environ.get('READ_SERVICE_PORT') or 5001))
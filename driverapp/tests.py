@@ -1,16 +1,1950 @@
 #!/usr/bin/env python
 from datetime import datetime, timedelta
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+import sqlalchemy
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+try:
+    import asyncio
+    from aiohttp.test_utils import TestClient, TestServer
+    from app.read_service import create_read_app
+except ImportError:
+    create_read_app = None
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import QueuePool
 from app import create_app, db
-from app.models import User, Person, Driver, Vehicle, Battery, ChargingStation, BatteryTransaction, DriverSummary
-from app.controllers.summaries import _rollover
-from config import Config
+from app.models import User, Person, Driver, Vehicle, Battery, ChargingStation, BatteryTransaction, DriverSummary, DriverSummaryBlock, \
+        DriverState, ChargingStationState, OutboxEvent, BatteryTransactionArchive
+from app.controllers.summaries import _rollover, rollover, rebuild, get_summaries, cumulative_totals
+from app.controllers.transactions import add_transaction, add_transaction_once, lock_objects, retry_on_conflict
+from app.controllers.exports import HAS_PYARROW
+from app.controllers.imports import IMPORT_COLUMNS, import_transactions
+from app.controllers.ingest import IngestScheduler, partition
+from app.controllers.fleet import refresh_fleet_state
+from app.controllers.search import search_drivers, explain_search, POSTGRES_INDEXES, _search_database, _prefix_index
+from app.controllers.records import transaction_records, link_transactions
+from app.controllers.fleet_rebuild import FleetRebuilder, read_checkpoint, rebuild_driver, verify_totals
+from app.controllers.validation import TransactionValidationError
+from app.controllers.outbox import SWAP_ADDED, SWAP_CORRECTED, FilePublisher, relay, relay_batch
+from app.controllers.drift import drifted_days, find_drift, drifted_block_drivers, repair_drift
+from app.controllers.archive import archive_horizon, archive_transactions, resolve_transaction
+from app.main.views import driver_fragment_key
+from app.counters import station_counters, RedisBackend
+from app.broadcast import broadcaster, station_channel, driver_channel, RedisBroker
+from app.leaderboard import leaderboard, period_start, period_end, RedisBackend as LeaderboardRedisBackend
+from app.engine import configure_engine
+from app.routing import REPLICA_BIND
+from config import Config, WebConfig, WorkerConfig, get_config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     ELASTICSEARCH_URL = None
+    WTF_CSRF_ENABLED = False
+    OUTBOX_PUBLISHER = 'none'
+    STATION_COUNTERS = 'simple'
+    LEADERBOARD = 'simple'
+    BROADCAST = 'simple'
+    BROADCAST_STREAMS = True
+
+class DatabaseCase(unittest.TestCase):
+    '''
+    Base for tests which save objects to the (in memory) test database
+    '''
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_driver_history(self, days, name='Ozias', phone_number='+256787737792'):
+        '''
+        Adds a driver who swapped a battery once a day for the given number of days
+        Returns the driver and its transactions, oldest first
+        '''
+        start_date = datetime.utcnow() - timedelta(days=days + 1)
+        charging_station = ChargingStation(name='Kiryanwompo {}'.format(phone_number))
+        batteries = [Battery(serial='{}-{}'.format(phone_number, i), voltage=12, capacity=200,
+            charging_station=charging_station) for i in range(2)]
+        vehicle = Vehicle(vin='I-{}'.format(phone_number))
+        person = Person(name1=name, primary_phone_number=phone_number)
+        driver = Driver(person=person, current_vehicle=vehicle, date_started=start_date)
+        db.session.add_all([charging_station, vehicle, person, driver] + batteries)
+        db.session.flush()
+
+        for day in range(days):
+            battery_in = vehicle.battery
+            battery_out = batteries[(day + 1) % 2] if battery_in else batteries[0]
+            add_transaction(
+                    driver = driver,
+                    battery_in = battery_in,
+                    battery_out = battery_out,
+                    charging_station = charging_station,
+                    battery_in_energy = 100 + day if battery_in else 0,
+                    battery_out_energy = 200,
+                    odometer_reading = day * 30,
+                    transaction_date = start_date + timedelta(days=day, hours=1))
+        db.session.commit()
+        transactions = BatteryTransaction.query.filter(BatteryTransaction.driver == driver)\
+                .order_by(BatteryTransaction.transaction_date.asc()).all()
+        return driver, transactions
+
+    def swap_now(self, driver, **kwargs):
+        '''
+        Swaps the battery on the driver's vehicle for one at the first charging station
+        '''
+        station = ChargingStation.query.first()
+        swap = dict(
+                driver = driver,
+                battery_in = driver.current_vehicle.battery,
+                battery_out = Battery.query.filter_by(charging_station=station).first(),
+                charging_station = station,
+                battery_in_energy = 50,
+                battery_out_energy = 200,
+                odometer_reading = 1000)
+        swap.update(kwargs)
+        return retry_on_conflict(lambda: add_transaction(**swap))
+
+    def login(self):
+        '''
+        Returns a test client with a logged in user
+        '''
+        user = User(username='susan')
+        user.set_password('cat')
+        db.session.add(user)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+        return client
+
+    def summary_values(self, driver):
+        return [(s.start_date, s.ride_distance, s.energy_used,
+                    s.cumulative_ride_distance, s.cumulative_energy_used)
+                for s in get_summaries(driver)]
+
+    def block_values(self, driver):
+        return [(b.start_date, b.ride_distance, b.energy_used)
+                for b in DriverSummaryBlock.query.filter_by(driver_id=driver.id).order_by(DriverSummaryBlock.start_date)]
+
+
+class SummaryRebuildCase(DatabaseCase):
+    def test_rebuild_matches_rollover(self):
+        '''
+        A rebuild after a backdated change gives the same summaries as rolling over from scratch
+        '''
+        driver, transactions = self.add_driver_history(10)
+        transactions[2].battery_in_energy -= 20
+        transactions[5].odometer_reading += 5
+        for summary in rebuild(driver, transactions[2].transaction_date):
+            db.session.add(summary)
+        db.session.commit()
+        rebuilt = self.summary_values(driver)
+        rebuilt_blocks = self.block_values(driver)
+
+        DriverSummary.query.delete()
+        DriverSummaryBlock.query.delete()
+        for summary in rollover(driver, datetime.utcnow()):
+            db.session.add(summary)
+        db.session.commit()
+        self.assertEqual(rebuilt, self.summary_values(driver))
+        self.assertEqual(rebuilt_blocks, self.block_values(driver))
+
+    def test_rebuild_updates_in_place(self):
+        '''
+        Only the changed summary and its block are rewritten; later summaries keep their rows
+        '''
+        driver, transactions = self.add_driver_history(10)
+        ids = [s.id for s in DriverSummary.query.order_by(DriverSummary.start_date)]
+        transactions[2].battery_in_energy -= 20
+        db.session.flush()
+
+        changed = rebuild(driver, transactions[2].transaction_date, transactions[-1].transaction_date)
+        db.session.commit()
+
+        summary = DriverSummary.query.get(ids[2])
+        block = DriverSummaryBlock.query.filter_by(driver_id=driver.id,
+                start_date=DriverSummaryBlock.get_start_date(summary.start_date)).one()
+        self.assertEqual(changed, [summary, block])
+        self.assertEqual(ids, [s.id for s in DriverSummary.query.order_by(DriverSummary.start_date)])
+
+    def test_cumulative_totals(self):
+        '''
+        Cumulative totals from blocks match the running totals of the daily summaries
+        '''
+        driver, transactions = self.add_driver_history(70)
+        summaries = get_summaries(driver)
+        self.assertGreater(DriverSummaryBlock.query.count(), 1)
+        for summary in summaries[::7]:
+            self.assertEqual(cumulative_totals(driver, summary.start_date),
+                    (summary.cumulative_ride_distance, summary.cumulative_energy_used))
+
+        later = get_summaries(driver, summaries[40].start_date)
+        self.assertEqual(later[0].cumulative_energy_used, summaries[40].cumulative_energy_used)
+        self.assertEqual(later[-1].cumulative_energy_used, summaries[-1].cumulative_energy_used)
+
+
+    def test_long_history_memory(self):
+        '''
+        Rolling over and rebuilding years of history stays within a fixed memory budget
+        '''
+        days, per_day = 3 * 365, 50
+        start_date = datetime.utcnow() - timedelta(days=days + 1)
+        driver = Driver(person=Person(name1='Ozias', primary_phone_number='+256787737792'), date_started=start_date)
+        db.session.add(driver)
+        db.session.flush()
+        db.session.execute(BatteryTransaction.__table__.insert(), [{
+            'id': i + 1,
+            'driver_id': driver.id,
+            'battery_in_energy': 100,
+            'battery_out_energy': 200,
+            'odometer_reading': i * 30,
+            'last_transaction_id': i or None,
+            'rejected': False,
+            'transaction_date': start_date + timedelta(days=i // per_day, minutes=i % per_day)}
+            for i in range(days * per_day)])
+        db.session.commit()
+
+        def peak_memory(function):
+            tracemalloc.start()
+            try:
+                function()
+                db.session.commit()
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        # a few thousand summaries are kept, but no more than a batch of transactions at a time
+        self.assertLess(peak_memory(lambda: rollover(driver, datetime.utcnow())), 8 * 1024 * 1024)
+        self.assertLess(peak_memory(lambda: rebuild(driver, start_date)), 8 * 1024 * 1024)
+        self.assertEqual(self.summary_values(driver)[-1][3], (days * per_day - 1) * 30)
+
+    def test_transaction_records(self):
+        '''
+        Records have the same values as the transactions they are read from
+        '''
+        driver, transactions = self.add_driver_history(5)
+        records = list(transaction_records(BatteryTransaction.driver_id == driver.id))
+        self.assertEqual(
+                [(r.id, r.transaction_date, r.battery_in_id, r.battery_out_id, r.ride_distance, r.energy_used) for r in records],
+                [(t.id, t.transaction_date, t.battery_in_id, t.battery_out_id, t.ride_distance, t.energy_used) for t in transactions])
+        with self.assertRaises(AttributeError):
+            records[0].odometer_reading = 10
+
+    def test_correction_relinks_later_transactions(self):
+        '''
+        The transaction after a corrected one measures its ride from the correction
+        '''
+        driver, transactions = self.add_driver_history(5)
+        corrected = transactions[2]
+        add_transaction(
+                driver = driver,
+                battery_in = corrected.battery_in,
+                battery_out = corrected.battery_out,
+                charging_station = corrected.charging_station,
+                battery_in_energy = corrected.battery_in_energy,
+                battery_out_energy = corrected.battery_out_energy,
+                odometer_reading = corrected.odometer_reading - 10,
+                correction = corrected)
+        db.session.commit()
+
+        correction = BatteryTransaction.query.filter_by(
+                transaction_date=corrected.transaction_date, rejected=False).one()
+        following = BatteryTransaction.query.get(transactions[3].id)
+        self.assertEqual(following.last_transaction_id, correction.id)
+        self.assertEqual(following.ride_distance, 40)
+        self.assertEqual(self.summary_values(driver)[-1][3], transactions[-1].odometer_reading)
+
+    def test_links_same_time_transactions_by_id(self):
+        '''
+        Transactions with the same date link in id order, whatever date the relink starts from
+        '''
+        driver, transactions = self.add_driver_history(3)
+        transactions[0].transaction_date = transactions[1].transaction_date
+        db.session.flush()
+
+        link_transactions(driver.id, transactions[0].transaction_date)
+        link_transactions(driver.id, transactions[2].transaction_date)
+        db.session.commit()
+        self.assertEqual([t.last_transaction_id for t in BatteryTransaction.query.order_by(BatteryTransaction.id)],
+                [None, transactions[0].id, transactions[1].id])
+
+
+class ExportCase(DatabaseCase):
+    def test_transactions_csv(self):
+        driver, transactions = self.add_driver_history(5)
+        other_driver, other_transactions = self.add_driver_history(3, 'Mugisha', '+256700000000')
+        client = self.login()
+
+        response = client.get('/export/transactions.csv?driver_id={}'.format(driver.id))
+        self.assertEqual(response.mimetype, 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual([int(row['id']) for row in rows], [t.id for t in transactions])
+        self.assertEqual([int(row['ride_distance']) for row in rows], [t.ride_distance for t in transactions])
+        self.assertEqual([int(row['energy_used']) for row in rows], [t.energy_used for t in transactions])
+
+        start = transactions[2].transaction_date.strftime('%Y-%m-%d')
+        response = client.get('/export/transactions.csv?start={}&charging_station_id={}'.format(
+            start, transactions[0].charging_station_id))
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual([int(row['id']) for row in rows], [t.id for t in transactions[2:]])
+
+        self.assertEqual(client.get('/export/transactions.csv?start=yesterday').status_code, 400)
+
+    def test_summaries_csv(self):
+        driver, transactions = self.add_driver_history(5)
+        client = self.login()
+        summaries = get_summaries(driver)
+
+        start = summaries[2].start_date.strftime('%Y-%m-%d')
+        response = client.get('/export/summaries.csv?start={}'.format(start))
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual([(int(row['cumulative_ride_distance']), int(row['cumulative_energy_used'])) for row in rows],
+                [(s.cumulative_ride_distance, s.cumulative_energy_used) for s in summaries[2:]])
+
+    @unittest.skipUnless(HAS_PYARROW, 'requires pyarrow')
+    def test_transactions_parquet(self):
+        import pyarrow.parquet
+        driver, transactions = self.add_driver_history(5)
+        client = self.login()
+
+        response = client.get('/export/transactions.parquet')
+        table = pyarrow.parquet.read_table(pyarrow.BufferReader(response.get_data()))
+        self.assertEqual(table.column('id').to_pylist(), [t.id for t in transactions])
+        self.assertEqual(table.column('transaction_date').to_pylist(), [t.transaction_date for t in transactions])
+
+    def test_export_command(self):
+        driver, transactions = self.add_driver_history(3)
+        from app import cli
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=['export', 'summaries', '--driver-id', str(driver.id)])
+        self.assertEqual(result.exit_code, 0, repr(result.exception))
+        rows = list(csv.DictReader(io.StringIO(result.output)))
+        self.assertEqual(len(rows), len(get_summaries(driver)))
+
+
+class DriverSearchCase(DatabaseCase):
+    def add_driver(self, name, phone_number):
+        person = Person(primary_phone_number=phone_number)
+        person.set_name(name)
+        driver = Driver(person=person, date_started=datetime.utcnow())
+        db.session.add(driver)
+        db.session.commit()
+        return driver
+
+    def test_set_name(self):
+        person = Person()
+        person.set_name('Ozias  Kato Mugisha Habimana')
+        self.assertEqual((person.name1, person.name2, person.name3), ('Ozias', 'Kato Mugisha', 'Habimana'))
+        person.set_name('Ozias')
+        self.assertEqual((person.name1, person.name2, person.name3), ('Ozias', '', ''))
+
+    def test_search(self):
+        ozias = self.add_driver('Ozias Kato Habimana', '+256787737792')
+        kato = self.add_driver('Kato Mugisha', '+256700000001')
+        self.add_driver('Gasore Ntwali', '+250788000000')
+
+        self.assertEqual([d[0] for d in search_drivers('kat')], [kato.id, ozias.id])
+        self.assertEqual([d[0] for d in search_drivers('Kato hab')], [ozias.id])
+        self.assertEqual([d[0] for d in search_drivers('25670')], [kato.id])
+        self.assertEqual([d[0] for d in search_drivers('+25678')], [ozias.id])
+        self.assertEqual(search_drivers('ato'), [])
+        self.assertEqual(search_drivers(' '), [])
+        self.assertEqual(search_drivers('kato', limit=1), [(kato.id, 'Kato Mugisha', '+256700000001')])
+
+        # new drivers are found straight away
+        new = self.add_driver('Katende', '+256711111111')
+        self.assertIn(new.id, [d[0] for d in search_drivers('kat')])
+
+        # and so are renamed ones
+        new.person.set_name('Amani Katende')
+        db.session.commit()
+        self.assertEqual([d[0] for d in search_drivers('amani')], [new.id])
+
+    def test_search_paths_agree(self):
+        '''
+        The Postgres query finds the same drivers as the prefix index
+        '''
+        self.add_driver('Ozias Kato Mugisha Habimana', '+256787737792')
+        self.add_driver('Kato Mugisha', '+256700000001')
+        self.add_driver('Gasore Ntwali', '+250788000000')
+        self.add_driver('Amani 100% Ntwali_Kato', '+250788000001')
+        for query in ['kat', 'mug', 'mugisha hab', 'ozias mug', 'ntw', '100%', 'ntwali_', 'ntwali%',
+                '+25078', '25078', 'ato', 'habimana kato']:
+            tokens = query.lower().split()
+            self.assertEqual(sorted(_search_database(tokens, 100)), sorted(_prefix_index().search(tokens, 100)), query)
+
+    def test_search_view(self):
+        client = self.login()
+        driver = self.add_driver('Ozias Habimana', '+256787737792')
+        response = client.get('/drivers/search/?q=ozi')
+        self.assertEqual(response.get_json(), {'drivers': [
+            {'id': driver.id, 'name': 'Ozias Habimana', 'phone_number': '+256787737792'}]})
+
+    def test_transaction_form(self):
+        '''
+        The form only lists the selected driver; any driver found by the search can be submitted
+        '''
+        client = self.login()
+        driver, transactions = self.add_driver_history(1)
+        self.add_driver('Kato Mugisha', '+256700000001')
+        url = '/transactions/new/{}/'.format(transactions[0].charging_station_id)
+        page = client.get(url).get_data(as_text=True)
+        self.assertIn('/drivers/search/', page)
+        self.assertNotIn('Kato', page)
+
+        battery = Battery.query.filter_by(charging_station_id=transactions[0].charging_station_id).first()
+        response = client.post(url, data={'driver_id': driver.id, 'battery_out_id': battery.id,
+            'odometer_reading': 30, 'battery_in_energy': 150, 'battery_out_energy': 200})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(BatteryTransaction.query.filter_by(driver_id=driver.id).count(), 2)
+
+
+class BatteryHistoryCase(DatabaseCase):
+    def expected_history(self, battery, transactions):
+        '''
+        The history entries of the battery, from the transaction relationships
+        '''
+        history = []
+        for t in sorted(transactions, key=lambda t: t.transaction_date, reverse=True):
+            if t.battery_in == battery:
+                history.append((t.transaction_date, t.charging_station, t.battery_in_energy, t.ride_distance, t.efficiency, ''))
+            elif t.battery_out == battery:
+                history.append((t.transaction_date, t.driver, t.battery_out_energy, '', '', t.charge_amount))
+        return history
+
+    def history_values(self, history):
+        return [(e['date'], e['owner'], e['energy'], e['distance'], e['efficiency'], e['charge_amount']) for e in history]
+
+    def test_history_in_batches(self):
+        driver, transactions = self.add_driver_history(7)
+        battery = transactions[0].battery_out
+        expected = self.expected_history(battery, transactions)
+        self.assertEqual(len(expected), 7)
+        for batch_size in (1, 2, 3, 500):
+            self.assertEqual(self.history_values(battery.iter_history(batch_size=batch_size)), expected)
+        self.assertEqual(self.history_values(battery.get_history()), expected)
+
+    def test_history_window(self):
+        driver, transactions = self.add_driver_history(7)
+        battery = transactions[0].battery_out
+        expected = self.expected_history(battery, transactions)
+
+        start_date = transactions[2].transaction_date
+        end_date = transactions[5].transaction_date
+        self.assertEqual(self.history_values(battery.iter_history(start_date, end_date, batch_size=1)),
+                [e for e in expected if start_date <= e[0] < end_date])
+        self.assertEqual(self.history_values(battery.iter_history(limit=3, batch_size=2)), expected[:3])
+        self.assertEqual(list(battery.iter_history(limit=0)), [])
+
+    def test_battery_page(self):
+        client = self.login()
+        driver, transactions = self.add_driver_history(4)
+        battery = transactions[0].battery_out
+        response = client.get('/battery/{}/?limit=2'.format(battery.id))
+        self.assertEqual(response.status_code, 200)
+        page = response.get_data(as_text=True)
+        self.assertIn(battery.serial, page)
+        self.assertEqual(page.count(transactions[0].charging_station.name), 1)
+        self.assertEqual(client.get('/battery/{}/?start=yesterday'.format(battery.id)).status_code, 400)
+
+
+class FleetStateCase(DatabaseCase):
+    def test_swaps_update_state(self):
+        '''
+        The driver's battery energy and last swap, and the station's stock, follow each swap
+        '''
+        driver, transactions = self.add_driver_history(3)
+        state = DriverState.query.filter_by(driver_id=driver.id).one()
+        self.assertEqual((state.battery_energy, state.last_transaction_id), (200, transactions[-1].id))
+        station = ChargingStationState.query.filter_by(charging_station_id=transactions[-1].charging_station_id).one()
+        # one battery on the vehicle, the other swapped in with 102
+        self.assertEqual((station.battery_count, station.energy_on_hand), (1, 102))
+
+        add_transaction(
+                driver = driver,
+                battery_in = transactions[-1].battery_out,
+                battery_out = transactions[-1].battery_in,
+                charging_station = transactions[-1].charging_station,
+                battery_in_energy = 50,
+                battery_out_energy = 180,
+                odometer_reading = 100)
+        db.session.commit()
+        self.assertEqual(state.battery_energy, 180)
+        self.assertEqual((station.battery_count, station.energy_on_hand), (1, 50))
+
+    def test_correction_updates_state(self):
+        driver, transactions = self.add_driver_history(3)
+        add_transaction(
+                driver = driver,
+                battery_in = transactions[-1].battery_in,
+                battery_out = transactions[-1].battery_out,
+                charging_station = transactions[-1].charging_station,
+                battery_in_energy = 90,
+                battery_out_energy = 170,
+                odometer_reading = 60,
+                correction = transactions[-1])
+        db.session.commit()
+        state = DriverState.query.filter_by(driver_id=driver.id).one()
+        self.assertEqual(state.battery_energy, 170)
+        self.assertNotEqual(state.last_transaction_id, transactions[-1].id)
+        station = ChargingStationState.query.filter_by(charging_station_id=transactions[-1].charging_station_id).one()
+        self.assertEqual(station.energy_on_hand, 90)
+
+    def test_refresh_matches_maintained_state(self):
+        self.add_driver_history(4)
+        self.add_driver_history(2, phone_number='+256700000001')
+        maintained = self.fleet_state()
+        DriverState.query.delete()
+        ChargingStationState.query.delete()
+        refresh_fleet_state()
+        self.assertEqual(self.fleet_state(), maintained)
+
+    def fleet_state(self):
+        return [(s.driver_id, s.battery_energy, s.last_transaction_id) for s in DriverState.query.order_by(DriverState.driver_id)] + \
+                [(s.charging_station_id, s.battery_count, s.energy_on_hand)
+                        for s in ChargingStationState.query.order_by(ChargingStationState.charging_station_id)]
+
+    def test_list_pages_use_one_query(self):
+        '''
+        The list pages run the same number of queries whatever the size of the fleet
+        '''
+        client = self.login()
+        self.add_driver_history(1)
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count)
+        self.addCleanup(sqlalchemy.event.remove, db.engine, 'before_cursor_execute', count)
+        counts = []
+        for i in range(2):
+            for page in ('/drivers/', '/charging_stations/'):
+                del statements[:]
+                response = client.get(page)
+                self.assertEqual(response.status_code, 200)
+                counts.append(len(statements))
+            if not i:
+                for j in range(3):
+                    self.add_driver_history(2, phone_number='+25670000000{}'.format(j))
+        self.assertEqual(counts[:2], counts[2:])
+        self.assertIn('Kiryanwompo +256700000002', response.get_data(as_text=True))
+
+
+class FragmentCacheCase(DatabaseCase):
+    def get_page(self, client, driver):
+        '''
+        Returns the driver page, and the statements run for its history tables
+        '''
+        statements = []
+        def record(conn, cursor, statement, *args):
+            if 'battery_transaction.battery_in_id' in statement or 'driver_summary.ride_distance AS' in statement:
+                statements.append(statement)
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = client.get('/driver/{}/'.format(driver.id))
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(response.status_code, 200)
+        return response.get_data(as_text=True), statements
+
+    def test_history_is_cached(self):
+        client = self.login()
+        driver, transactions = self.add_driver_history(3)
+        page, statements = self.get_page(client, driver)
+        self.assertTrue(statements)
+        self.assertIn(transactions[-1].battery_out.serial, page)
+
+        cached_page, statements = self.get_page(client, driver)
+        self.assertEqual(statements, [])
+        self.assertEqual(cached_page, page)
+
+    def test_new_transaction_changes_key(self):
+        client = self.login()
+        driver, transactions = self.add_driver_history(3)
+        self.get_page(client, driver)
+        add_transaction(
+                driver = driver,
+                battery_in = transactions[-1].battery_out,
+                battery_out = transactions[-1].battery_in,
+                charging_station = transactions[-1].charging_station,
+                battery_in_energy = 123,
+                battery_out_energy = 200,
+                odometer_reading = 456)
+        db.session.commit()
+        page, statements = self.get_page(client, driver)
+        self.assertTrue(statements)
+        self.assertIn('456', page)
+
+    def test_rebuild_invalidates(self):
+        '''
+        A rebuild changing summaries in place is shown once committed, but not if rolled back
+        '''
+        client = self.login()
+        driver, transactions = self.add_driver_history(3)
+        page, statements = self.get_page(client, driver)
+
+        transactions[1].odometer_reading += 1000
+        for summary in rebuild(driver, transactions[1].transaction_date):
+            db.session.add(summary)
+        db.session.rollback()
+        self.assertEqual(self.get_page(client, driver), (page, []))
+
+        transactions[1].odometer_reading += 1000
+        for summary in rebuild(driver, transactions[1].transaction_date):
+            db.session.add(summary)
+        db.session.commit()
+        page, statements = self.get_page(client, driver)
+        self.assertTrue(statements)
+        self.assertIn('1030', page)
+
+    def test_changes_bump_version(self):
+        '''
+        Swaps, corrections, rebuilds and archiving each change the key, which is read from one row
+        '''
+        driver, transactions = self.add_driver_history(3)
+        driver_id = driver.id
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            keys = [driver_fragment_key(driver)]
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(len(statements), 1)
+        self.assertIn('FROM driver_state', statements[0])
+
+        self.swap_now(driver)
+        keys.append(driver_fragment_key(Driver.query.get(driver_id)))
+        swap = BatteryTransaction.query.order_by(BatteryTransaction.id.desc()).first()
+        self.swap_now(Driver.query.get(driver_id), battery_in=swap.battery_in, battery_out=swap.battery_out, correction=swap)
+        keys.append(driver_fragment_key(Driver.query.get(driver_id)))
+
+        transactions = BatteryTransaction.query.filter_by(driver_id=driver_id, rejected=False)\
+                .order_by(BatteryTransaction.transaction_date).all()
+        transactions[1].odometer_reading += 1000
+        for summary in rebuild(Driver.query.get(driver_id), transactions[1].transaction_date):
+            db.session.add(summary)
+        db.session.commit()
+        keys.append(driver_fragment_key(Driver.query.get(driver_id)))
+
+        self.assertEqual(archive_transactions(), 1)
+        keys.append(driver_fragment_key(Driver.query.get(driver_id)))
+        self.assertEqual(len(set(keys)), len(keys), keys)
+
+
+class ImportCase(DatabaseCase):
+    def swap_log(self, transactions, phone_number):
+        '''
+        Returns CSV lines for the given transactions, as swaps of the driver with phone_number
+        '''
+        lines = io.StringIO()
+        writer = csv.DictWriter(lines, IMPORT_COLUMNS)
+        writer.writeheader()
+        for t in transactions:
+            writer.writerow({
+                'transaction_date': t.transaction_date.strftime('%Y-%m-%d %H:%M:%S'),
+                'driver_phone_number': phone_number,
+                'vin': '',
+                'charging_station': 'Kiryanwompo {}'.format(phone_number),
+                'battery_in': t.battery_in.serial.replace(t.driver.person.primary_phone_number, phone_number) if t.battery_in else '',
+                'battery_out': t.battery_out.serial.replace(t.driver.person.primary_phone_number, phone_number) if t.battery_out else '',
+                'battery_in_energy': t.battery_in_energy,
+                'battery_out_energy': t.battery_out_energy,
+                'odometer_reading': t.odometer_reading,
+            })
+        lines.seek(0)
+        return lines
+
+    def test_import_matches_added_transactions(self):
+        '''
+        Importing a swap log, in any order, gives the same state as adding the swaps one by one
+        '''
+        driver, transactions = self.add_driver_history(6)
+        imported_driver, _ = self.add_driver_history(0, name='Kato', phone_number='+256700000001')
+        imported_driver.date_started = driver.date_started
+        log = self.swap_log(reversed(transactions), '+256700000001')
+
+        result = import_transactions(log)
+        db.session.commit()
+
+        self.assertEqual(result.imported, len(transactions))
+        self.assertEqual(result.errors, [], result.errors)
+        self.assertEqual(result.drivers, 1)
+        imported = BatteryTransaction.query.filter_by(driver=imported_driver)\
+                .order_by(BatteryTransaction.transaction_date).all()
+        self.assertEqual([t.last_transaction for t in imported], [None] + imported[:-1])
+        self.assertEqual(imported_driver.current_vehicle.battery.serial[-2:],
+                driver.current_vehicle.battery.serial[-2:])
+        self.assertEqual([b.charging_station is None for b in Battery.query.filter(Battery.serial.like('+256700000001%')).order_by(Battery.serial)],
+                [b.charging_station is None for b in Battery.query.filter(Battery.serial.like('+256787737792%')).order_by(Battery.serial)])
+        # the rebuild also fills in the days up to today
+        summaries = self.summary_values(driver)
+        self.assertEqual(self.summary_values(imported_driver)[:len(summaries)], summaries)
+
+    def test_backdated_import_relinks_history(self):
+        '''
+        A swap imported into the middle of existing history becomes the last transaction of the next one
+        '''
+        driver, transactions = self.add_driver_history(4)
+        backdated = BatteryTransaction(driver=driver, battery_in=transactions[1].battery_out,
+                battery_out=transactions[1].battery_in, battery_in_energy=150, battery_out_energy=200,
+                odometer_reading=40, transaction_date=transactions[1].transaction_date + timedelta(hours=2))
+        log = self.swap_log([backdated], '+256787737792')
+        version = DriverState.query.filter_by(driver_id=driver.id).one().history_version
+
+        import_transactions(log)
+        db.session.commit()
+        self.assertGreater(DriverState.query.filter_by(driver_id=driver.id).one().history_version, version)
+
+        history = BatteryTransaction.query.filter_by(driver=driver)\
+                .order_by(BatteryTransaction.transaction_date).all()
+        self.assertEqual(len(history), 5)
+        self.assertEqual([t.last_transaction for t in history], [None] + history[:-1])
+        self.assertEqual(self.summary_values(driver)[1][1:3], (40, 149))
+
+    def test_odometer_readings(self):
+        '''
+        Rows whose odometer reading goes backwards, from the driver's swaps or an earlier row, are skipped
+        '''
+        driver, transactions = self.add_driver_history(4)
+        def swap(after, hours, odometer_reading):
+            return BatteryTransaction(driver=driver, battery_in=after.battery_out, battery_out=after.battery_in,
+                    battery_in_energy=150, battery_out_energy=200, odometer_reading=odometer_reading,
+                    transaction_date=after.transaction_date + timedelta(hours=hours))
+        rows = [swap(transactions[3], 2, 95), swap(transactions[2], 2, 100),
+                swap(transactions[1], 3, 35), swap(transactions[1], 2, 40)]
+        log = self.swap_log(rows, '+256787737792')
+
+        result = import_transactions(log)
+        db.session.commit()
+
+        self.assertEqual(result.imported, 2)
+        self.assertEqual([e.line for e in result.errors], [3, 4])
+        self.assertIn('higher than the next swap (90)', result.errors[0].message)
+        self.assertIn('lower than the previous swap (40)', result.errors[1].message)
+        readings = [t.odometer_reading for t in BatteryTransaction.query.filter_by(driver_id=driver.id)\
+                .order_by(BatteryTransaction.transaction_date)]
+        self.assertEqual(readings, [0, 30, 40, 60, 90, 95])
+
+    def test_invalid_rows(self):
+        '''
+        Invalid rows are reported with their line number and nothing is written for them
+        '''
+        driver, transactions = self.add_driver_history(2)
+        log = self.swap_log(transactions, '+256787737792').getvalue().splitlines()
+        log[1] = log[1].replace('+256787737792-', 'X-', 1)
+        log[2] = log[2].replace(',200,', ',201,', 1)
+        log.append('yesterday,+256787737792,,Kiryanwompo +256787737792,,+256787737792-0,0,200,90')
+
+        result = import_transactions(log, dry_run=True)
+
+        self.assertEqual(result.imported, 0)
+        self.assertEqual([e.line for e in result.errors], [2, 3, 4])
+        self.assertIn('Unknown battery', result.errors[0].message)
+        self.assertIn('capacity', result.errors[1].message)
+        self.assertIn('transaction_date', result.errors[2].message)
+
+    def test_idempotency_keys(self):
+        '''
+        Rows with a key repeated in the log, or already imported, are skipped
+        '''
+        driver, transactions = self.add_driver_history(3)
+        self.add_driver_history(0, name='Kato', phone_number='+256700000001')
+        log = self.swap_log(transactions, '+256700000001').getvalue().splitlines()
+        log = [log[0] + ',idempotency_key'] + ['{},swap-{}'.format(line, i) for i, line in enumerate(log[1:])] + \
+                [log[1] + ',swap-0']
+
+        result = import_transactions(log)
+        db.session.commit()
+        self.assertEqual((result.imported, result.duplicates), (3, 0))
+        self.assertEqual([e.line for e in result.errors], [5])
+        self.assertIn('Repeated idempotency_key', result.errors[0].message)
+
+        result = import_transactions(log[:3])
+        db.session.commit()
+        self.assertEqual((result.imported, result.duplicates, result.errors), (0, 2, []))
+        self.assertEqual(BatteryTransaction.query.count(), 6)
+
+    def test_imports_record_events(self):
+        '''
+        Each imported swap gets the same outbox event as a swap added in the app, and a dry run gets none
+        '''
+        driver, transactions = self.add_driver_history(3)
+        imported_driver, _ = self.add_driver_history(0, name='Kato', phone_number='+256700000001')
+        OutboxEvent.query.delete()
+        log = self.swap_log(transactions, '+256700000001').getvalue().splitlines()
+
+        import_transactions(log, dry_run=True)
+        self.assertEqual(OutboxEvent.query.count(), 0)
+
+        import_transactions(log)
+        db.session.commit()
+        imported = BatteryTransaction.query.filter_by(driver=imported_driver).order_by(BatteryTransaction.id).all()
+        events = OutboxEvent.query.order_by(OutboxEvent.id).all()
+        self.assertEqual([e.event_type for e in events], [SWAP_ADDED] * 3)
+        payloads = [json.loads(e.payload) for e in events]
+        self.assertEqual([p['id'] for p in payloads], [t.id for t in imported])
+        self.assertEqual(payloads[2]['date'], imported[2].transaction_date.isoformat())
+        self.assertEqual((payloads[2]['driver_id'], payloads[2]['battery_out_energy'], payloads[2]['odometer_reading']),
+                (imported_driver.id, imported[2].battery_out_energy, imported[2].odometer_reading))
+
+
+class IngestCase(DatabaseCase):
+    '''
+    Uses a sqlite file, since worker threads each have their own connection
+    '''
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        class IngestConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + self.path
+        self.app = create_app(IngestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        super(IngestCase, self).tearDown()
+        os.remove(self.path)
+
+    def daily_swaps(self, driver, days):
+        '''
+        Returns the swaps add_driver_history would add for the driver, latest first
+        '''
+        batteries = Battery.query.filter(Battery.serial.like(driver.person.primary_phone_number + '%'))\
+                .order_by(Battery.serial).all()
+        swaps = []
+        battery_in = None
+        for day in range(days):
+            battery_out = batteries[(day + 1) % 2] if battery_in else batteries[0]
+            swaps.append({
+                'driver_id': driver.id,
+                'battery_in_id': battery_in.id if battery_in else None,
+                'battery_out_id': battery_out.id,
+                'charging_station_id': batteries[0].charging_station_id,
+                'battery_in_energy': 100 + day if battery_in else 0,
+                'battery_out_energy': 200,
+                'odometer_reading': day * 30,
+                'transaction_date': driver.date_started + timedelta(days=day, hours=1),
+            })
+            battery_in = battery_out
+        return swaps[::-1]
+
+    def test_partition(self):
+        '''
+        Swaps sharing a driver or a battery end up in the same queue, in date order
+        '''
+        swaps = [
+            {'driver_id': 1, 'battery_out_id': 10, 'transaction_date': datetime(2020, 1, 3)},
+            {'driver_id': 2, 'battery_out_id': 20, 'transaction_date': datetime(2020, 1, 1)},
+            {'driver_id': 3, 'battery_in_id': 20, 'battery_out_id': 30, 'transaction_date': datetime(2020, 1, 2)},
+            {'driver_id': 1, 'battery_in_id': 10, 'battery_out_id': 11, 'transaction_date': datetime(2020, 1, 4)},
+            {'driver_id': 4, 'battery_out_id': 40, 'transaction_date': datetime(2020, 1, 1)},
+        ]
+        queues = partition(swaps)
+        self.assertEqual([[s['driver_id'] for s in queue] for queue in queues], [[1, 1], [2, 3], [4]])
+
+    def test_ingest(self):
+        '''
+        Swaps applied by concurrent workers give the same history as adding them in order
+        '''
+        drivers = [self.add_driver_history(0, phone_number=str(i))[0] for i in range(3)]
+        for driver in drivers:
+            driver.date_started = datetime.utcnow() - timedelta(days=6)
+        db.session.commit()
+        swaps = [swap for driver in drivers for swap in self.daily_swaps(driver, 5)]
+
+        result = IngestScheduler(self.app, workers=3).run(swaps)
+
+        self.assertEqual((result.applied, result.failed, result.queues), (15, [], 3))
+        db.session.expire_all()
+        for driver in drivers:
+            history = BatteryTransaction.query.filter_by(driver=driver)\
+                    .order_by(BatteryTransaction.transaction_date).all()
+            self.assertEqual([t.last_transaction for t in history], [None] + history[:-1])
+            self.assertEqual(driver.current_vehicle.battery, history[-1].battery_out)
+            self.assertEqual(get_summaries(driver)[-1].cumulative_ride_distance, 120)
+
+    def test_failed_swap_stops_its_queue(self):
+        driver, _ = self.add_driver_history(0)
+        swaps = self.daily_swaps(driver, 3)
+        # an unknown driver swapping the same batteries joins the same queue
+        swaps[1]['driver_id'] = 999
+
+        result = IngestScheduler(self.app, workers=2).run(swaps)
+
+        self.assertEqual((result.applied, result.queues), (1, 1))
+        self.assertEqual([f.swap['driver_id'] for f in result.failed], [999, driver.id])
+        self.assertIn('earlier swap', result.failed[1].message)
+        self.assertEqual(BatteryTransaction.query.count(), 1)
+
+    def test_workers_need_connections(self):
+        self.app.config.update(SQLALCHEMY_POOL_SIZE=1, SQLALCHEMY_MAX_OVERFLOW=1)
+        from app import cli
+        cli.register(self.app)
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['ingest-swaps', '--workers', '3', '-'], input=','.join(IMPORT_COLUMNS) + '\n')
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('the pool has 2', result.output)
+
+        result = runner.invoke(args=['ingest-swaps', '-'], input=','.join(IMPORT_COLUMNS) + '\n')
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('0 swaps applied in 0 queues', result.output)
+
+    def test_repeated_ingest(self):
+        '''
+        Swaps with idempotency keys are not applied again when the log is ingested again
+        '''
+        driver, _ = self.add_driver_history(0)
+        driver.date_started = datetime.utcnow() - timedelta(days=6)
+        db.session.commit()
+        swaps = self.daily_swaps(driver, 4)
+        for i, swap in enumerate(swaps):
+            swap['idempotency_key'] = 'swap-{}'.format(i)
+
+        self.assertEqual(IngestScheduler(self.app, workers=2).run(swaps[2:]), (2, [], 1, 0))
+        self.assertEqual(IngestScheduler(self.app, workers=2).run(swaps), (2, [], 1, 2))
+        db.session.expire_all()
+        history = BatteryTransaction.query.filter_by(driver=driver).order_by(BatteryTransaction.transaction_date).all()
+        self.assertEqual([t.idempotency_key for t in history], ['swap-3', 'swap-2', 'swap-1', 'swap-0'])
+        self.assertEqual(get_summaries(driver)[-1].cumulative_ride_distance, 90)
+
+
+class FleetRebuildCase(DatabaseCase):
+    '''
+    Uses a sqlite file, since the worker processes each have their own connection
+    '''
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.checkpoint = self.path + '.checkpoint'
+
+        class RebuildConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + self.path
+        self.app = create_app(RebuildConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        super(FleetRebuildCase, self).tearDown()
+        os.remove(self.path)
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def add_drivers(self):
+        drivers = [self.add_driver_history(6, phone_number='+25678773779{}'.format(i))[0] for i in range(3)]
+        expected = [self.summary_values(driver) for driver in drivers]
+
+        # a summary with the wrong totals, and a missing block
+        summary = DriverSummary.query.filter_by(driver_id=drivers[0].id).order_by(DriverSummary.start_date).all()[3]
+        summary.ride_distance += 5
+        DriverSummaryBlock.query.filter_by(driver_id=drivers[1].id).delete()
+        db.session.commit()
+        return drivers, expected
+
+    def test_rebuild_resumes_from_checkpoint(self):
+        drivers, expected = self.add_drivers()
+        self.assertEqual([m.driver_id for m in verify_totals()], [drivers[0].id, drivers[1].id])
+        with open(self.checkpoint, 'w') as checkpoint:
+            checkpoint.write('{}\n'.format(drivers[2].id))
+
+        finished = []
+        result = FleetRebuilder(self.app, workers=2, checkpoint=self.checkpoint, shard_size=1)\
+                .run(lambda done, total: finished.append((done, total)))
+        db.session.remove()
+
+        self.assertEqual(result, (2, 1, []))
+        self.assertEqual(sorted(finished), [(2, 3), (3, 3)])
+        self.assertEqual(verify_totals(), [])
+        # rolled over up to now, with empty summaries after the last swap
+        self.assertEqual([self.summary_values(driver)[:len(values)] for driver, values in zip(drivers, expected)], expected)
+        self.assertEqual(read_checkpoint(self.checkpoint), set(driver.id for driver in drivers))
+
+    def test_rebuild_command(self):
+        drivers, expected = self.add_drivers()
+        db.session.remove()
+        from app import cli
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=['rebuild-summaries', '--workers', '2', '--checkpoint', self.checkpoint])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('3 drivers rebuilt, 0 already rebuilt, 0 failed', result.output)
+        self.assertIn('0 drivers with totals not matching', result.output)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+
+class DriftCase(DatabaseCase):
+    def test_find_and_repair_drift(self):
+        driver, transactions = self.add_driver_history(20)
+        other, other_transactions = self.add_driver_history(5, phone_number='+256700000001')
+        expected = self.summary_values(driver)
+        self.assertEqual(find_drift(), [])
+
+        summaries = DriverSummary.query.filter_by(driver_id=driver.id).order_by(DriverSummary.start_date).all()
+        summaries[3].ride_distance += 5
+        db.session.delete(summaries[5])
+        summaries[15].energy_used -= 1
+        # a change made behind the summaries' back
+        db.session.execute(BatteryTransaction.__table__.update()\
+                .where(BatteryTransaction.id == other_transactions[2].id).values(battery_in_energy=90))
+        db.session.commit()
+
+        day = lambda transaction: DriverSummary.get_start_date(transaction.transaction_date)
+        self.assertEqual([(d.driver_id, d.day) for d in drifted_days()],
+                [(driver.id, summaries[3].start_date), (driver.id, summaries[5].start_date),
+                    (driver.id, summaries[15].start_date), (other.id, day(other_transactions[2]))])
+        ranges = find_drift()
+        self.assertEqual(ranges, [
+            (driver.id, summaries[3].start_date, summaries[6].start_date, 2),
+            (driver.id, summaries[15].start_date, summaries[16].start_date, 1),
+            (other.id, day(other_transactions[2]), day(other_transactions[2]) + timedelta(days=1), 1)])
+
+        self.assertEqual(drifted_block_drivers(), [driver.id])
+
+        repair_drift(ranges)
+        db.session.commit()
+        self.assertEqual(find_drift(), [])
+        self.assertEqual(drifted_block_drivers(), [])
+        self.assertEqual(verify_totals(), [])
+        self.assertEqual(self.summary_values(driver), expected)
+
+    def test_repair_blocks(self):
+        driver, transactions = self.add_driver_history(40)
+        expected = self.block_values(driver)
+        DriverSummaryBlock.query.filter_by(driver_id=driver.id).first().energy_used += 7
+        db.session.commit()
+        self.assertEqual(find_drift(), [])
+        self.assertEqual(drifted_block_drivers(), [driver.id])
+        repair_drift([], drifted_block_drivers())
+        db.session.commit()
+        self.assertEqual(self.block_values(driver), expected)
+
+    def test_check_command(self):
+        driver, transactions = self.add_driver_history(3)
+        DriverSummary.query.filter_by(driver_id=driver.id).first().ride_distance += 1
+        db.session.commit()
+        from app import cli
+        cli.register(self.app)
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['check-summaries'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('1 drifted ranges, 1 drivers with drifted blocks', result.output)
+        result = runner.invoke(args=['check-summaries', '--repair'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(find_drift(), [])
+
+
+class ArchiveCase(DatabaseCase):
+    def add_archivable_history(self):
+        '''
+        Adds a driver with three months of swaps, the last one corrected
+        Returns the driver, the ids of its transactions, and the start of the month of the 45th
+        '''
+        driver, transactions = self.add_driver_history(90)
+        corrected = transactions[-1]
+        retry_on_conflict(lambda: add_transaction(
+                driver = driver,
+                battery_in = corrected.battery_in,
+                battery_out = corrected.battery_out,
+                charging_station = corrected.charging_station,
+                battery_in_energy = 150,
+                battery_out_energy = 200,
+                odometer_reading = corrected.odometer_reading,
+                correction = corrected))
+        return driver, [t.id for t in transactions], DriverSummaryBlock.get_start_date(transactions[45].transaction_date)
+
+    def test_archive_keeps_references(self):
+        driver, ids, before = self.add_archivable_history()
+        expected = self.summary_values(driver)
+        aged = [t.id for t in BatteryTransaction.query.filter(BatteryTransaction.transaction_date < before)]
+
+        self.assertEqual(archive_transactions(before, batch_size=7), len(aged))
+        db.session.expire_all()
+        # the last aged swap is kept, as the last transaction of the first staying one
+        self.assertEqual(sorted(t.id for t in BatteryTransactionArchive.query),
+                aged[:-1] + [ids[-1]])
+        self.assertEqual(BatteryTransaction.query.filter(BatteryTransaction.transaction_date < before).one().id, aged[-1])
+        self.assertEqual(BatteryTransaction.query.filter_by(rejected=True).count(), 0)
+        self.assertEqual(archive_horizon(), before)
+
+        boundary = BatteryTransaction.query.get(aged[-1])
+        self.assertTrue(boundary.previous_transaction.archived)
+        self.assertEqual(boundary.ride_distance, 30)
+        self.assertEqual(resolve_transaction(aged[0]).odometer_reading, 0)
+        # the correction's rejected swap is found in the archive
+        correcting = BatteryTransaction.query.filter_by(correction_id=ids[-1]).one()
+        self.assertTrue(resolve_transaction(correcting.correction_id).rejected)
+
+        self.assertEqual(self.summary_values(driver), expected)
+        self.assertEqual(find_drift(), [])
+        self.assertEqual(verify_totals(), [])
+        rebuild_driver(driver.id)
+        db.session.commit()
+        self.assertEqual(self.summary_values(driver), expected)
+
+        # archiving again moves nothing
+        self.assertEqual(archive_transactions(before), 0)
+
+    def test_rejected_only(self):
+        driver, ids, before = self.add_archivable_history()
+        self.assertEqual(archive_transactions(), 1)
+        self.assertEqual(resolve_transaction(ids[-1]).archived, True)
+        self.assertEqual(BatteryTransaction.query.count(), 90)
+        # rejected swaps do not move the horizon
+        self.assertIsNone(archive_horizon())
+        with self.assertRaises(ValueError):
+            archive_transactions(before + timedelta(days=1))
+
+    def test_swaps_before_horizon_rejected(self):
+        driver, ids, before = self.add_archivable_history()
+        archive_transactions(before)
+        vehicle_battery = driver.current_vehicle.battery
+        with self.assertRaises(TransactionValidationError) as raised:
+            retry_on_conflict(lambda: add_transaction(
+                    driver = driver,
+                    battery_in = vehicle_battery,
+                    battery_out = Battery.query.filter(Battery.charging_station != None).first(),
+                    charging_station = ChargingStation.query.first(),
+                    battery_in_energy = 50,
+                    battery_out_energy = 200,
+                    odometer_reading = 0,
+                    transaction_date = before - timedelta(days=1)))
+        self.assertIn('transaction_date', [field for field, message in raised.exception.errors])
+
+    def test_history_pages(self):
+        client = self.login()
+        driver, ids, before = self.add_archivable_history()
+        battery = BatteryTransaction.query.get(ids[0]).battery_out
+        expected = BatteryTransaction.query.filter(BatteryTransaction.rejected.is_(False),
+                (BatteryTransaction.battery_in == battery) | (BatteryTransaction.battery_out == battery)).count()
+        archive_transactions(before)
+        archived = BatteryTransactionArchive.query.filter_by(rejected=False).order_by(BatteryTransactionArchive.id).all()
+
+        page = client.get('/driver/{}/'.format(driver.id)).get_data(as_text=True)
+        self.assertNotIn('id="transaction-{}"'.format(archived[0].id), page)
+        page = client.get('/driver/{}/?archived=1'.format(driver.id)).get_data(as_text=True)
+        self.assertIn('id="transaction-{}"'.format(archived[0].id), page)
+        self.assertEqual(page.count('Archived'), len(archived))
+        self.assertNotIn('id="transaction-{}"'.format(ids[-1]), page)
+
+        history = battery.get_history(archived=True)
+        self.assertEqual(len(history), expected)
+        self.assertEqual([e['date'] for e in history], sorted((e['date'] for e in history), reverse=True))
+        self.assertLess(len(battery.get_history()), len(history))
+
+
+class ValidationCase(DatabaseCase):
+    def swap(self, driver, **kwargs):
+        vehicle_battery = driver.current_vehicle.battery
+        swap = dict(
+                driver = driver,
+                battery_in = vehicle_battery,
+                battery_out = Battery.query.filter(Battery.charging_station != None, Battery.id != vehicle_battery.id).first(),
+                charging_station = ChargingStation.query.first(),
+                battery_in_energy = 50,
+                battery_out_energy = 200,
+                odometer_reading = 1000)
+        swap.update(kwargs)
+        return lambda: add_transaction(**swap)
+
+    def error_fields(self, swap):
+        with self.assertRaises(TransactionValidationError) as raised:
+            retry_on_conflict(swap)
+        return sorted(field for field, message in raised.exception.errors)
+
+    def test_valid_swap(self):
+        driver, transactions = self.add_driver_history(3)
+        retry_on_conflict(self.swap(driver))
+        self.assertEqual(BatteryTransaction.query.count(), 4)
+
+    def test_battery_locations(self):
+        driver, transactions = self.add_driver_history(3)
+        other, other_transactions = self.add_driver_history(2, phone_number='+256700000001')
+        station = ChargingStation.query.first()
+        # the battery on the other driver's vehicle, and one which is not on this driver's
+        self.assertEqual(self.error_fields(self.swap(driver, battery_out=other.current_vehicle.battery)), ['battery_out_id'])
+        self.assertEqual(self.error_fields(self.swap(driver,
+            battery_in=Battery.query.filter_by(charging_station=station).first())), ['battery_in_id'])
+        self.assertEqual(self.error_fields(self.swap(driver, battery_in=None)), ['battery_in_id'])
+        # nothing was written, and the locks were released
+        self.assertEqual(BatteryTransaction.query.count(), 5)
+        self.assertEqual(driver.current_vehicle.battery, transactions[-1].battery_out)
+
+    def test_energy_and_odometer(self):
+        driver, transactions = self.add_driver_history(3)
+        self.assertEqual(self.error_fields(self.swap(driver, battery_in_energy=-1, battery_out_energy=201)),
+                ['battery_in_energy', 'battery_out_energy'])
+        self.assertEqual(self.error_fields(self.swap(driver, odometer_reading=59)), ['odometer_reading'])
+
+    def test_backdated_and_corrections(self):
+        '''
+        Swaps before later ones are checked against the odometer readings on either side,
+        but not against the current battery locations
+        '''
+        driver, transactions = self.add_driver_history(3)
+        correction = transactions[1]
+        self.assertEqual(self.error_fields(lambda: add_transaction(
+                driver = driver,
+                battery_in = correction.battery_in,
+                battery_out = correction.battery_out,
+                charging_station = correction.charging_station,
+                battery_in_energy = 100,
+                battery_out_energy = 200,
+                odometer_reading = 61,
+                correction = correction)), ['odometer_reading'])
+        retry_on_conflict(lambda: add_transaction(
+                driver = driver,
+                battery_in = correction.battery_in,
+                battery_out = correction.battery_out,
+                charging_station = correction.charging_station,
+                battery_in_energy = 100,
+                battery_out_energy = 200,
+                odometer_reading = 40,
+                correction = correction))
+        self.assertTrue(BatteryTransaction.query.get(correction.id).rejected)
+
+    def test_correcting_twice(self):
+        '''
+        A swap which was corrected, even by an edit which committed after this one
+        loaded it, can not be corrected again
+        '''
+        driver, transactions = self.add_driver_history(3)
+        correction = transactions[1]
+
+        def correct():
+            return add_transaction(
+                    driver = driver,
+                    battery_in = correction.battery_in,
+                    battery_out = correction.battery_out,
+                    charging_station = correction.charging_station,
+                    battery_in_energy = 100,
+                    battery_out_energy = 200,
+                    odometer_reading = 40,
+                    correction = correction)
+        retry_on_conflict(correct)
+        # as loaded before the first edit committed
+        sqlalchemy.orm.attributes.set_committed_value(correction, 'rejected', False)
+        self.assertEqual(self.error_fields(correct), ['id'])
+        self.assertEqual(BatteryTransaction.query.filter_by(rejected=False).count(), 3)
+
+        client = self.login()
+        response = client.post('/transactions/edit/{}/'.format(correction.id), data={
+            'driver_id': driver.id,
+            'battery_in_id': correction.battery_in_id,
+            'battery_out_id': correction.battery_out_id,
+            'battery_in_energy': 100,
+            'battery_out_energy': 200,
+            'odometer_reading': 40})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'has already been corrected', response.data)
+        self.assertEqual(BatteryTransaction.query.count(), 4)
+
+    def test_form_errors(self):
+        driver, transactions = self.add_driver_history(3)
+        station = ChargingStation.query.first()
+        battery_out = Battery.query.filter_by(charging_station=station).first()
+        client = self.login()
+        response = client.post('/transactions/new/{}/'.format(station.id), data={
+            'driver_id': driver.id,
+            'battery_out_id': battery_out.id,
+            'battery_in_energy': 50,
+            'battery_out_energy': 500,
+            'odometer_reading': 100})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Energy must be between 0 and the capacity', response.data)
+        self.assertEqual(BatteryTransaction.query.count(), 3)
+
+
+class IdempotencyCase(DatabaseCase):
+    def test_repeated_key(self):
+        driver, transactions = self.add_driver_history(3)
+        calls = []
+
+        def swap():
+            calls.append(1)
+            return self.swap_now(driver, idempotency_key='tablet-1-42')
+
+        transaction, added = add_transaction_once(swap, 'tablet-1-42')
+        self.assertTrue(added)
+        summaries = self.summary_values(driver)
+        events = OutboxEvent.query.count()
+
+        again, added = add_transaction_once(swap, 'tablet-1-42')
+        self.assertFalse(added)
+        self.assertEqual((again.id, len(calls)), (transaction.id, 1))
+        self.assertEqual(self.summary_values(driver), summaries)
+        self.assertEqual(OutboxEvent.query.count(), events)
+        # swaps without a key are always added
+        self.assertTrue(add_transaction_once(lambda: self.swap_now(driver, odometer_reading=1100), None)[1])
+
+    def test_unique_key(self):
+        driver, transactions = self.add_driver_history(1)
+        self.swap_now(driver, idempotency_key='tablet-1-42')
+        with self.assertRaises(sqlalchemy.exc.IntegrityError):
+            self.swap_now(driver, odometer_reading=1100, idempotency_key='tablet-1-42')
+
+    def test_form_resubmitted(self):
+        driver, transactions = self.add_driver_history(3)
+        station = ChargingStation.query.first()
+        client = self.login()
+        page = client.get('/transactions/new/{}/'.format(station.id)).get_data(as_text=True)
+        self.assertIn('name="idempotency_key"', page)
+        data = {
+            'driver_id': driver.id,
+            'battery_out_id': Battery.query.filter_by(charging_station=station).first().id,
+            'battery_in_energy': 50,
+            'battery_out_energy': 200,
+            'odometer_reading': 100,
+            'idempotency_key': 'tablet-1-42'}
+        self.assertEqual(client.post('/transactions/new/{}/'.format(station.id), data=data).status_code, 302)
+        # the battery out has left the station, but the retry is not validated again
+        self.assertEqual(client.post('/transactions/new/{}/'.format(station.id), data=data).status_code, 302)
+        self.assertEqual(BatteryTransaction.query.count(), 4)
+
+
+class OutboxCase(DatabaseCase):
+    def setUp(self):
+        super(OutboxCase, self).setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'outbox.jsonl')
+
+    def tearDown(self):
+        super(OutboxCase, self).tearDown()
+        self.directory.cleanup()
+
+    def test_swaps_record_events(self):
+        driver, transactions = self.add_driver_history(3)
+        correction = transactions[1]
+        retry_on_conflict(lambda: add_transaction(
+                driver = driver,
+                battery_in = correction.battery_in,
+                battery_out = correction.battery_out,
+                charging_station = correction.charging_station,
+                battery_in_energy = 90,
+                battery_out_energy = 200,
+                odometer_reading = 30,
+                correction = correction))
+        # an invalid swap is rolled back with its event
+        with self.assertRaises(TransactionValidationError):
+            retry_on_conflict(lambda: add_transaction(driver=driver, battery_in=driver.current_vehicle.battery,
+                charging_station=correction.charging_station, battery_in_energy=-1, odometer_reading=100))
+
+        events = FilePublisher(self.path)
+        relay(events)
+        published = events.read()
+        self.assertEqual([e.type for e in published], [SWAP_ADDED] * 3 + [SWAP_CORRECTED])
+        self.assertEqual([e.payload['id'] for e in published[:3]], [t.id for t in transactions])
+        self.assertEqual(published[3].payload['corrects'], correction.id)
+        self.assertEqual(published[3].payload['battery_in_energy'], 90)
+        self.assertEqual(published[0].payload['date'], transactions[0].transaction_date.isoformat())
+
+    def test_relay_in_batches(self):
+        driver, transactions = self.add_driver_history(5)
+        events = FilePublisher(self.path)
+        self.assertEqual(relay_batch(events, batch_size=2), 2)
+        self.assertEqual(OutboxEvent.query.count(), 3)
+        self.assertEqual(relay(events, batch_size=2), 3)
+        self.assertEqual(OutboxEvent.query.count(), 0)
+
+        # consumers read on from where they stopped
+        first = events.read(count=2)
+        rest = events.read(first[-1].offset)
+        self.assertEqual([e.payload['id'] for e in first + rest], [t.id for t in transactions])
+        self.assertEqual(events.read(rest[-1].offset), [])
+
+    def test_relay_command(self):
+        driver, transactions = self.add_driver_history(2)
+        self.app.config.update(OUTBOX_PUBLISHER='file', OUTBOX_FILE=self.path)
+        from app import cli
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=['relay-outbox'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('2 events published', result.output)
+        self.assertEqual(len(FilePublisher(self.path).read()), 2)
+
+
+class StationCountersCase(DatabaseCase):
+    def expected(self, station, swaps):
+        state = ChargingStationState.query.filter_by(charging_station_id=station.id).one()
+        return [(station.id, station.name, swaps, state.battery_count, state.energy_on_hand)]
+
+    def check_counters(self):
+        driver, transactions = self.add_driver_history(3)
+        station = ChargingStation.query.first()
+        # the history is more than an hour old
+        self.assertEqual(station_counters.counts(), self.expected(station, 0))
+
+        self.swap_now(driver)
+        with self.assertRaises(TransactionValidationError):
+            self.swap_now(driver, battery_in_energy=-1)
+        self.assertEqual(station_counters.counts(), self.expected(station, 1))
+        self.assertEqual(station_counters.counts()[0].energy_on_hand, 50)
+
+        # a correction replaces the swap it corrects
+        swap = BatteryTransaction.query.order_by(BatteryTransaction.id.desc()).first()
+        self.swap_now(driver, battery_in=swap.battery_in, battery_out=swap.battery_out,
+                battery_in_energy=60, correction=swap)
+        self.assertEqual(station_counters.counts(), self.expected(station, 1))
+        self.assertEqual(station_counters.counts()[0].energy_on_hand, 60)
+        # an hour later
+        self.assertEqual(station_counters.counts(now=time.time() + 60 * 60 + 1)[0].swaps, 0)
+
+        counts = station_counters.counts()
+        station_counters.rebuild(db.session)
+        self.assertEqual(station_counters.counts(), counts)
+
+    def test_simple_counters(self):
+        self.check_counters()
+
+    @unittest.skipUnless(fakeredis, 'fakeredis is not installed')
+    def test_redis_counters(self):
+        self.app.extensions['station_counters'] = RedisBackend(client=fakeredis.FakeStrictRedis())
+        self.check_counters()
+
+    def test_dashboard(self):
+        driver, transactions = self.add_driver_history(2)
+        client = self.login()
+        self.swap_now(driver)
+        station = ChargingStation.query.first()
+        response = client.get('/dashboard/stations/')
+        self.assertEqual(response.get_json()['stations'], [{'charging_station_id': station.id, 'name': station.name,
+            'swaps': 1, 'battery_count': 1, 'energy_on_hand': 50}])
+        self.assertIn(station.name.encode('utf-8'), client.get('/dashboard/').data)
+
+    def test_rebuild_command(self):
+        from app import cli
+        cli.register(self.app)
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['rebuild-station-counters'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('STATION_COUNTERS is simple', result.output)
+
+        self.app.extensions['station_counters'] = None
+        self.assertIn('STATION_COUNTERS is none', runner.invoke(args=['rebuild-station-counters']).output)
+        self.assertEqual(station_counters.counts(), [])
+
+    @unittest.skipUnless(fakeredis, 'fakeredis is not installed')
+    def test_redis_rebuild_command(self):
+        driver, transactions = self.add_driver_history(2)
+        self.app.extensions['station_counters'] = RedisBackend(client=fakeredis.FakeStrictRedis())
+        from app import cli
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=['rebuild-station-counters'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('1 stations counted', result.output)
+
+
+class LeaderboardCase(DatabaseCase):
+    def expected(self, window, date):
+        '''
+        The standings in the window's period holding date, from every driver's summaries
+        '''
+        start_date = period_start(window, date)
+        end_date = period_end(window, start_date)
+        totals = []
+        for driver in Driver.query.order_by(Driver.id):
+            summaries = [s for s in get_summaries(driver) if start_date <= s.start_date < end_date]
+            ride_distance = sum(s.ride_distance for s in summaries)
+            energy_used = sum(s.energy_used for s in summaries)
+            if energy_used:
+                totals.append((driver.id, ride_distance, energy_used))
+        totals.sort(key=lambda t: t[1] / t[2], reverse=True)
+        return [(i + 1, driver_id, round(ride_distance / energy_used, 2), ride_distance, energy_used)
+                for i, (driver_id, ride_distance, energy_used) in enumerate(totals)]
+
+    def standings(self, window, date):
+        return [tuple(standing) for standing in leaderboard.top(window, 10, date)]
+
+    def check_leaderboard(self):
+        driver, transactions = self.add_driver_history(10)
+        other, other_transactions = self.add_driver_history(4, phone_number='+256700000001')
+        date = transactions[-1].transaction_date
+        for window in ('week', 'month'):
+            expected = self.expected(window, date)
+            self.assertEqual(len(expected), 2)
+            self.assertNotEqual(expected[0][2], expected[1][2])
+            self.assertEqual(self.standings(window, date), expected)
+            self.assertEqual(tuple(leaderboard.rank(window, other.id, date)), [s for s in expected if s[1] == other.id][0])
+        self.assertIsNone(leaderboard.rank('week', driver.id, date - timedelta(days=400)))
+
+        # a correction changes the driver's totals, and a rejected swap does not
+        before = leaderboard.rank('week', driver.id, date)
+        swap = transactions[-1]
+        retry_on_conflict(lambda: add_transaction(driver=driver, battery_in=swap.battery_in, battery_out=swap.battery_out,
+                charging_station=swap.charging_station, battery_in_energy=180, battery_out_energy=200,
+                odometer_reading=swap.odometer_reading, correction=swap))
+        with self.assertRaises(TransactionValidationError):
+            self.swap_now(other, battery_in_energy=-1)
+        self.assertEqual(leaderboard.rank('week', driver.id, date).energy_used, before.energy_used - (180 - 109))
+        for window in ('week', 'month'):
+            self.assertEqual(self.standings(window, date), self.expected(window, date))
+
+        standings = self.standings('month', date)
+        leaderboard.rebuild(db.session, now=date)
+        self.assertEqual(self.standings('month', date), standings)
+
+    def test_simple_leaderboard(self):
+        self.check_leaderboard()
+
+    @unittest.skipUnless(fakeredis, 'fakeredis is not installed')
+    def test_redis_leaderboard(self):
+        self.app.extensions['leaderboard'] = LeaderboardRedisBackend(client=fakeredis.FakeStrictRedis())
+        self.check_leaderboard()
+
+    def test_periods(self):
+        monday = datetime(2026, 10, 19)
+        self.assertEqual(period_start('week', monday + timedelta(days=6, hours=23)), monday)
+        self.assertEqual(period_end('week', monday), datetime(2026, 10, 26))
+        self.assertEqual(period_start('month', datetime(2026, 12, 31, 23)), datetime(2026, 12, 1))
+        self.assertEqual(period_end('month', datetime(2026, 12, 1)), datetime(2027, 1, 1))
+
+    def test_pages(self):
+        driver, transactions = self.add_driver_history(10)
+        client = self.login()
+        date = transactions[-1].transaction_date.strftime('%Y-%m-%d')
+        page = client.get('/leaderboard/?window=month&date={}'.format(date)).get_data(as_text=True)
+        self.assertIn(driver.display_name, page)
+        self.assertEqual(client.get('/leaderboard/?window=year').status_code, 400)
+        self.assertIn('Efficiency rank this week', client.get('/driver/{}/'.format(driver.id)).get_data(as_text=True))
+
+    def test_command_refuses_simple(self):
+        from app import cli
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=['rebuild-leaderboard'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('LEADERBOARD is simple', result.output)
+
+    @unittest.skipUnless(fakeredis, 'fakeredis is not installed')
+    def test_command(self):
+        driver, transactions = self.add_driver_history(10)
+        self.app.extensions['leaderboard'] = LeaderboardRedisBackend(client=fakeredis.FakeStrictRedis())
+        from app import cli
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=['rebuild-leaderboard', '--periods', '3'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(result.output.count('drivers ranked'), 6)
+        self.assertEqual(leaderboard.top('month', date=transactions[-1].transaction_date)[0].driver_id, driver.id)
+
+
+class BroadcastCase(DatabaseCase):
+    def messages(self, subscription):
+        messages = []
+        while True:
+            message = subscription.get(0.1)
+            if message is None:
+                return messages
+            messages.append(json.loads(message))
+
+    def check_broadcast(self):
+        driver, transactions = self.add_driver_history(2)
+        station = ChargingStation.query.first()
+        subscription = broadcaster.backend.subscribe([station_channel(station.id), driver_channel(driver.id)])
+        try:
+            self.swap_now(driver)
+            swap = BatteryTransaction.query.order_by(BatteryTransaction.id.desc()).first()
+            with self.assertRaises(TransactionValidationError):
+                self.swap_now(driver, battery_in_energy=-1)
+            # once for each channel
+            messages = self.messages(subscription)
+            self.assertEqual([(event_type, event_id) for event_type, data, event_id in messages],
+                    [('swap', swap.id), ('swap', swap.id), ('stock', None)])
+            self.assertEqual(messages[0][1]['battery_out'], swap.battery_out.serial)
+            self.assertEqual(messages[0][1]['odometer_reading'], 1000)
+            self.assertEqual(messages[2][1]['energy_on_hand'], 50)
+
+            self.swap_now(driver, battery_in=swap.battery_in, battery_out=swap.battery_out, correction=swap)
+            self.assertEqual(self.messages(subscription)[0][1]['corrects'], swap.id)
+        finally:
+            subscription.close()
+
+    def test_simple_broadcast(self):
+        self.check_broadcast()
+
+    @unittest.skipUnless(fakeredis, 'fakeredis is not installed')
+    def test_redis_broadcast(self):
+        self.app.extensions['broadcast'] = RedisBroker(client=fakeredis.FakeStrictRedis())
+        self.check_broadcast()
+
+    def test_event_stream(self):
+        driver, transactions = self.add_driver_history(2)
+        driver_id = driver.id
+        station = ChargingStation.query.first()
+        station_id = station.id
+        self.app.config['BROADCAST_KEEPALIVE'] = 0.1
+        client = self.login()
+        self.assertIn('/charging_station/{}/events/'.format(station_id).encode('utf-8'),
+                client.get('/charging_station/{}/'.format(station_id)).data)
+
+        response = client.get('/charging_station/{}/events/'.format(station_id), buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = iter(response.response)
+        self.assertEqual(next(chunks), b'retry: 3000\n\n')
+        self.assertEqual(next(chunks), b': keepalive\n\n')
+        # the stream released the session
+        self.swap_now(Driver.query.get(driver_id))
+        swap = BatteryTransaction.query.order_by(BatteryTransaction.id.desc()).first()
+        self.assertEqual(next(chunks), 'id: {}\n'.format(swap.id).encode('utf-8'))
+        self.assertTrue(next(chunks).startswith(b'event: swap\ndata: {'))
+        self.assertTrue(next(chunks).startswith(b'event: stock\ndata: {'))
+        response.close()
+        self.assertEqual(broadcaster.backend.subscriptions[station_channel(station_id)], set())
+
+    def test_no_streams_on_sync_workers(self):
+        driver, transactions = self.add_driver_history(2)
+        station = ChargingStation.query.first()
+        self.app.config['BROADCAST_STREAMS'] = False
+        client = self.login()
+        self.assertNotIn(b'/events/', client.get('/charging_station/{}/'.format(station.id)).data)
+        self.assertNotIn(b'/events/', client.get('/driver/{}/'.format(driver.id)).data)
+        self.assertEqual(client.get('/driver/{}/events/'.format(driver.id)).status_code, 404)
+
+
+@unittest.skipUnless(create_read_app, 'aiohttp is not installed')
+class ReadServiceCase(DatabaseCase):
+    '''
+    Uses a sqlite file, since the service reads through its own connections
+    '''
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        class ReadConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + self.path
+            READ_SERVICE_INSECURE = True
+        self.config = ReadConfig
+        self.app = create_app(ReadConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        super(ReadServiceCase, self).tearDown()
+        self.loop.close()
+        os.remove(self.path)
+
+    def get(self, *paths, headers=None):
+        '''
+        Returns the status and JSON of a GET of each path, requested concurrently
+        '''
+        async def get_all():
+            client = TestClient(TestServer(create_read_app(self.config), loop=self.loop), loop=self.loop)
+            await client.start_server()
+            try:
+                responses = await asyncio.gather(*[client.get(path, headers=headers) for path in paths], loop=self.loop)
+                return [(response.status, await response.json() if response.status == 200 else None)
+                        for response in responses]
+            finally:
+                await client.close()
+        return self.loop.run_until_complete(get_all())
+
+    def test_state(self):
+        driver, transactions = self.add_driver_history(3)
+        refresh_fleet_state()
+        db.session.commit()
+        battery = driver.current_vehicle.battery
+        station = transactions[-1].charging_station
+        at_station = Battery.query.filter_by(charging_station=station).one()
+
+        (status, driver_state), (status, battery_state), (status, stocked), (status, station_state), (missing, body) = \
+                self.get('/drivers/{}'.format(driver.id), '/batteries/{}'.format(battery.id),
+                        '/batteries/{}'.format(at_station.id), '/charging_stations/{}'.format(station.id), '/drivers/1000')
+        self.assertEqual(status, 200)
+        self.assertEqual(missing, 404)
+        self.assertEqual((driver_state['name'], driver_state['battery_id'], driver_state['battery_serial'],
+            driver_state['last_transaction_id'], driver_state['last_transaction_date']),
+            ('Ozias', battery.id, battery.serial, transactions[-1].id, transactions[-1].transaction_date.isoformat()))
+        self.assertEqual((battery_state['driver_id'], battery_state['charging_station_id'], battery_state['energy']),
+                (driver.id, None, transactions[-1].battery_out_energy))
+        self.assertEqual((stocked['driver_id'], stocked['charging_station_id'], stocked['energy']),
+                (None, station.id, at_station.current_energy))
+        self.assertEqual((station_state['battery_count'], station_state['batteries']),
+                (1, [{'id': at_station.id, 'serial': at_station.serial}]))
+
+    def test_token(self):
+        self.config.READ_SERVICE_TOKEN = 'secret'
+        driver, transactions = self.add_driver_history(1)
+        path = '/drivers/{}'.format(driver.id)
+        self.assertEqual([status for status, body in self.get(path)], [401])
+        self.assertEqual([status for status, body in self.get(path, headers={'Authorization': 'Bearer secret'})], [200])
+        self.assertEqual([status for status, body in self.get(path, headers={'Authorization': 'Bearer secreT'})], [401])
+
+    def test_token_required(self):
+        self.config.READ_SERVICE_INSECURE = False
+        with self.assertRaises(RuntimeError):
+            create_read_app(self.config)
+
+
+class ConcurrencyCase(DatabaseCase):
+    def test_stale_update_is_retried(self):
+        '''
+        An update based on a stale read of a battery is retried from a fresh transaction
+        '''
+        driver, transactions = self.add_driver_history(1)
+        battery = driver.current_vehicle.battery
+        attempts = []
+
+        def move_battery():
+            attempts.append(battery.version_id)
+            if len(attempts) == 1:
+                # a concurrent swap changes the battery after it was read
+                db.session.execute('UPDATE battery SET version_id = version_id + 1 WHERE id = :id', {'id': battery.id})
+            battery.charging_station = transactions[0].charging_station
+            return battery
+
+        self.assertIs(retry_on_conflict(move_battery), battery)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(battery.charging_station, transactions[0].charging_station)
+        self.assertEqual(battery.version_id, attempts[1] + 1)
+
+    def test_conflicts_give_up(self):
+        '''
+        Conflicts are only retried a limited number of times
+        '''
+        attempts = []
+        def conflict():
+            attempts.append(1)
+            raise StaleDataError()
+        with self.assertRaises(StaleDataError):
+            retry_on_conflict(conflict, attempts=2)
+        self.assertEqual(len(attempts), 2)
+
+    def test_other_errors_are_not_retried(self):
+        attempts = []
+        def error():
+            attempts.append(1)
+            db.session.execute('SELECT * FROM missing_table')
+        with self.assertRaises(sqlalchemy.exc.OperationalError):
+            retry_on_conflict(error)
+        self.assertEqual(len(attempts), 1)
+
+
+class PostgresMixin():
+    '''
+    Runs a DatabaseCase on the scratch postgres database at TEST_POSTGRES_URI
+    '''
+    def setUp(self):
+        class PostgresConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = os.environ['TEST_POSTGRES_URI']
+        self.app = create_app(PostgresConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+
+
+@unittest.skipUnless(os.environ.get('TEST_POSTGRES_URI'), 'set TEST_POSTGRES_URI to a scratch postgres database')
+class PostgresImportCase(PostgresMixin, ImportCase):
+    pass
+
+
+@unittest.skipUnless(os.environ.get('TEST_POSTGRES_URI'), 'set TEST_POSTGRES_URI to a scratch postgres database')
+class PostgresSearchCase(PostgresMixin, DriverSearchCase):
+    def setUp(self):
+        super(PostgresSearchCase, self).setUp()
+        for statement in POSTGRES_INDEXES:
+            db.session.execute(statement)
+        db.session.commit()
+
+    def test_search_uses_indexes(self):
+        '''
+        Every alternative of the search, including later tokens of name2, is answered from an index
+        '''
+        self.add_driver('Ozias Kato Mugisha Habimana', '+256787737792')
+        db.session.execute('SET enable_seqscan = off')
+        for query in ['mug', 'kato hab', '+25678']:
+            plan = '\n'.join(explain_search(query))
+            self.assertNotIn('Seq Scan on person', plan, plan)
+        self.assertIn('ix_person_name2_trgm', '\n'.join(explain_search('mug')))
+
+
+@unittest.skipUnless(os.environ.get('TEST_POSTGRES_URI'), 'set TEST_POSTGRES_URI to a scratch postgres database')
+class ConcurrentSwapStressCase(unittest.TestCase):
+    '''
+    Drivers at one station swapping for the same few batteries from many threads at once
+    '''
+    threads = 8
+    swaps = 10
+
+    def setUp(self):
+        class PostgresConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = os.environ['TEST_POSTGRES_URI']
+            SQLALCHEMY_POOL_SIZE = self.threads
+        self.app = create_app(PostgresConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+
+        self.charging_station = ChargingStation(name='Kiryanwompo')
+        db.session.add(self.charging_station)
+        for i in range(self.threads + 2):
+            db.session.add(Battery(serial='B-{}'.format(i), voltage=12, capacity=200, charging_station=self.charging_station))
+        for i in range(self.threads):
+            person = Person(name1='Driver {}'.format(i), primary_phone_number=str(i))
+            db.session.add(Driver(person=person, current_vehicle=Vehicle(vin='V-{}'.format(i)),
+                date_started=datetime.utcnow() - timedelta(days=1)))
+        db.session.commit()
+        self.driver_ids = [d.id for d in Driver.query.order_by(Driver.id)]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def swap(self, driver_id, errors):
+        with self.app.app_context():
+            try:
+                for i in range(self.swaps):
+                    def swap():
+                        driver = Driver.query.get(driver_id)
+                        battery_out = Battery.query.filter_by(charging_station_id=self.charging_station.id)\
+                                .order_by(Battery.id).first()
+                        lock_objects([driver], [battery_out])
+                        if battery_out.charging_station_id != self.charging_station.id:
+                            # taken by someone else while waiting for the lock
+                            db.session.rollback()
+                            return swap()
+                        return add_transaction(
+                                driver = driver,
+                                battery_in = driver.current_vehicle.battery,
+                                battery_out = battery_out,
+                                charging_station = battery_out.charging_station,
+                                battery_in_energy = 100,
+                                battery_out_energy = 200,
+                                odometer_reading = i * 10)
+                    retry_on_conflict(swap, attempts=10)
+            except Exception as err:
+                errors.append(err)
+            finally:
+                db.session.remove()
+
+    def test_concurrent_swaps(self):
+        errors = []
+        workers = [threading.Thread(target=self.swap, args=(driver_id, errors)) for driver_id in self.driver_ids]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+
+        db.session.expire_all()
+        transactions = BatteryTransaction.query.order_by(BatteryTransaction.transaction_date).all()
+        self.assertEqual(len(transactions), self.threads * self.swaps)
+
+        # each driver's history is a single chain
+        for driver_id in self.driver_ids:
+            history = [t for t in transactions if t.driver_id == driver_id]
+            self.assertEqual([t.last_transaction_id for t in history], [None] + [t.id for t in history[:-1]])
+
+        # replaying the history gives the saved battery locations and vehicle batteries
+        locations = dict((b.id, ('station', b.charging_station_id)) for b in Battery.query)
+        for transaction in transactions:
+            if transaction.battery_in_id:
+                locations[transaction.battery_in_id] = ('station', transaction.charging_station_id)
+            locations[transaction.battery_out_id] = ('vehicle', transaction.driver.current_vehicle_id)
+        for battery in Battery.query:
+            if battery.charging_station_id:
+                self.assertEqual(locations[battery.id], ('station', battery.charging_station_id))
+                self.assertEqual(battery.vehicle, [])
+            else:
+                self.assertEqual(locations[battery.id], ('vehicle', battery.vehicle[0].id))
+        self.assertEqual(Vehicle.query.filter(Vehicle.battery_id.isnot(None)).count(), self.threads)
+
+    def test_racing_corrections(self):
+        '''
+        Of two concurrent edits of the same swap, one corrects it and the other is refused
+        '''
+        driver_id = self.driver_ids[0]
+        battery = Battery.query.order_by(Battery.id).first()
+        add_transaction(driver=Driver.query.get(driver_id), battery_out=battery,
+                charging_station=self.charging_station, battery_out_energy=200)
+        db.session.commit()
+        swap_id = BatteryTransaction.query.one().id
+        results = []
+        ready = threading.Barrier(2)
+
+        def edit(energy):
+            with self.app.app_context():
+                try:
+                    correction = BatteryTransaction.query.get(swap_id)
+                    ready.wait()
+                    retry_on_conflict(lambda: add_transaction(
+                            driver = correction.driver,
+                            battery_out = correction.battery_out,
+                            charging_station = correction.charging_station,
+                            battery_out_energy = energy,
+                            correction = correction), attempts=10)
+                    results.append('corrected')
+                except TransactionValidationError as err:
+                    results.append(err.errors[0][0])
+                finally:
+                    db.session.remove()
+
+        workers = [threading.Thread(target=edit, args=(energy,)) for energy in (150, 160)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(sorted(results), ['corrected', 'id'])
+        db.session.expire_all()
+        self.assertEqual(BatteryTransaction.query.filter_by(rejected=False).count(), 1)
+
+    def test_same_station_stock(self):
+        '''
+        Swaps of different drivers and batteries at one station, which share no other
+        lock, each recount the station's stock after the others' battery moves
+        '''
+        battery_ids = [b.id for b in Battery.query.order_by(Battery.id)]
+        errors = []
+        ready = threading.Barrier(self.threads)
+
+        def take_battery(driver_id, battery_id):
+            with self.app.app_context():
+                try:
+                    ready.wait()
+                    retry_on_conflict(lambda: add_transaction(
+                            driver = Driver.query.get(driver_id),
+                            battery_out = Battery.query.get(battery_id),
+                            charging_station = ChargingStation.query.get(self.charging_station.id),
+                            battery_out_energy = 200), attempts=10)
+                except Exception as err:
+                    errors.append(err)
+                finally:
+                    db.session.remove()
+
+        workers = [threading.Thread(target=take_battery, args=args) for args in zip(self.driver_ids, battery_ids)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+
+        db.session.expire_all()
+        state = ChargingStationState.query.filter_by(charging_station_id=self.charging_station.id).one()
+        self.assertEqual(state.battery_count, Battery.query.filter_by(charging_station_id=self.charging_station.id).count())
+        self.assertEqual(state.battery_count, 2)
+
 
 class TransactionModelCase(unittest.TestCase):
     def setUp(self):
@@ -178,5 +2112,149 @@ class TransactionModelCase(unittest.TestCase):
         self.assertEqual(battery3.charging_station, cs)
         
         
+class ReplicaRoutingCase(unittest.TestCase):
+    '''
+    Uses two sqlite databases as stand ins for a primary and its replica
+    '''
+    def setUp(self):
+        self.paths = []
+        for name in ('primary', 'replica'):
+            handle, path = tempfile.mkstemp(suffix='-{}.db'.format(name))
+            os.close(handle)
+            self.paths.append(path)
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + self.paths[0]
+            SQLALCHEMY_BINDS = {REPLICA_BIND: 'sqlite:///' + self.paths[1]}
+            WTF_CSRF_ENABLED = False
+            REPLICA_LAG = 60
+
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.Model.metadata.create_all(db.get_engine(self.app, REPLICA_BIND))
+
+        user = User(username='susan')
+        user.set_password('cat')
+        db.session.add(user)
+        db.session.add(Driver(person=Person(name1='Primary', primary_phone_number='1'), date_started=datetime.utcnow()))
+        db.session.commit()
+        replica = db.get_engine(self.app, REPLICA_BIND)
+        replica.execute(Person.__table__.insert(), id=1, name1='Replica', name2='', name3='', primary_phone_number='1')
+        replica.execute(Driver.__table__.insert(), id=1, person_id=1, date_started=datetime.utcnow())
+        # each request starts with a new session, which has not written anything
+        db.session.remove()
+
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+        for path in self.paths:
+            os.remove(path)
+
+    def test_read_only_view_uses_replica(self):
+        page = self.client.get('/drivers/').get_data(as_text=True)
+        self.assertIn('Replica', page)
+        self.assertNotIn('Primary', page)
+
+    def test_other_views_use_primary(self):
+        page = self.client.get('/charging_stations/')
+        self.assertEqual(page.status_code, 200)
+        with self.app.test_request_context():
+            self.assertEqual(Person.query.get(1).name1, 'Primary')
+
+    def test_reads_after_write_use_primary(self):
+        with self.app.test_request_context():
+            from flask import g
+            g.replica_reads = True
+            self.assertEqual(Person.query.get(1).name1, 'Replica')
+            db.session.add(ChargingStation(name='Kiryanwompo'))
+            self.assertEqual(ChargingStation.query.count(), 1)
+            self.assertEqual(Person.query.filter_by(name1='Primary').count(), 1)
+            db.session.commit()
+            db.session.remove()
+
+    def test_user_reads_own_writes(self):
+        with self.client.session_transaction() as session:
+            session['primary_until'] = datetime.utcnow().timestamp() + 60
+        page = self.client.get('/drivers/').get_data(as_text=True)
+        self.assertIn('Primary', page)
+
+
+class StartupCase(unittest.TestCase):
+    def test_slim_app(self):
+        app = create_app(TestConfig, web=False)
+        self.assertEqual(app.blueprints, {})
+        self.assertNotIn('migrate', app.extensions)
+        with app.app_context():
+            db.create_all()
+            self.assertEqual(Driver.query.count(), 0)
+            db.drop_all()
+
+    def test_worker_imports(self):
+        '''
+        Celery workers import neither the web extensions nor pyarrow, and do not push an app context
+        '''
+        output = subprocess.check_output([sys.executable, '-c',
+            'import sys, flask, app.tasks; print(flask.has_app_context(), '
+            'sorted(m for m in ("alembic", "flask_bootstrap", "pyarrow") if m in sys.modules))'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True)
+        self.assertEqual(output.split('\n')[-2], 'False []')
+
+
+class EngineConfigCase(unittest.TestCase):
+    def test_profiles(self):
+        self.assertIs(get_config('web'), WebConfig)
+        self.assertIs(get_config('worker'), WorkerConfig)
+        app = create_app(WorkerConfig)
+        self.assertEqual(app.config['SQLALCHEMY_POOL_SIZE'], WorkerConfig.SQLALCHEMY_POOL_SIZE)
+
+    def test_pgbouncer_uses_null_pool(self):
+        class PgBouncerConfig(WebConfig):
+            SQLALCHEMY_PGBOUNCER = True
+        app = create_app(PgBouncerConfig)
+        options = {}
+        db.apply_pool_defaults(app, options)
+        self.assertIs(options['poolclass'], sqlalchemy.pool.NullPool)
+        self.assertNotIn('pool_size', options)
+
+    def test_pool_not_shared_across_fork(self):
+        '''
+        A connection pooled before a fork is replaced in the child, and still works in the parent
+        '''
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        engine = sqlalchemy.create_engine('sqlite:///' + path, poolclass=QueuePool, pool_size=1)
+        configure_engine(engine, {'SQLALCHEMY_POOL_PRE_PING': True})
+
+        connection = engine.connect()
+        parent_connection = connection.connection.connection
+        connection.close()
+
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                connection = engine.connect()
+                shared = connection.connection.connection is parent_connection
+                connection.scalar(sqlalchemy.select([1]))
+                os.write(write_end, b'shared' if shared else b'own')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        os.close(write_end)
+        self.assertEqual(os.read(read_end, 16), b'own')
+        os.close(read_end)
+
+        connection = engine.connect()
+        self.assertIs(connection.connection.connection, parent_connection)
+        self.assertEqual(connection.scalar(sqlalchemy.select([1])), 1)
+        connection.close()
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)